@@ -0,0 +1,182 @@
+# account.py
+
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+
+from config import Config
+from client import binance_client
+
+# Order statuses after which an order is no longer open
+CLOSED_STATUSES = {"FILLED", "CANCELED", "EXPIRED", "REJECTED", "EXPIRED_IN_MATCH"}
+
+
+class AccountState:
+    def __init__(self, client=binance_client, ttl=Config.ACCOUNT_STATE_TTL, orders_ttl=Config.ACCOUNT_ORDERS_TTL,
+                 replay_window=1000):
+        """
+        Keep balances and open orders in memory, indexed by asset and by symbol.
+        Each part is fetched in one request when it is first needed or older than its TTL, and kept
+        current in between by user-data-stream events passed to apply_event.
+        The service does not open a user data stream. Orders placed or canceled through the tools
+        invalidate both parts at once. Changes made elsewhere, such as fills and orders from other
+        clients, show up only when a snapshot expires: open orders can be up to orders_ttl seconds
+        stale and balances up to ttl seconds.
+        :param client: BinanceClient used for snapshots
+        :param ttl: Seconds a balances snapshot is served before it is refetched
+        :param orders_ttl: Seconds an open orders snapshot is served before it is refetched
+        :param replay_window: Recent events kept to replay onto a snapshot that was fetched while they arrived
+        """
+        self.client = client
+        self.ttls = {"balances": ttl, "orders": orders_ttl}
+        self.balances = {}  # asset -> {"free": str, "locked": str}
+        self.orders = {}  # symbol -> {orderId: order}
+        self.fetched_at = {"balances": None, "orders": None}  # monotonic time of the last snapshot
+        self.generation = 0  # Bumped by invalidate, so a refresh started before it does not count as fresh
+        self.events = deque(maxlen=replay_window)
+        self.lock = threading.Lock()
+        self.refresh_locks = {"balances": threading.Lock(), "orders": threading.Lock()}
+        self.feed_thread = None
+        self.stats = {"hits": 0, "refreshes": 0, "events": 0, "invalidations": 0}
+
+    def get_balance(self, asset):
+        """
+        Get the balance of an asset.
+        :param asset: Asset, e.g., BTC
+        :return: Dictionary with free and locked amounts, or None if the account holds none
+        """
+        self._ensure_fresh("balances")
+        with self.lock:
+            balance = self.balances.get(asset)
+            return dict(balance) if balance is not None else None
+
+    def get_open_orders(self, symbol):
+        """
+        Get the open orders of a symbol.
+        :param symbol: Trading pair, e.g., BTCUSDT
+        :return: List of orders in the format of /api/v3/openOrders
+        """
+        self._ensure_fresh("orders")
+        with self.lock:
+            return [dict(order) for order in self.orders.get(symbol, {}).values()]
+
+    def invalidate(self):
+        """Mark both snapshots stale, e.g. after placing or canceling an order."""
+        with self.lock:
+            self.fetched_at = {"balances": None, "orders": None}
+            self.generation += 1
+            self.stats["invalidations"] += 1
+
+    def apply_event(self, event):
+        """
+        Apply a user data stream event: outboundAccountPosition, balanceUpdate or executionReport.
+        Other event types are ignored.
+        :param event: Event dictionary as sent by the stream
+        """
+        with self.lock:
+            self.events.append(event)
+            self.stats["events"] += 1
+            self._apply(event)
+
+    def start_feed(self, events):
+        """
+        Apply events from a user data stream in a background thread.
+        :param events: Blocking iterable of event dictionaries, e.g. a websocket reader or
+                       StubBinance.user_data_stream()
+        :return: The feed thread
+        """
+        def consume():
+            for event in events:
+                self.apply_event(event)
+
+        self.feed_thread = threading.Thread(target=consume, daemon=True, name="account-feed")
+        self.feed_thread.start()
+        return self.feed_thread
+
+    def get_stats(self):
+        """
+        Get account state counters.
+        :return: Dictionary of counters, the number of assets and open orders, and the snapshot ages
+        """
+        now = time.monotonic()
+        with self.lock:
+            stats = dict(self.stats)
+            stats["assets"] = len(self.balances)
+            stats["open_orders"] = sum(len(orders) for orders in self.orders.values())
+            for part, fetched_at in self.fetched_at.items():
+                stats[f"{part}_age_s"] = now - fetched_at if fetched_at is not None else None
+        return stats
+
+    def _ensure_fresh(self, part):
+        if self._is_fresh(part):
+            with self.lock:
+                self.stats["hits"] += 1
+            return
+        # One refresh per part at a time, callers arriving meanwhile use its result
+        with self.refresh_locks[part]:
+            if not self._is_fresh(part):
+                self._refresh(part)
+
+    def _is_fresh(self, part):
+        fetched_at = self.fetched_at[part]
+        return fetched_at is not None and time.monotonic() - fetched_at < self.ttls[part]
+
+    def _refresh(self, part):
+        started = int(time.time() * 1000)
+        fetched_at = time.monotonic()
+        generation = self.generation
+        if part == "balances":
+            response = self.client.request("GET", "/api/v3/account", signed=True)
+            if response.status_code != 200:
+                raise ValueError(response.text)
+            payload = response.json()
+            snapshot = {balance["asset"]: {"free": balance["free"], "locked": balance["locked"]}
+                        for balance in payload.get("balances", [])}
+            as_of = payload.get("updateTime", started)
+        else:
+            response = self.client.request("GET", "/api/v3/openOrders", signed=True)
+            if response.status_code != 200:
+                raise ValueError(response.text)
+            snapshot = {}
+            for order in response.json():
+                snapshot.setdefault(order["symbol"], {})[order["orderId"]] = order
+            as_of = started
+
+        with self.lock:
+            if part == "balances":
+                self.balances = snapshot
+            else:
+                self.orders = snapshot
+            # Events newer than the snapshot may be missing from it
+            for event in self.events:
+                if event.get("E", 0) > as_of and _event_part(event) == part:
+                    self._apply(event)
+            if generation == self.generation:
+                self.fetched_at[part] = fetched_at
+            self.stats["refreshes"] += 1
+
+    def _apply(self, event):
+        kind = event.get("e")
+        if kind == "outboundAccountPosition":
+            for balance in event.get("B", []):
+                self.balances[balance["a"]] = {"free": balance["f"], "locked": balance["l"]}
+        elif kind == "balanceUpdate":
+            balance = self.balances.setdefault(event["a"], {"free": "0", "locked": "0"})
+            balance["free"] = str(Decimal(balance["free"]) + Decimal(event["d"]))
+        elif kind == "executionReport":
+            orders = self.orders.setdefault(event["s"], {})
+            if event["X"] in CLOSED_STATUSES:
+                orders.pop(event["i"], None)
+            else:
+                orders[event["i"]] = {"symbol": event["s"], "orderId": event["i"], "side": event["S"],
+                                      "type": event["o"], "origQty": event["q"], "price": event["p"],
+                                      "status": event["X"]}
+
+
+def _event_part(event):
+    return "orders" if event.get("e") == "executionReport" else "balances"
+
+
+# Initialize AccountState
+account_state = AccountState()
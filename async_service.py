@@ -0,0 +1,225 @@
+# async_service.py
+#
+# asyncio serving mode with the same /chat SSE contract as service.py.
+# Run with: uvicorn async_service:app --port 5000
+
+import asyncio
+import contextvars
+import functools
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from service import (session_manager, model_manager, chat_turn, Blocking, UseTools, format_token,
+                     format_final_token)
+from tokenizer import count_message_tokens, count_tokens
+from tool import tool_manager
+from tracing import tracer, TRACE_HEADER
+
+
+class UpstreamLimits:
+    def __init__(self, limits=Config.UPSTREAM_CONCURRENCY):
+        """
+        Cap the number of concurrent calls per upstream.
+        Semaphores are created on first use so they bind to the running event loop.
+        :param limits: Dictionary of upstream name -> maximum concurrent calls
+        """
+        self.limits = limits
+        self.semaphores = {}
+        # Tools are synchronous functions, they run on a pool sized to the Binance cap
+        self.tool_executor = ThreadPoolExecutor(max_workers=limits.get("binance", 16),
+                                                thread_name_prefix="binance")
+
+    def hold(self, upstream):
+        """
+        Get the semaphore guarding an upstream.
+        :param upstream: Upstream name, e.g., azure
+        :return: asyncio.Semaphore to use with `async with`
+        """
+        if upstream not in self.semaphores:
+            self.semaphores[upstream] = asyncio.Semaphore(self.limits.get(upstream, 64))
+        return self.semaphores[upstream]
+
+    async def use_tool(self, tool_manager, tool_name, **kwargs):
+        """
+        Run a tool off the event loop, within the Binance concurrency cap.
+        :param tool_manager: Tool management module
+        :param tool_name: Name of the tool
+        :param kwargs: Tool arguments
+        :return: Result of the tool call
+        """
+        async with self.hold("binance"):
+            loop = asyncio.get_running_loop()
+            # The worker nests its spans in the current one
+            call = functools.partial(contextvars.copy_context().run, tool_manager.use_tool, tool_name, **kwargs)
+            return await loop.run_in_executor(self.tool_executor, call)
+
+    async def use_tools(self, tool_manager, calls):
+        """
+        Run several tool calls concurrently, each within its timeout, like ToolManager.use_tools.
+        :param tool_manager: Tool management module
+        :param calls: List of (tool name, arguments dictionary)
+        :return: List of results, in the order of the calls
+        """
+        async def run(tool_name, arguments):
+            try:
+                return await asyncio.wait_for(self.use_tool(tool_manager, tool_name, **arguments),
+                                              tool_manager.get_timeout(tool_name))
+            except Exception as e:
+                return tool_manager.failure_result(tool_name, e)
+
+        return await asyncio.gather(*(run(tool_name, arguments) for tool_name, arguments in calls))
+
+
+upstream_limits = UpstreamLimits()
+
+
+async def handle_chat_stream_async(prompt, session_id, model_manager, tool_manager, limits=upstream_limits):
+    """
+    Async version of service.handle_chat_stream.
+    :param prompt: User input
+    :param session_id: Session ID
+    :param model_manager: Model management module
+    :param tool_manager: Tool management module
+    :param limits: UpstreamLimits capping concurrent upstream calls
+    :return: Async generator of text deltas
+    """
+    # Session locks block, so wait for them off the event loop
+    lock = session_manager.lock(session_id)
+    with tracer.span("chat.session_lock"):
+        await asyncio.to_thread(lock.acquire)
+    try:
+        async for delta in _drive(chat_turn(prompt, session_id, tool_manager), model_manager, tool_manager, limits):
+            yield delta
+    finally:
+        await asyncio.to_thread(lock.release)
+
+
+async def _drive(turn, model_manager, tool_manager, limits):
+    """
+    Async version of service._drive, making the upstream calls of a chat turn without blocking the event loop.
+    Session reads and writes run on a worker thread, tools and model calls within the upstream limits.
+    :return: Async generator of text deltas
+    """
+    send, value = turn.send, None
+    try:
+        while True:
+            try:
+                step = send(value)
+            except StopIteration:
+                return
+            send, value = turn.send, None
+            try:
+                if isinstance(step, str):
+                    yield step
+                elif isinstance(step, Blocking):
+                    value = await asyncio.to_thread(step.function, *step.args)
+                elif isinstance(step, UseTools):
+                    if step.speculation is not None and step.speculation.flights:
+                        # Speculative calls already run on the tool manager's pool, wait for them off the event loop
+                        value = await asyncio.to_thread(tool_manager.use_tools, step.calls, step.speculation)
+                    elif len(step.calls) == 1:
+                        function_name, function_args = step.calls[0]
+                        value = [await limits.use_tool(tool_manager, function_name, **function_args)]
+                    else:
+                        value = await limits.use_tools(tool_manager, step.calls)
+                else:
+                    streamed = ""
+                    async with limits.hold("azure"):
+                        reply = await model_manager.acall_azure(step.messages, stream=True, **step.options)
+                        async for delta in _relay(reply, step.span, step.messages):
+                            streamed += delta
+                            yield delta
+                    value = reply.result, streamed
+            except Exception as e:
+                send, value = turn.throw, e
+    finally:
+        turn.close()
+
+
+async def _relay(reply, span, messages):
+    """Async version of service._relay, yielding the deltas of a streaming reply."""
+    start = time.perf_counter()
+    streamed = ""
+    async for delta in reply:
+        if not streamed:
+            span.set(first_token_ms=round((time.perf_counter() - start) * 1000, 3))
+        streamed += delta
+        yield delta
+    if span.recording:
+        span.set(prompt_tokens=sum(map(count_message_tokens, messages)), completion_tokens=count_tokens(streamed))
+
+
+async def app(scope, receive, send):
+    """ASGI application serving POST /chat and GET /metrics."""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                upstream_limits.tool_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        body = tracer.render_prometheus().encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; version=0.0.4")]})
+        await send({"type": "http.response.body", "body": body})
+        return
+    if scope["path"] != "/chat" or scope["method"] != "POST":
+        await _send_json(send, 404, {"error": "Not found"})
+        return
+
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(body)
+    except ValueError:
+        await _send_json(send, 400, {"error": "Request body must be JSON"})
+        return
+    session_id = data.get('session_id', "root_session")
+    prompt = data.get('inputs')
+    headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+    trace_id = None
+    for name, value in scope["headers"]:
+        if name.decode("latin-1").lower() == TRACE_HEADER.lower():
+            trace_id = value.decode("latin-1") or uuid.uuid4().hex
+            headers.append((TRACE_HEADER.lower().encode(), trace_id.encode("latin-1")))
+
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    gen_text = ""
+    tok_cnt = 0
+    with tracer.span("chat", trace_id=trace_id) as span:
+        sending = 0.0  # Time spent in send, i.e. waiting for the server to take the events
+        async for delta in handle_chat_stream_async(prompt, session_id, model_manager, tool_manager):
+            tok_cnt += 1
+            gen_text += delta
+            sent = time.perf_counter()
+            await send({"type": "http.response.body", "body": format_token(delta).encode(), "more_body": True})
+            sending += time.perf_counter() - sent
+        tracer.record("chat.sse", sending, events=tok_cnt)
+    await send({"type": "http.response.body",
+                "body": format_final_token(gen_text, tok_cnt, span.details()).encode()})
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=5000)
@@ -0,0 +1,324 @@
+# batching.py
+
+import queue
+import threading
+
+import torch
+from transformers import DynamicCache
+
+from config import Config
+
+
+class _Sequence:
+    def __init__(self, input_ids, max_new_tokens, session_id, streamer, logits_processor):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.session_id = session_id
+        self.streamer = streamer
+        self.logits_processor = logits_processor
+        self.generated = []
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        if self.streamer is not None:
+            self.streamer.end()
+        self.done.set()
+
+
+class BatchingEngine:
+    def __init__(self, model, tokenizer, max_batch_size=Config.LOCAL_BATCH_SIZE, kv_cache=None):
+        """
+        Run the local model over all pending requests at once with continuous batching.
+        New prompts are prefilled together, left-padded, and join the running batch between decode
+        steps; finished sequences leave it without waiting for the others.
+        :param model: Loaded causal LM
+        :param tokenizer: Its tokenizer
+        :param max_batch_size: Maximum number of sequences decoded together
+        :param kv_cache: Optional PrefixKVCache to prefill from and to store finished sequences in
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.kv_cache = kv_cache
+        self.pending = queue.Queue()
+        self.active = []  # Sequences in batch order
+        self.cache = None  # DynamicCache of the running batch, left-padded
+        self.mask = None  # Attention mask of the running batch
+
+        eos = model.generation_config.eos_token_id
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+        self.stats = {"requests": 0, "steps": 0, "tokens": 0, "batch_size_sum": 0, "max_batch_size_seen": 0}
+        self.thread = threading.Thread(target=self._run, daemon=True, name="batching-engine")
+        self.thread.start()
+
+    def submit(self, input_ids, max_new_tokens, session_id=None, streamer=None, logits_processor=None):
+        """
+        Queue a prompt for generation.
+        :param input_ids: 1-D tensor of prompt token ids
+        :param max_new_tokens: Maximum number of tokens to generate
+        :param session_id: Session ID for the prefix KV cache
+        :param streamer: Optional streamer receiving each new token, e.g. a TextIteratorStreamer
+        :param logits_processor: Optional LogitsProcessor applied to this sequence's logits before sampling
+        :return: Handle to pass to wait
+        """
+        sequence = _Sequence(input_ids.to(self.model.device), max_new_tokens, session_id, streamer, logits_processor)
+        if streamer is not None:
+            # Same protocol as generate: the prompt goes first, so skip_prompt streamers drop it
+            streamer.put(input_ids.unsqueeze(0).cpu())
+        self.pending.put(sequence)
+        return sequence
+
+    @staticmethod
+    def wait(sequence):
+        """
+        Block until a sequence is finished.
+        :param sequence: Handle returned by submit
+        :return: 1-D tensor of prompt and generated token ids
+        """
+        sequence.done.wait()
+        if sequence.error is not None:
+            raise sequence.error
+        generated = torch.tensor(sequence.generated, dtype=sequence.input_ids.dtype, device=sequence.input_ids.device)
+        return torch.cat([sequence.input_ids, generated])
+
+    def get_stats(self):
+        """
+        Get engine counters.
+        :return: Dictionary with requests, decode steps, generated tokens and the mean batch size
+        """
+        stats = dict(self.stats)
+        stats["mean_batch_size"] = stats["batch_size_sum"] / stats["steps"] if stats["steps"] else 0.0
+        stats["pending"] = self.pending.qsize()
+        stats["active"] = len(self.active)
+        return stats
+
+    def _run(self):
+        while True:
+            try:
+                self._cycle()
+            except Exception as e:
+                # Keep serving later requests: everything in flight fails with the error instead of hanging
+                for sequence in self.active:
+                    sequence.finish(e)
+                self.active, self.cache, self.mask = [], None, None
+                while True:
+                    try:
+                        self.pending.get_nowait().finish(e)
+                    except queue.Empty:
+                        break
+
+    def _cycle(self):
+        # Sleep until there is work, then admit as many new sequences as the batch allows
+        if not self.active:
+            self._admit([self.pending.get()])
+        admitted = []
+        while len(self.active) + len(admitted) < self.max_batch_size:
+            try:
+                admitted.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if admitted:
+            self._admit(admitted)
+        if self.active:
+            self._step()
+
+    @torch.no_grad()
+    def _admit(self, sequences):
+        self.stats["requests"] += len(sequences)
+        fresh = []
+        for sequence in sequences:
+            cache = self.kv_cache.lookup(sequence.session_id, sequence.input_ids) if self.kv_cache else None
+            if cache is None:
+                fresh.append(sequence)
+                continue
+            # Prefill the uncached tail of this prompt on top of the reused prefix
+            try:
+                tail = sequence.input_ids[cache.get_seq_length():].unsqueeze(0)
+                length = len(sequence.input_ids)
+                outputs = self.model(
+                    input_ids=tail,
+                    attention_mask=torch.ones(1, length, dtype=torch.long, device=tail.device),
+                    past_key_values=cache,
+                    use_cache=True,
+                )
+                self._join([sequence], outputs.past_key_values, torch.ones(1, length, dtype=torch.long,
+                                                                           device=tail.device), outputs.logits[:, -1])
+            except Exception as e:
+                self._fail([sequence], e)
+
+        if not fresh:
+            return
+        try:
+            width = max(len(sequence.input_ids) for sequence in fresh)
+            device = fresh[0].input_ids.device
+            input_ids = torch.full((len(fresh), width), self.pad_token_id, dtype=torch.long, device=device)
+            mask = torch.zeros((len(fresh), width), dtype=torch.long, device=device)
+            for row, sequence in enumerate(fresh):
+                input_ids[row, width - len(sequence.input_ids):] = sequence.input_ids
+                mask[row, width - len(sequence.input_ids):] = 1
+            position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+            outputs = self.model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                                 past_key_values=DynamicCache(), use_cache=True)
+            self._join(fresh, outputs.past_key_values, mask, outputs.logits[:, -1])
+        except Exception as e:
+            self._fail(fresh, e)
+
+    def _join(self, sequences, cache, mask, logits):
+        """Merge prefilled sequences into the running batch and emit their first token."""
+        if self.active:
+            width = max(self.mask.shape[1], mask.shape[1])
+            layers = [(torch.cat([_pad_left(k, width), _pad_left(new_k, width)]),
+                       torch.cat([_pad_left(v, width), _pad_left(new_v, width)]))
+                      for (k, v), (new_k, new_v) in zip(_layer_tensors(self.cache), _layer_tensors(cache))]
+            self.cache = _build_cache(layers)
+            self.mask = torch.cat([_pad_left(self.mask, width), _pad_left(mask, width)])
+        else:
+            self.cache, self.mask = cache, mask
+        self.active.extend(sequences)
+        logits, errors = self._process(sequences, logits)
+        self._emit(sequences, self._sample(logits), errors)
+
+    @torch.no_grad()
+    def _step(self):
+        """Decode one token for every active sequence."""
+        last = torch.tensor([[sequence.generated[-1]] for sequence in self.active], device=self.mask.device)
+        position_ids = self.mask.sum(-1, keepdim=True)
+        self.mask = torch.cat([self.mask, torch.ones_like(last)], dim=1)
+        try:
+            outputs = self.model(input_ids=last, attention_mask=self.mask, position_ids=position_ids,
+                                 past_key_values=self.cache, use_cache=True)
+        except Exception as e:
+            for sequence in self.active:
+                sequence.finish(e)
+            self.active, self.cache, self.mask = [], None, None
+            return
+        self.cache = outputs.past_key_values
+        self.stats["steps"] += 1
+        self.stats["batch_size_sum"] += len(self.active)
+        self.stats["max_batch_size_seen"] = max(self.stats["max_batch_size_seen"], len(self.active))
+        sequences = list(self.active)
+        logits, errors = self._process(sequences, outputs.logits[:, -1])
+        self._emit(sequences, self._sample(logits), errors)
+
+    def _emit(self, sequences, tokens, errors):
+        finished = []
+        for sequence, token in zip(sequences, tokens.tolist()):
+            if id(sequence) in errors:
+                finished.append(sequence)
+                continue
+            sequence.generated.append(token)
+            self.stats["tokens"] += 1
+            if sequence.streamer is not None:
+                sequence.streamer.put(torch.tensor([token]))
+            if token in self.eos_token_ids or len(sequence.generated) >= sequence.max_new_tokens:
+                finished.append(sequence)
+        if finished:
+            self._retire(finished, errors)
+
+    def _fail(self, sequences, error):
+        """Finish sequences with an error, dropping those that already joined the batch."""
+        joined = [sequence for sequence in sequences if sequence in self.active]
+        if joined:
+            self._retire(joined, {id(sequence): error for sequence in joined})
+        for sequence in sequences:
+            if sequence not in joined:
+                sequence.finish(error)
+
+    def _retire(self, finished, errors=None):
+        """
+        Drop finished sequences from the batch and trim padding no remaining row needs.
+        :param finished: Sequences to drop
+        :param errors: Dictionary of id(sequence) -> error, for sequences that failed
+        """
+        errors = errors or {}
+        rows = {id(sequence): row for row, sequence in enumerate(self.active)}
+        if self.kv_cache is not None:
+            for sequence in finished:
+                if id(sequence) not in errors and sequence.generated:
+                    self._store(sequence, rows[id(sequence)])
+        for sequence in finished:
+            sequence.finish(errors.get(id(sequence)))
+
+        keep = [row for row, sequence in enumerate(self.active) if sequence not in finished]
+        self.active = [self.active[row] for row in keep]
+        if not self.active:
+            self.cache, self.mask = None, None
+            return
+        index = torch.tensor(keep, device=self.mask.device)
+        mask = self.mask[index]
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        self.cache = _build_cache([(k[index, :, start:], v[index, :, start:]) for k, v in _layer_tensors(self.cache)])
+        self.mask = mask[:, start:]
+
+    def _store(self, sequence, row):
+        # Cached positions are the prompt and all generated tokens but the last one
+        length = len(sequence.input_ids) + len(sequence.generated) - 1
+        width = self.cache.get_seq_length()
+        layers = [(k[row:row + 1, :, width - length:], v[row:row + 1, :, width - length:])
+                  for k, v in _layer_tensors(self.cache)]
+        token_ids = torch.cat([sequence.input_ids, torch.tensor(sequence.generated[:-1], dtype=sequence.input_ids.dtype,
+                                                                device=sequence.input_ids.device)])
+        self.kv_cache.store(sequence.session_id, token_ids, _build_cache(layers))
+
+    @staticmethod
+    def _process(sequences, logits):
+        """
+        Apply each sequence's logits processor to its row, e.g. to constrain it to a grammar.
+        :return: Tuple of (logits, dictionary of id(sequence) -> error for sequences whose processor failed)
+        """
+        errors = {}
+        for row, sequence in enumerate(sequences):
+            if sequence.logits_processor is not None:
+                try:
+                    token_ids = torch.tensor([sequence.input_ids.tolist() + sequence.generated],
+                                             device=logits.device)
+                    logits[row:row + 1] = sequence.logits_processor(token_ids, logits[row:row + 1])
+                except Exception as e:
+                    errors[id(sequence)] = e
+        return logits, errors
+
+    def _sample(self, logits):
+        config = self.model.generation_config
+        if not config.do_sample:
+            return logits.argmax(-1)
+        logits = logits / max(config.temperature or 1.0, 1e-5)
+        if config.top_k:
+            threshold = torch.topk(logits, min(config.top_k, logits.shape[-1])).values[..., -1:]
+            logits = logits.masked_fill(logits < threshold, float("-inf"))
+        probs = torch.softmax(logits.float(), dim=-1)
+        if config.top_p and config.top_p < 1.0:
+            sorted_probs, order = probs.sort(dim=-1, descending=True)
+            drop = sorted_probs.cumsum(-1) - sorted_probs > config.top_p
+            probs = probs.scatter(-1, order, sorted_probs.masked_fill(drop, 0.0))
+        return torch.multinomial(probs, 1).squeeze(-1)
+
+
+def _layer_tensors(cache):
+    """Per-layer (keys, values) of a DynamicCache, across transformers versions."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def _build_cache(layers):
+    cache = DynamicCache()
+    for index, (keys, values) in enumerate(layers):
+        cache.update(keys, values, index)
+    return cache
+
+
+def _pad_left(tensor, width):
+    """Left-pad the sequence axis (last for masks, third for key/value states) with zeros."""
+    axis = 1 if tensor.dim() == 2 else 2
+    missing = width - tensor.shape[axis]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[axis] = missing
+    return torch.cat([torch.zeros(shape, dtype=tensor.dtype, device=tensor.device), tensor], dim=axis)
@@ -0,0 +1,149 @@
+# benchmarks/klines.py
+#
+# Kline store and indicators over multi-year 1m data. A synthetic random walk is written as a cache
+# file ending at the last closed minute; KlineStore then opens it against a stub exchange, so only
+# the minutes that closed since are fetched. Indicator times over the whole series are compared with
+# plain Python loops, and appending a candle is compared with rewriting the whole file.
+#
+# Usage: python -m benchmarks.klines --years 3
+
+import argparse
+import math
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from client import BinanceClient
+from kline import CANDLE, INTERVAL_MS, KlineStore, sma, ema, rsi, volatility
+from stub_binance import StubBinance
+
+
+def synthetic_candles(count, end_open_time, step):
+    """Random-walk candles, the last one opening at end_open_time."""
+    rng = np.random.default_rng(0)
+    close = 30_000 * np.exp(np.cumsum(rng.normal(0, 0.0008, count)))
+    candles = np.empty(count, dtype=CANDLE)
+    candles["open_time"] = end_open_time - step * np.arange(count - 1, -1, -1, dtype=np.int64)
+    candles["open"] = np.concatenate([[close[0]], close[:-1]])
+    candles["close"] = close
+    candles["high"] = np.maximum(candles["open"], close) * 1.0005
+    candles["low"] = np.minimum(candles["open"], close) * 0.9995
+    candles["volume"] = rng.uniform(1, 50, count)
+    candles["quote_volume"] = candles["volume"] * close
+    candles["trades"] = rng.integers(10, 1000, count)
+    return candles
+
+
+def python_sma(values, period):
+    window, result = 0.0, []
+    for index, value in enumerate(values):
+        window += value
+        if index >= period:
+            window -= values[index - period]
+        if index >= period - 1:
+            result.append(window / period)
+    return result
+
+
+def python_ema(values, period):
+    alpha, result = 2 / (period + 1), [values[0]]
+    for value in values[1:]:
+        result.append(result[-1] + alpha * (value - result[-1]))
+    return result
+
+
+def python_rsi(values, period):
+    gains = [max(b - a, 0.0) for a, b in zip(values, values[1:])]
+    losses = [max(a - b, 0.0) for a, b in zip(values, values[1:])]
+    gain, loss = sum(gains[:period]) / period, sum(losses[:period]) / period
+    result = [100 - 100 / (1 + gain / loss) if loss else 100.0]
+    for g, l in zip(gains[period:], losses[period:]):
+        gain, loss = (gain * (period - 1) + g) / period, (loss * (period - 1) + l) / period
+        result.append(100 - 100 / (1 + gain / loss) if loss else 100.0)
+    return result
+
+
+def python_volatility(values, period, periods_per_year):
+    returns = [math.log(b / a) for a, b in zip(values, values[1:])]
+    total, squares, result = 0.0, 0.0, []
+    for index, value in enumerate(returns):
+        total += value
+        squares += value * value
+        if index >= period:
+            total -= returns[index - period]
+            squares -= returns[index - period] ** 2
+        if index >= period - 1:
+            result.append((max(squares - total * total / period, 0.0) / (period - 1) * periods_per_year) ** 0.5)
+    return result
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the kline store and indicators on 1m data.")
+    parser.add_argument("--years", type=float, default=3.0, help="Years of 1m candles")
+    parser.add_argument("--period", type=int, default=50, help="Indicator period")
+    parser.add_argument("--skip-python", action="store_true", help="Skip the plain Python loops")
+    args = parser.parse_args()
+
+    step = INTERVAL_MS["1m"]
+    count = int(args.years * 365 * 1440)
+    last_closed = (int(time.time() * 1000) // step - 1) * step
+    candles = synthetic_candles(count, last_closed, step)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "BTCUSDT_1m.bin")
+        seconds, _ = timed(candles.tofile, path)
+        print(f"{count:,} candles, {os.path.getsize(path) / 2 ** 20:.1f} MB file, written in {seconds:.3f} s")
+
+        stub = StubBinance(weight_limit=10 ** 6)
+        client = BinanceClient(base_url=stub.start())
+        try:
+            store = KlineStore(client=client, cache_dir=directory)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            seconds, stored = timed(store.get_candles, "BTCUSDT", "1m", count)
+            stats = store.get_stats()
+            print(f"Restart: opened and synced in {seconds * 1000:.1f} ms, {stats['pages']} request(s), "
+                  f"{stats['candles_fetched']} new candle(s), peak RSS +"
+                  f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss:.1f} MB")
+
+            seconds, _ = timed(store.indicator, "BTCUSDT", "ema", args.period, "1m")
+            print(f"Tool call ema({args.period}) on 1m, cached: {seconds * 1000:.2f} ms")
+        finally:
+            stub.stop()
+
+        # Appending one candle against rewriting the whole cache
+        new = synthetic_candles(1, last_closed + step, step)
+        seconds_append, _ = timed(store._append, ("BTCUSDT", "1m"), new)
+        seconds_rewrite, _ = timed(np.save, os.path.join(directory, "rewrite.npy"), np.concatenate([stored, new]))
+        print(f"Append one candle: {seconds_append * 1000:.2f} ms, rewrite whole file: {seconds_rewrite * 1000:.1f} ms")
+        close = np.array(stored["close"])
+
+    periods_per_year = 365 * 1440
+    indicators = [
+        ("sma", sma, python_sma, (args.period,)),
+        ("ema", ema, python_ema, (args.period,)),
+        ("rsi", rsi, python_rsi, (args.period,)),
+        ("volatility", volatility, python_volatility, (args.period, periods_per_year)),
+    ]
+    print(f"{'indicator':<12}{'numpy ms':>10}{'python ms':>11}{'speedup':>9}{'max diff':>11}")
+    for name, vectorized, loop, extra in indicators:
+        seconds, values = timed(vectorized, close, *extra)
+        if args.skip_python:
+            print(f"{name:<12}{seconds * 1000:>10.1f}")
+            continue
+        reference_seconds, reference = timed(loop, close.tolist(), *extra)
+        difference = np.max(np.abs(values - np.array(reference)) / np.abs(np.array(reference)).max())
+        print(f"{name:<12}{seconds * 1000:>10.1f}{reference_seconds * 1000:>11.1f}"
+              f"{reference_seconds / seconds:>8.0f}x{difference:>11.1e}")
+
+
+if __name__ == "__main__":
+    main()
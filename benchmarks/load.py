@@ -0,0 +1,221 @@
+# benchmarks/load.py
+#
+# End-to-end load test of the chat service without any live API: service.app (or async_service.app)
+# runs in a thread against StubBinance and StubLLM, and simulated users replay multi-turn sessions
+# over HTTP at increasing concurrency. Each turn is read as the SSE stream a client sees, for the time
+# to the first token and to the final event. Memory is the RSS of this process, which holds the
+# service, the stubs and the clients.
+#
+# Usage: python -m benchmarks.load --concurrency 1,4,16,64 --rounds 2 --first-token 0.3
+#        python -m benchmarks.load --server asgi --traffic sessions.jsonl
+
+import argparse
+import json
+import logging
+import resource
+import socket
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from client import binance_client
+from config import Config
+from history import trade_history
+from kline import kline_store
+from stub_binance import StubBinance
+from stub_llm import StubLLM
+
+# A session of test.py-style questions, replayed by every simulated user unless --traffic is given
+CONVERSATION = [
+    "What is the current price of BTC?",
+    "What is my BTC balance?",
+    "How did ETH do this week?",
+    "What are the five trades in my history for BTCUSDT?",
+    "What are my open orders for BTCUSDT?",
+    "Compare the prices of SOL and BNB.",
+]
+
+
+def load_traffic(path):
+    """
+    Read sessions to replay from a JSONL file of {"session_id": ..., "inputs": ...} lines, in order.
+    :return: List of prompt lists, one per session
+    """
+    sessions = defaultdict(list)
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                turn = json.loads(line)
+                sessions[turn.get("session_id", "default")].append(turn["inputs"])
+    return list(sessions.values())
+
+
+def serve(server):
+    """
+    Run the service in a background thread.
+    :param server: "flask" for service.app, "asgi" for async_service.app under uvicorn
+    :return: Tuple of (base URL, function stopping the server)
+    """
+    if server == "flask":
+        from werkzeug.serving import make_server
+        import service
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)  # One access log line per turn otherwise
+        http_server = make_server("127.0.0.1", 0, service.app, threaded=True)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{http_server.server_port}", http_server.shutdown
+
+    import uvicorn
+    import async_service
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    http_server = uvicorn.Server(uvicorn.Config(async_service.app, host="127.0.0.1", port=port,
+                                                log_level="warning", backlog=4096))
+    threading.Thread(target=http_server.run, daemon=True).start()
+    while not http_server.started:
+        time.sleep(0.01)
+
+    def stop():
+        http_server.should_exit = True
+
+    return f"http://127.0.0.1:{port}", stop
+
+
+def chat_turn(http, url, session_id, prompt):
+    """
+    Send one turn and read its SSE stream.
+    :return: Tuple of (seconds to the first token, seconds to the final event, generated text)
+    """
+    start = time.perf_counter()
+    first, text = None, None
+    with http.post(f"{url}/chat", json={"session_id": session_id, "inputs": prompt}, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            event = json.loads(line[len(b"data:"):])
+            if event["token"]["special"]:
+                text = event["generated_text"]
+            elif first is None:
+                first = time.perf_counter() - start
+    latency = time.perf_counter() - start
+    return (first if first is not None else latency), latency, text
+
+
+def run(url, sessions, concurrency, rounds, level):
+    """Replay sessions from `concurrency` users at once, each user one turn after the other."""
+    first_tokens, latencies, errors = [], [], []
+    lock = threading.Lock()
+
+    def user(index):
+        http = requests.Session()
+        prompts = sessions[index % len(sessions)]
+        for round_index in range(rounds):
+            session_id = f"load-{level}-{index}-{round_index}"
+            for prompt in prompts:
+                try:
+                    first, latency, _ = chat_turn(http, url, session_id, prompt)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                    continue
+                with lock:
+                    first_tokens.append(first)
+                    latencies.append(latency)
+
+    start = time.perf_counter()
+    users = [threading.Thread(target=user, args=(index,)) for index in range(concurrency)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    first_tokens.sort()
+    latencies.sort()
+    return {
+        "turns": len(latencies),
+        "errors": len(errors),
+        "requests_per_s": len(latencies) / elapsed,
+        "p50_ttft_s": statistics.median(first_tokens) if first_tokens else 0.0,
+        "p99_ttft_s": _percentile(first_tokens, 0.99),
+        "p50_latency_s": statistics.median(latencies) if latencies else 0.0,
+        "p99_latency_s": _percentile(latencies, 0.99),
+        "rss_mb": _rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the chat service against stub Binance and LLM servers.")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask", help="Serving mode")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="Comma-separated numbers of simultaneous users")
+    parser.add_argument("--rounds", type=int, default=1, help="Times each user replays its session")
+    parser.add_argument("--traffic", help="JSONL file of session_id/inputs turns to replay instead of CONVERSATION")
+    parser.add_argument("--first-token", type=float, default=0.3, help="Seconds before the stub LLM's first chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Seconds between the stub LLM's chunks")
+    parser.add_argument("--binance-latency", type=float, default=0.02, help="Seconds added to each Binance request")
+    parser.add_argument("--no-router", action="store_true", help="Send every turn to the LLM")
+    parser.add_argument("--no-response-cache", action="store_true", help="Answer every turn afresh")
+    args = parser.parse_args()
+
+    llm = StubLLM(first_token=args.first_token, chunk_delay=args.chunk_delay)
+    exchange = StubBinance(weight_limit=10 ** 9, order_limit=10 ** 9, latency=args.binance_latency)
+    Config.AZURE_API_KEY = Config.OPENAI_API_KEY = "stub"
+    Config.AZURE_API_VERSION = "2024-06-01"
+    Config.AZURE_ENDPOINT = Config.OPENAI_BASE_URL = llm.start()
+    binance_client.base_url = exchange.start()
+    trade_history.cache_dir = kline_store.cache_dir = None
+    url, stop = serve(args.server)
+    if args.no_router:
+        from service import intent_router
+        intent_router.enabled = False
+    if args.no_response_cache:
+        from service import response_cache
+        response_cache.enabled = False
+
+    sessions = load_traffic(args.traffic) if args.traffic else [CONVERSATION]
+    print(f"{args.server} service at {url}, {len(sessions)} session script(s), "
+          f"{sum(map(len, sessions))} turn(s) each round, stub LLM first token {args.first_token:g} s")
+    print(f"{'users':>6}{'turns':>7}{'errors':>7}{'req/s':>8}{'p50 ttft':>10}{'p99 ttft':>10}"
+          f"{'p50 lat':>9}{'p99 lat':>9}{'RSS MB':>8}")
+    try:
+        for level, concurrency in enumerate(int(value) for value in args.concurrency.split(",")):
+            result = run(url, sessions, concurrency, args.rounds, level)
+            print(f"{concurrency:>6}{result['turns']:>7}{result['errors']:>7}{result['requests_per_s']:>8.1f}"
+                  f"{result['p50_ttft_s']:>10.3f}{result['p99_ttft_s']:>10.3f}{result['p50_latency_s']:>9.3f}"
+                  f"{result['p99_latency_s']:>9.3f}{result['rss_mb']:>8.1f}")
+    finally:
+        stop()
+        llm.stop()
+        exchange.stop()
+
+    stats = llm.get_stats()
+    print(f"Stub LLM: {stats['requests']} requests, peak {stats['max_active']} at once; "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    from service import response_cache
+    cache = response_cache.get_stats()
+    print(f"Response cache: hit rate {cache['hit_rate']:.1%}, {cache['llm_calls_avoided']} LLM calls avoided")
+
+
+def _percentile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _rss_mb():
+    """Current resident set size; falls back to the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# benchmarks/local_batching.py
+#
+# Throughput and latency of local-model inference with and without the continuous batching
+# engine, at increasing concurrency.
+#
+# Usage: python -m benchmarks.local_batching --model /path/to/your/model
+
+import argparse
+import statistics
+import threading
+import time
+
+from transformers import TextIteratorStreamer
+
+from batching import BatchingEngine
+from config import Config
+from model import ModelManager
+
+PROMPTS = [
+    "What is the current price of BTC?",
+    "Summarize my last five trades on ETHUSDT.",
+    "Explain what a market order is in two sentences.",
+    "Should I keep some USDT available for fees? Answer briefly.",
+]
+
+
+def run(backend, concurrency, requests_per_client, max_new_tokens):
+    """Send requests from `concurrency` clients, each one after the other, and time them."""
+    latencies, first_tokens, tokens = [], [], []
+    lock = threading.Lock()
+
+    def client(index):
+        for request in range(requests_per_client):
+            prompt = PROMPTS[(index + request) % len(PROMPTS)]
+            inputs = backend.tokenizer(prompt, return_tensors="pt").to(backend.model.device)
+            streamer = TextIteratorStreamer(backend.tokenizer, skip_prompt=True)
+            start = time.perf_counter()
+            first = None
+            result = {}
+            thread = threading.Thread(target=lambda: result.update(ids=backend.generate(
+                inputs.input_ids, max_new_tokens, f"bench-{index}-{request}", streamer=streamer)))
+            thread.start()
+            for _ in streamer:
+                if first is None:
+                    first = time.perf_counter() - start
+            thread.join()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                first_tokens.append(first if first is not None else latencies[-1])
+                tokens.append(result["ids"].shape[1] - inputs.input_ids.shape[1])
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(index,)) for index in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    first_tokens.sort()
+    return {
+        "tokens_per_s": sum(tokens) / elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "p50_latency_s": statistics.median(latencies),
+        "p99_latency_s": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+        "p50_ttft_s": statistics.median(first_tokens),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark continuous batching for the local model.")
+    parser.add_argument("--model", default=Config.LOCAL_MODEL_PATH, help="Local model path")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=4, help="Requests per client")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=Config.LOCAL_BATCH_SIZE)
+    args = parser.parse_args()
+    if not args.model:
+        parser.error("set --model or Config.LOCAL_MODEL_PATH")
+
+    Config.LOCAL_MODEL_PATH = args.model
+    Config.LOCAL_BATCHING = False
+    backend = ModelManager().get_backend("local")
+    # Measure batching alone, without prefix reuse between requests
+    backend.kv_cache.min_prefix = float("inf")
+    backend.model.generation_config.do_sample = False
+    engine = BatchingEngine(backend.model, backend.tokenizer, max_batch_size=args.batch_size)
+
+    print(f"{'mode':<10}{'clients':>8}{'tok/s':>10}{'req/s':>8}{'p50 lat':>10}{'p99 lat':>10}{'p50 ttft':>10}")
+    for concurrency in [int(level) for level in args.concurrency.split(",")]:
+        for mode, batching_engine in (("generate", None), ("batched", engine)):
+            backend.batching_engine = batching_engine
+            result = run(backend, concurrency, args.requests, args.max_new_tokens)
+            print(f"{mode:<10}{concurrency:>8}{result['tokens_per_s']:>10.1f}{result['requests_per_s']:>8.2f}"
+                  f"{result['p50_latency_s']:>10.3f}{result['p99_latency_s']:>10.3f}{result['p50_ttft_s']:>10.3f}")
+    print(f"Engine: {engine.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
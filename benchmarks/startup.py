@@ -0,0 +1,70 @@
+# benchmarks/startup.py
+#
+# Import time and peak RSS of the service entry points, each measured in a fresh interpreter.
+# Exits non-zero when a limit is exceeded or a heavy backend dependency is imported at startup,
+# so it can guard against startup regressions.
+#
+# Usage: python -m benchmarks.startup --modules service,async_service --runs 5
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Dependencies of the backends, which must only be imported on first use
+HEAVY_MODULES = ["torch", "transformers", "openai"]
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(module, runs):
+    """Import `module` in `runs` fresh interpreters and collect the probe results."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=root, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "p50_seconds": statistics.median(result["seconds"] for result in results),
+        "max_seconds": max(result["seconds"] for result in results),
+        "max_rss_mb": max(result["max_rss_mb"] for result in results),
+        "heavy": sorted({name for result in results for name in result["heavy"]}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark service startup time and memory.")
+    parser.add_argument("--modules", default="service,async_service", help="Comma-separated modules to import")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module")
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="Limit on the median import time")
+    parser.add_argument("--max-rss-mb", type=float, default=150.0, help="Limit on the peak RSS")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<16}{'p50 s':>8}{'max s':>8}{'RSS MB':>9}  heavy imports")
+    for module in args.modules.split(","):
+        result = measure(module, args.runs)
+        print(f"{module:<16}{result['p50_seconds']:>8.3f}{result['max_seconds']:>8.3f}{result['max_rss_mb']:>9.1f}"
+              f"  {', '.join(result['heavy']) or '-'}")
+        if result["heavy"] or result["p50_seconds"] > args.max_seconds or result["max_rss_mb"] > args.max_rss_mb:
+            failed = True
+    if failed:
+        print("Startup regression: limits exceeded or a backend dependency was imported at startup")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
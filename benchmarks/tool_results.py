@@ -0,0 +1,119 @@
+# benchmarks/tool_results.py
+#
+# Prompt tokens of the follow-up LLM call with raw tool results (the Python repr) and with the compact
+# rendering of ToolManager.render_result. A scripted session of test.py-style questions is replayed
+# against the stub exchange; each question comes with the tool calls the model would make, so no LLM
+# is needed. Both variants keep their history in an InMemorySessionManager, so later turns pay for
+# earlier results the way they do in the service.
+#
+# Usage: python -m benchmarks.tool_results --trades 250 --orders 40
+
+import argparse
+import time
+
+from client import binance_client
+from history import trade_history
+from kline import kline_store
+from session import InMemorySessionManager
+from stub_binance import StubBinance
+from tokenizer import count_message_tokens
+from tool import tool_manager
+
+# (prompt, tool calls the model answers it with)
+REPLAY = [
+    ("What is the current price of BTC?", [("get_symbol_price", {"symbol": "BTCUSDT"})]),
+    ("What is my BTC balance?", [("get_account_balance", {"asset": "BTC"})]),
+    ("What are the last 100 trades in my history for BTCUSDT?",
+     [("get_trade_history", {"symbol": "BTCUSDT", "limit": 100})]),
+    ("What are my open orders for BTCUSDT?", [("get_open_orders", {"symbol": "BTCUSDT"})]),
+    ("How did ETH do this week?", [("get_klines", {"symbol": "ETHUSDT", "interval": "1d", "limit": 7})]),
+    ("Show me hourly candles for BTC over the last day.",
+     [("get_klines", {"symbol": "BTCUSDT", "interval": "1h", "limit": 24})]),
+    ("Summarize my BTCUSDT trading.", [("get_trade_summary", {"symbol": "BTCUSDT"})]),
+    ("What was my daily volume on BTCUSDT over the last month?",
+     [("get_daily_volume", {"symbol": "BTCUSDT", "days": 30})]),
+    ("Prices of BTC, ETH and SOL?", [("get_symbol_price", {"symbol": symbol})
+                                     for symbol in ("BTCUSDT", "ETHUSDT", "SOLUSDT")]),
+    ("Show all my trades for BTCUSDT.", [("get_trade_history", {"symbol": "BTCUSDT", "limit": 1000})]),
+    ("What are my open orders for BTCUSDT now?", [("get_open_orders", {"symbol": "BTCUSDT"})]),
+]
+REPLY = "Here is what I found."
+
+
+def seed(stub, trades, orders):
+    """Fill the stub with trade history and resting limit orders on BTCUSDT."""
+    now = int(time.time() * 1000)
+    for index in range(trades):
+        price = 80_000 + (index % 50) * 10
+        stub.trades.append({"symbol": "BTCUSDT", "id": index + 1, "orderId": index + 1, "price": f"{price:.8f}",
+                            "qty": "0.01000000", "quoteQty": f"{price * 0.01:.8f}", "commission": "0.00001000",
+                            "commissionAsset": "BTC", "time": now - (trades - index) * 3_600_000,
+                            "isBuyer": index % 3 != 0, "isMaker": False, "side": "BUY" if index % 3 else "SELL"})
+    for index in range(orders):
+        binance_client.request("POST", "/api/v3/order", {"symbol": "BTCUSDT", "side": "BUY", "type": "LIMIT",
+                                                         "quantity": "0.01000000",
+                                                         "price": f"{70_000 + index * 50:.8f}"}, signed=True)
+
+
+def render(variant, tool_name, arguments, result):
+    if variant == "compact":
+        return tool_manager.render_result(tool_name, arguments, result)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prompt tokens of raw and compact tool results.")
+    parser.add_argument("--trades", type=int, default=250, help="Trades in the BTCUSDT history")
+    parser.add_argument("--orders", type=int, default=40, help="Open BTCUSDT orders")
+    parser.add_argument("--sessions", type=int, default=1, help="Times the session is replayed")
+    args = parser.parse_args()
+
+    stub = StubBinance(weight_limit=10 ** 6, order_limit=10 ** 6)
+    binance_client.base_url = stub.start()
+    trade_history.cache_dir = kline_store.cache_dir = None
+    seed(stub, args.trades, args.orders)
+    system = {"role": "system", "content": tool_manager.get_system_prompt()}
+    histories = {"raw": InMemorySessionManager(), "compact": InMemorySessionManager()}
+    totals = {"raw": 0, "compact": 0}
+
+    print(f"{'turn':<58}{'raw':>8}{'compact':>9}{'saved':>8}")
+    try:
+        for session in range(args.sessions):
+            session_id = f"replay-{session}"
+            for prompt, calls in REPLAY:
+                results = tool_manager.use_tools(calls)
+                tokens = {}
+                for variant, history in histories.items():
+                    steps = [{
+                        "role": "function",
+                        "name": tool_name,
+                        "content": f"Tool call result: {render(variant, tool_name, arguments, result)}"
+                    } for (tool_name, arguments), result in zip(calls, results)]
+                    # The follow-up call sees the history, the question and the tool results
+                    user = {"role": "user", "content": prompt}
+                    messages = [system] + history.get_history(session_id) + [user] + steps
+                    tokens[variant] = sum(count_message_tokens(message) for message in messages)
+                    totals[variant] += tokens[variant]
+                    history.add_to_history(session_id, user)
+                    for step in steps:
+                        history.add_to_history(session_id, step)
+                    history.add_to_history(session_id, {"role": "assistant", "content": REPLY})
+                if session == 0:
+                    print(f"{prompt[:56]:<58}{tokens['raw']:>8}{tokens['compact']:>9}"
+                          f"{1 - tokens['compact'] / tokens['raw']:>8.0%}")
+    finally:
+        stub.stop()
+
+    print(f"{'total follow-up prompt tokens':<58}{totals['raw']:>8}{totals['compact']:>9}"
+          f"{1 - totals['compact'] / totals['raw']:>8.0%}")
+    for variant, history in histories.items():
+        metrics = history.get_metrics()
+        print(f"{variant} history: {metrics['tokens_retained']} tokens retained, "
+              f"{metrics['compactions']} compactions")
+    stats = tool_manager.get_result_stats()
+    print(f"Results rendered: {stats['results']}, cut short: {stats['truncated']}, "
+          f"tokens {stats['raw_tokens']} -> {stats['compact_tokens']} ({stats['saved']:.0%} saved)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+# client.py
+
+import hashlib
+import heapq
+import hmac
+import itertools
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+from metrics import LatencyStats
+from tracing import tracer
+
+# Binance error code for a timestamp outside of recvWindow
+TIMESTAMP_OUT_OF_WINDOW = -1021
+
+# Documented request weights; refined at runtime from the X-MBX-USED-WEIGHT headers
+ENDPOINT_WEIGHTS = {
+    "GET /api/v3/time": 1,
+    "GET /api/v3/exchangeInfo": 20,
+    "GET /api/v3/ticker/price": 2,
+    "GET /api/v3/ticker/price (all symbols)": 4,
+    "GET /api/v3/klines": 2,
+    "GET /api/v3/account": 20,
+    "GET /api/v3/myTrades": 20,
+    "GET /api/v3/openOrders": 6,
+    "GET /api/v3/openOrders (all symbols)": 80,
+    "POST /api/v3/order": 1,
+    "DELETE /api/v3/order": 1,
+}
+DEFAULT_WEIGHT = 1
+
+# Endpoints that cost more when called without a symbol
+SYMBOL_OPTIONAL = {"/api/v3/ticker/price", "/api/v3/openOrders"}
+
+# Endpoints that count against the ORDERS limits
+ORDER_ENDPOINTS = {"POST /api/v3/order"}
+
+# Scheduling priorities, lower runs first
+PRIORITY_ORDER = 0
+PRIORITY_QUERY = 1
+
+INTERVAL_LETTERS = {"SECOND": "S", "MINUTE": "M", "HOUR": "H", "DAY": "D"}
+INTERVAL_SECONDS = {"SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+
+
+class RateLimited(Exception):
+    """Raised when a call cannot get rate-limit budget in time. Carries a retry hint for the caller."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        """
+        Token bucket refilled linearly over a period.
+        :param capacity: Maximum number of tokens
+        :param period: Seconds needed to refill an empty bucket
+        """
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """
+        Get the time until the bucket holds enough tokens.
+        :param amount: Tokens needed
+        :param now: Current monotonic time
+        :return: Seconds to wait, 0 if the tokens are available now
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= amount
+
+    def sync_used(self, used, now):
+        """
+        Align the bucket with the usage Binance reports, which also counts other clients on our IP.
+        :param used: Used budget reported by the server for the current window
+        :param now: Current monotonic time
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, self.capacity - used)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RequestScheduler:
+    def __init__(self, rate_limits=Config.BINANCE_RATE_LIMITS, max_wait=Config.BINANCE_MAX_QUEUE_WAIT):
+        """
+        Admit outbound Binance calls against the request-weight and order-rate limits.
+        Calls wait in a priority queue so orders and cancels go ahead of read-only queries.
+        :param rate_limits: Limits in the exchangeInfo rateLimits format
+        :param max_wait: Seconds a call may queue before RateLimited is raised
+        """
+        self.max_wait = max_wait
+        self.weight_buckets = {}  # Response header -> TokenBucket
+        self.order_buckets = {}
+        for limit in rate_limits:
+            suffix = f"{limit['intervalNum']}{INTERVAL_LETTERS[limit['interval']]}"
+            bucket = TokenBucket(limit["limit"], limit["intervalNum"] * INTERVAL_SECONDS[limit["interval"]])
+            if limit["rateLimitType"] == "REQUEST_WEIGHT":
+                self.weight_buckets[f"X-MBX-USED-WEIGHT-{suffix}"] = bucket
+            elif limit["rateLimitType"] == "ORDERS":
+                self.order_buckets[f"X-MBX-ORDER-COUNT-{suffix}"] = bucket
+
+        self.weights = dict(ENDPOINT_WEIGHTS)
+        self.blocked_until = 0.0
+        self.queue = []
+        self.sequence = itertools.count()
+        self.dispatched = 0
+        self.in_flight = 0
+        self.last_used_weight = None
+        self.cond = threading.Condition()
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "throttled_by_server": 0}
+
+    def acquire(self, endpoint, priority=PRIORITY_QUERY):
+        """
+        Wait for budget to send one request.
+        :param endpoint: Endpoint key as built by endpoint_key
+        :param priority: PRIORITY_ORDER or PRIORITY_QUERY
+        :return: Ticket to pass to observe once the response arrives
+        """
+        weight = self.weights.get(endpoint, DEFAULT_WEIGHT)
+        is_order = endpoint in ORDER_ENDPOINTS
+        with self.cond:
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.queue, entry)
+            deadline = time.monotonic() + self.max_wait
+            waited = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(weight, is_order, now) if self.queue[0] == entry else None
+                    if delay == 0:
+                        break
+                    # Back off right away when the budget cannot free up before the deadline
+                    if delay is not None and now + delay > deadline:
+                        self.stats["rejected"] += 1
+                        raise RateLimited(f"Binance rate limit reached for {endpoint}", delay)
+                    if now >= deadline:
+                        self.stats["rejected"] += 1
+                        raise RateLimited(f"Binance request queue is full for {endpoint}", self.max_wait)
+                    if not waited:
+                        waited = True
+                        self.stats["queued"] += 1
+                    self.cond.wait(timeout=deadline - now if delay is None else delay)
+
+                for bucket in self.weight_buckets.values():
+                    bucket.take(weight, now)
+                if is_order:
+                    for bucket in self.order_buckets.values():
+                        bucket.take(1, now)
+                self.stats["admitted"] += 1
+                self.dispatched += 1
+                self.in_flight += 1
+                return {"endpoint": endpoint, "dispatched": self.dispatched, "alone": self.in_flight == 1,
+                        "used_before": self.last_used_weight}
+            finally:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.cond.notify_all()
+
+    def observe(self, ticket, status_code=None, headers=None):
+        """
+        Update the limiter from a Binance response.
+        :param ticket: Ticket returned by acquire
+        :param status_code: HTTP status code, None if the request failed without a response
+        :param headers: Response headers
+        """
+        now = time.monotonic()
+        headers = headers or {}
+        with self.cond:
+            self.in_flight -= 1
+            for name, bucket in self.weight_buckets.items():
+                if name in headers:
+                    bucket.sync_used(int(headers[name]), now)
+            for name, bucket in self.order_buckets.items():
+                if name in headers:
+                    bucket.sync_used(int(headers[name]), now)
+
+            used = headers.get("X-MBX-USED-WEIGHT-1M") or headers.get("X-MBX-USED-WEIGHT")
+            if used is not None:
+                used = int(used)
+                # Learn the real cost when no other request overlapped with this one
+                if (ticket["alone"] and ticket["dispatched"] == self.dispatched
+                        and ticket["used_before"] is not None and used > ticket["used_before"]):
+                    self.weights[ticket["endpoint"]] = used - ticket["used_before"]
+                # Overlapping responses can arrive out of order, keep the highest count among them
+                if ticket["alone"] or self.last_used_weight is None or used > self.last_used_weight:
+                    self.last_used_weight = used
+
+            if status_code in (418, 429):
+                # 429 is a warning and 418 an IP ban, both carry Retry-After
+                self.stats["throttled_by_server"] += 1
+                retry_after = float(headers.get("Retry-After", 60))
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.cond.notify_all()
+
+    def get_stats(self):
+        """
+        Get scheduler counters and the remaining budget.
+        :return: Dictionary of counters, remaining tokens per limit and learned weights
+        """
+        now = time.monotonic()
+        with self.cond:
+            stats = dict(self.stats)
+            stats["waiting"] = len(self.queue)
+            stats["blocked_for"] = max(0.0, self.blocked_until - now)
+            for name, bucket in list(self.weight_buckets.items()) + list(self.order_buckets.items()):
+                bucket.wait_time(0, now)
+                stats[name] = bucket.tokens
+            stats["weights"] = dict(self.weights)
+        return stats
+
+    def _delay(self, weight, is_order, now):
+        delay = max(0.0, self.blocked_until - now)
+        for bucket in self.weight_buckets.values():
+            delay = max(delay, bucket.wait_time(weight, now))
+        if is_order:
+            for bucket in self.order_buckets.values():
+                delay = max(delay, bucket.wait_time(1, now))
+        return delay
+
+
+def endpoint_key(method, path, params=None):
+    """
+    Build the key used for weights and latency stats.
+    :param method: HTTP method
+    :param path: Endpoint path
+    :param params: Query parameters
+    :return: Key such as "GET /api/v3/openOrders (all symbols)"
+    """
+    key = f"{method} {path}"
+    if path in SYMBOL_OPTIONAL and not (params or {}).get("symbol"):
+        key += " (all symbols)"
+    return key
+
+
+class BinanceClient:
+    def __init__(self, api_key=Config.BINANCE_API_KEY, secret_key=Config.BINANCE_SECRET_KEY,
+                 base_url=Config.BINANCE_BASE_URL, pool_size=Config.BINANCE_POOL_SIZE,
+                 timeout=Config.BINANCE_TIMEOUT, recv_window=Config.BINANCE_RECV_WINDOW, scheduler=None):
+        """
+        Binance REST client shared by all tools.
+        Keeps a keep-alive connection pool, signs with a pre-keyed HMAC and corrects for clock drift.
+        :param api_key: Binance API key
+        :param secret_key: Binance secret key
+        :param base_url: REST base URL
+        :param pool_size: Maximum number of pooled connections
+        :param timeout: Request timeout in seconds
+        :param recv_window: Milliseconds a signed request stays valid
+        :param scheduler: RequestScheduler admitting the calls, a new one by default
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.recv_window = recv_window
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["X-MBX-APIKEY"] = api_key
+
+        self._hmac = hmac.new(secret_key.encode(), digestmod=hashlib.sha256)
+        self._hmac_lock = threading.Lock()
+
+        self.time_offset = None  # Server time minus local time, in milliseconds
+        self.scheduler = scheduler or RequestScheduler()
+        self.latency = LatencyStats()
+
+    def sync_time(self):
+        """Measure the offset between the local clock and Binance server time."""
+        start = time.time()
+        response = self.request("GET", "/api/v3/time")
+        end = time.time()
+        if response.status_code != 200:
+            raise ValueError(f"Failed to sync time: {response.text}")
+        self.time_offset = response.json()["serverTime"] - int((start + end) / 2 * 1000)
+
+    def timestamp(self):
+        """
+        Get the current time on the Binance clock, syncing it on first use.
+        :return: Timestamp in milliseconds
+        """
+        if self.time_offset is None:
+            try:
+                self.sync_time()
+            except Exception as e:
+                print(f"Binance time sync failed, using the local clock: {e}")
+                self.time_offset = 0
+        return int(time.time() * 1000) + self.time_offset
+
+    def sign(self, query_string):
+        """
+        Sign a query string with the pre-keyed HMAC.
+        :param query_string: URL-encoded query string
+        :return: Hex signature
+        """
+        with self._hmac_lock:
+            mac = self._hmac.copy()
+        mac.update(query_string.encode())
+        return mac.hexdigest()
+
+    def request(self, method, path, params=None, signed=False):
+        """
+        Send a request to Binance once the scheduler admits it.
+        Orders and cancels are admitted ahead of read-only queries.
+        :param method: HTTP method
+        :param path: Endpoint path, e.g., /api/v3/account
+        :param params: Query parameters
+        :param signed: Whether the endpoint requires a timestamp and signature
+        :return: requests.Response
+        :raises RateLimited: When no budget frees up within the scheduler's max wait
+        """
+        response = self._send(method, path, params, signed)
+        if signed and response.status_code == 400 and _error_code(response) == TIMESTAMP_OUT_OF_WINDOW:
+            # The local clock drifted, resync once and retry
+            self.time_offset = None
+            response = self._send(method, path, params, signed)
+        return response
+
+    def get_stats(self):
+        """
+        Get per-endpoint latency statistics and the scheduler state.
+        :return: Dictionary with "latency" and "scheduler" entries
+        """
+        return {"latency": self.latency.snapshot(), "scheduler": self.scheduler.get_stats()}
+
+    def _send(self, method, path, params, signed):
+        params = dict(params or {})
+        key = endpoint_key(method, path, params)
+        if signed and self.time_offset is None:
+            self.timestamp()  # The first sync is a request of its own, send it before queueing this one
+
+        with tracer.upstream("binance", endpoint=key) as span:
+            queued = time.perf_counter()
+            ticket = self.scheduler.acquire(key, PRIORITY_QUERY if method == "GET" else PRIORITY_ORDER)
+            start = time.perf_counter()
+            try:
+                # Stamp and sign once admitted, so the time spent queueing does not count against recvWindow
+                response = self.session.request(method, self._url(path, params, signed), timeout=self.timeout)
+            except Exception:
+                self.scheduler.observe(ticket)
+                raise
+            finally:
+                self.latency.record(key, time.perf_counter() - start)
+            self.scheduler.observe(ticket, response.status_code, response.headers)
+            span.set(status=response.status_code, queue_ms=round((start - queued) * 1000, 3))
+        return response
+
+    def _url(self, path, params, signed):
+        if signed:
+            params = dict(params, recvWindow=self.recv_window, timestamp=self.timestamp())
+        query_string = urlencode(params)
+        if signed:
+            query_string += f"&signature={self.sign(query_string)}"
+
+        url = self.base_url + path
+        if query_string:
+            url += "?" + query_string
+        return url
+
+
+def _error_code(response):
+    try:
+        return response.json().get("code")
+    except ValueError:
+        return None
+
+
+# Initialize BinanceClient
+binance_client = BinanceClient()
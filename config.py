@@ -4,6 +4,34 @@ class Config:
     # Binance API Configs
     BINANCE_API_KEY = ""
     BINANCE_SECRET_KEY = ""
+    BINANCE_BASE_URL = "https://api.binance.com"
+    BINANCE_POOL_SIZE = 10  # Keep-alive connections shared by all tools
+    BINANCE_TIMEOUT = 10  # Seconds
+    BINANCE_RECV_WINDOW = 5000  # Milliseconds a signed request stays valid
+
+    # Binance rate limits, in the same format as the rateLimits of /api/v3/exchangeInfo
+    BINANCE_RATE_LIMITS = [
+        {"rateLimitType": "REQUEST_WEIGHT", "interval": "MINUTE", "intervalNum": 1, "limit": 6000},
+        {"rateLimitType": "ORDERS", "interval": "SECOND", "intervalNum": 10, "limit": 50},
+        {"rateLimitType": "ORDERS", "interval": "DAY", "intervalNum": 1, "limit": 160000},
+    ]
+    BINANCE_MAX_QUEUE_WAIT = 5.0  # Seconds a call may wait for rate-limit budget before backing off
+
+    # Market data cache
+    PRICE_CACHE_TTL = 2.0  # Seconds a cached quote is served before it is refetched
+    PRICE_CACHE_BULK_REFRESH = False  # Refresh every symbol at once through the all-tickers endpoint
+
+    # Account state: balances and open orders kept in memory
+    ACCOUNT_STATE_TTL = 30  # Seconds a snapshot is served before it is refetched
+    ACCOUNT_ORDERS_TTL = 5  # Shorter for open orders, which fills and other clients change without a stream feed
+
+    # Trade history: full myTrades history per symbol, cached on disk
+    TRADE_HISTORY_DIR = "trade_history"  # Directory of the per-symbol cache files, None to keep them in memory
+    TRADE_HISTORY_TTL = 30  # Seconds before a symbol is checked for new trades again
+
+    # Klines: closed candles per symbol and interval, in append-only files
+    KLINE_DIR = "klines"  # Directory of the per-symbol/interval cache files, None to keep them in memory
+    KLINE_WARMUP = 10  # Candles fetched per EMA/RSI period, so the result no longer depends on the seed
 
     # OpenAI Configs
     OPENAI_API_KEY = "sk-"
@@ -13,6 +41,63 @@ class Config:
     AZURE_API_KEY = ""
     AZURE_API_VERSION = ""
     AZURE_ENDPOINT = ""
+    # Second Azure deployment, e.g. in another region, registered as the "azure_secondary" backend
+    AZURE_SECONDARY_API_KEY = ""
+    AZURE_SECONDARY_ENDPOINT = ""
+
+    # LLM clients: one long-lived client and connection pool per backend
+    LLM_POOL_SIZE = 32  # Keep-alive connections per backend
+    LLM_TIMEOUT = 60  # Seconds a request may take
+    LLM_CONNECT_TIMEOUT = 5  # Seconds to open a connection
+    LLM_MAX_RETRIES = 2  # Retries of connection errors, timeouts, 429 and 5xx responses
+    LLM_RETRY_BACKOFF = 0.5  # Base retry delay in seconds, doubled per attempt, with full jitter
+    LLM_RETRY_BACKOFF_MAX = 8.0  # Cap of the retry delay
+    # Hedging: backend -> (second backend, seconds), sends a request that has not answered in time to both
+    LLM_HEDGE = {}  # e.g. {"azure": ("azure_secondary", 2.0)}
+    # Structured output of tool-calling replies: "json" for JSON mode with the tool catalog in the prompt,
+    # "tools" for native tool calling, None for the prompt alone
+    LLM_STRUCTURED_OUTPUT = "json"
+
+    # Tool calls: a reply may request several, they run concurrently
+    TOOL_MAX_WORKERS = 8  # Tool calls running at the same time
+    TOOL_TIMEOUT = 10  # Seconds a tool call may take before its result is reported as missing
+    TOOL_RESULT_MAX_TOKENS = 300  # Tokens a tool result may take in the prompt and history, the rest is summarized
+
+    # Intent router: answer simple price, balance and open-order questions without calling the LLM
+    ROUTER_ENABLED = True
+    # Speculative prefetch: start the read-only tool calls a prompt likely needs while the LLM decides
+    PREFETCH_ENABLED = True
+    PREFETCH_MAX_CALLS = 4  # Speculative calls per turn
+    # Response cache: reuse replies to market questions across sessions while their tool data is fresh
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_MAX_ENTRIES = 1024  # Questions kept before the least recently used one is evicted
+    RESPONSE_CACHE_MAX_TTL = 300  # Seconds a question's tool calls are reused, and cap of any reply's freshness
+
+    # Session storage: "memory" for a single process, "sqlite" to share sessions across worker processes
+    SESSION_BACKEND = "memory"
+    SESSION_DB_PATH = "sessions.db"
+    SESSION_LOCK_TIMEOUT = 30  # Seconds a request waits while another request holds the same session
+    SESSION_LOCK_LEASE = 120  # Seconds after which a lock left by a crashed worker expires
+    SESSION_SWEEP_INTERVAL = 60  # Seconds between eviction sweeps of the sqlite backend
+
+    # Session history limits
+    SESSION_MAX_SESSIONS = 10000  # Least recently used sessions beyond this are evicted
+    SESSION_IDLE_TIMEOUT = 3600  # Seconds of inactivity before a session is evicted
+    SESSION_TOKEN_BUDGET = 4000  # Tokens of history kept per session before compaction
+    SESSION_KEEP_RECENT = 6  # Most recent messages that are never compacted
+    TOKENIZER_ENCODING = "cl100k_base"  # tiktoken encoding used to measure history
+
+    # Tracing: per-stage spans of each chat turn, aggregated on /metrics; False leaves a no-op tracer
+    TRACING_ENABLED = True
+
+    # Async serving mode (async_service.py): maximum concurrent calls per upstream
+    UPSTREAM_CONCURRENCY = {"azure": 64, "openai": 64, "binance": 16}
 
     # Local model path / Should be safetensors
-    LOCAL_MODEL_PATH = None  # "/path/to/your/model"
\ No newline at end of file
+    LOCAL_MODEL_PATH = None  # "/path/to/your/model"
+    LOCAL_MODEL_WARMUP = False  # Load the local model in the background at startup instead of on the first call
+    LOCAL_KV_CACHE_ENTRIES = 8  # Sessions whose KV cache is kept for prefix reuse
+    LOCAL_KV_CACHE_TOKENS = 32768  # Total cached tokens across sessions
+    LOCAL_KV_CACHE_MIN_PREFIX = 16  # Shortest shared prompt prefix worth reusing
+    LOCAL_BATCHING = False  # Batch concurrent local-model calls together with continuous batching
+    LOCAL_BATCH_SIZE = 8  # Maximum number of sequences decoded together
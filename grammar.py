@@ -0,0 +1,268 @@
+# grammar.py
+#
+# Grammar of replies in the tool-calling JSON format, built from the tools' JSON schemas, for
+# constrained decoding of the local model: only tokens that keep the output a valid reply are allowed,
+# so a tool call always parses and its arguments always follow the tool's schema.
+
+import json
+import threading
+
+# Bounds that keep the model from generating whitespace or digits forever
+MAX_WHITESPACE = 12
+MAX_DIGITS = 15
+
+_CONTROL = "".join(chr(code) for code in range(0x20))
+DEAD = -1  # DFA state after a character no reply can continue with
+
+
+# Grammar expressions, compiled into an NFA. Each is a tuple whose first item is the kind.
+
+def lit(text):
+    return ("seq", [("chars", frozenset(char), False) for char in text])
+
+
+def chars(characters, negated=False):
+    return ("chars", frozenset(characters), negated)
+
+
+def seq(*expressions):
+    return ("seq", list(expressions))
+
+
+def alt(*expressions):
+    return ("alt", list(expressions))
+
+
+def star(expression):
+    return ("star", expression)
+
+
+def opt(expression):
+    return ("alt", [expression, ("seq", [])])
+
+
+def rep(expression, low, high):
+    """Between low and high repetitions."""
+    tail = ("seq", [])
+    for _ in range(high - low):
+        tail = opt(seq(expression, tail))
+    return seq(*([expression] * low), tail)
+
+
+def members(properties):
+    """
+    A JSON object with the given members, in order.
+    :param properties: List of (key, value expression, required); optional members may be left out
+    """
+    return ("object", properties)
+
+
+WS = rep(chars(" \t\n"), 0, MAX_WHITESPACE)
+DIGIT = chars("0123456789")
+STRING = seq(lit('"'), star(alt(
+    chars('"\\' + _CONTROL, negated=True),
+    seq(lit("\\"), chars('"\\/bfnrt')),
+    seq(lit("\\u"), rep(chars("0123456789abcdefABCDEF"), 4, 4)),
+)), lit('"'))
+INTEGER = seq(opt(lit("-")), alt(lit("0"), seq(chars("123456789"), rep(DIGIT, 0, MAX_DIGITS - 1))))
+NUMBER = seq(INTEGER, opt(seq(lit("."), rep(DIGIT, 1, MAX_DIGITS))))
+BOOLEAN = alt(lit("true"), lit("false"))
+SCALAR = alt(STRING, NUMBER, BOOLEAN, lit("null"))
+
+
+def value(schema):
+    """Expression of a value following a JSON schema; arrays and free-form objects fall back to any scalar."""
+    if "enum" in schema:
+        return alt(*(lit(json.dumps(option)) for option in schema["enum"]))
+    kind = schema.get("type")
+    if kind == "string":
+        return STRING
+    if kind == "integer":
+        return INTEGER
+    if kind == "number":
+        return NUMBER
+    if kind == "boolean":
+        return BOOLEAN
+    if kind == "object" and "properties" in schema:
+        required = set(schema.get("required", []))
+        return members([(key, value(property_schema), key in required)
+                        for key, property_schema in schema["properties"].items()])
+    return SCALAR
+
+
+def reply(tools):
+    """
+    Expression of a reply: {"content": ...}, or {"function_call": call or list of calls, "content": ...}
+    where each call is {"name": ..., "arguments": {...}} with the arguments of the named tool.
+    :param tools: Tool descriptions (name, description, parameters)
+    """
+    call = alt(*(members([("name", lit(json.dumps(tool["name"])), True),
+                          ("arguments", value(tool["parameters"]), True)]) for tool in tools))
+    calls = alt(call, seq(lit("["), WS, call, star(seq(WS, lit(","), WS, call)), WS, lit("]")))
+    return seq(WS, alt(members([("content", STRING, True)]),
+                       members([("function_call", calls, True), ("content", STRING, False)])), WS)
+
+
+class ReplyGrammar:
+    def __init__(self, tools, vocabulary=None):
+        """
+        Automaton accepting exactly the replies in the tool-calling JSON format for the given tools.
+        It is compiled into an NFA and determinized lazily, one transition at a time as decoding needs it.
+        :param tools: Tool descriptions (name, description, parameters), e.g. ToolManager.get_tool_descriptions()
+        :param vocabulary: Vocabulary of the model's tokenizer, needed for allowed_tokens
+        """
+        self.vocabulary = vocabulary
+        self.edges = []  # NFA state -> list of (label, target state), label None for an epsilon move
+        start, self.final = self._compile(reply(tools))
+        self.sets = []  # DFA state -> frozenset of NFA states
+        self.ids = {}  # frozenset of NFA states -> DFA state
+        self.transitions = {}  # (DFA state, character) -> DFA state
+        self.allowed = {}  # DFA state -> list of token ids
+        self.lock = threading.Lock()
+        self.start = self._state(self._closure({start}))
+
+    def step(self, state, char):
+        """
+        Advance by one character.
+        :return: Next state, or DEAD if no reply continues with this character
+        """
+        key = (state, char)
+        next_state = self.transitions.get(key)
+        if next_state is None:
+            targets = {target for source in self.sets[state] for label, target in self.edges[source]
+                       if label is not None and (char in label[0]) != label[1]}
+            next_state = self.transitions[key] = self._state(self._closure(targets)) if targets else DEAD
+        return next_state
+
+    def walk(self, state, text):
+        """Advance by each character of text, stopping at DEAD."""
+        for char in text:
+            state = self.step(state, char)
+            if state == DEAD:
+                break
+        return state
+
+    def accepts(self, state):
+        """Whether the text read so far is a complete reply."""
+        return state != DEAD and self.final in self.sets[state]
+
+    def allowed_tokens(self, state):
+        """
+        Tokens whose text can follow the text read so far, found by walking the vocabulary's trie.
+        Computed once per state; most of a reply is spent in a handful of states, e.g. inside a string.
+        :return: List of token ids
+        """
+        allowed = self.allowed.get(state)
+        if allowed is None:
+            allowed = []
+            pending = [(self.vocabulary.trie, state)]
+            while pending:
+                node, node_state = pending.pop()
+                for char, child in node.items():
+                    if char is None:
+                        continue
+                    child_state = self.step(node_state, char)
+                    if child_state != DEAD:
+                        allowed.extend(child.get(None, ()))
+                        pending.append((child, child_state))
+            self.allowed[state] = allowed
+        return allowed
+
+    def _state(self, nfa_states):
+        nfa_states = frozenset(nfa_states)
+        with self.lock:
+            state = self.ids.get(nfa_states)
+            if state is None:
+                state = self.ids[nfa_states] = len(self.sets)
+                self.sets.append(nfa_states)
+        return state
+
+    def _closure(self, states):
+        closure, pending = set(states), list(states)
+        while pending:
+            for label, target in self.edges[pending.pop()]:
+                if label is None and target not in closure:
+                    closure.add(target)
+                    pending.append(target)
+        return closure
+
+    def _new(self):
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def _compile(self, expression):
+        """Add the expression to the NFA, as a fragment from a start to an end state."""
+        kind = expression[0]
+        start = self._new()
+        if kind == "chars":
+            end = self._new()
+            self.edges[start].append(((expression[1], expression[2]), end))
+        elif kind == "seq":
+            end = start
+            for part in expression[1]:
+                part_start, part_end = self._compile(part)
+                self.edges[end].append((None, part_start))
+                end = part_end
+        elif kind == "alt":
+            end = self._new()
+            for part in expression[1]:
+                part_start, part_end = self._compile(part)
+                self.edges[start].append((None, part_start))
+                self.edges[part_end].append((None, end))
+        elif kind == "star":
+            part_start, part_end = self._compile(expression[1])
+            self.edges[start].append((None, part_start))
+            self.edges[part_end].append((None, start))
+            end = start
+        else:
+            end = self._compile_members(start, expression[1])
+        return start, end
+
+    def _compile_members(self, start, properties):
+        # One state per (member index, whether a member was written yet): optional members are skipped
+        # by moving to the next index, and only the first member written goes without a comma
+        opened_start, opened_end = self._compile(seq(lit("{"), WS))
+        self.edges[start].append((None, opened_start))
+        states = {(index, first): self._new() for index in range(len(properties) + 1) for first in (True, False)}
+        self.edges[opened_end].append((None, states[0, True]))
+        for index, (key, value_expression, required) in enumerate(properties):
+            member_start, member_end = self._compile(seq(lit(json.dumps(key)), WS, lit(":"), WS, value_expression, WS))
+            comma_start, comma_end = self._compile(seq(lit(","), WS))
+            self.edges[states[index, True]].append((None, member_start))
+            self.edges[states[index, False]].append((None, comma_start))
+            self.edges[comma_end].append((None, member_start))
+            self.edges[member_end].append((None, states[index + 1, False]))
+            if not required:
+                for first in (True, False):
+                    self.edges[states[index, first]].append((None, states[index + 1, first]))
+        closing_start, end = self._compile(lit("}"))
+        for first in (True, False):
+            self.edges[states[len(properties), first]].append((None, closing_start))
+        return end
+
+
+class Vocabulary:
+    def __init__(self, tokenizer):
+        """
+        Text of every token of a tokenizer, in a trie for ReplyGrammar.allowed_tokens.
+        A token's text is what it adds after another token, so tokenizers that mark word starts
+        (e.g. a leading space) are read the way they decode mid-sequence.
+        Special tokens and tokens that decode to part of a character are left out.
+        :param tokenizer: Hugging Face tokenizer
+        """
+        anchor = tokenizer.encode("a", add_special_tokens=False)[0]
+        prefix = len(tokenizer.decode([anchor], clean_up_tokenization_spaces=False))
+        special = set(tokenizer.all_special_ids)
+        ids = [token_id for token_id in range(len(tokenizer)) if token_id not in special]
+        decoded = tokenizer.batch_decode([[anchor, token_id] for token_id in ids], clean_up_tokenization_spaces=False)
+        self.texts = {}  # token id -> text
+        self.trie = {}  # character -> child node, None -> token ids ending here
+        for token_id, text in zip(ids, decoded):
+            text = text[prefix:]
+            if not text or "\ufffd" in text:
+                continue
+            self.texts[token_id] = text
+            node = self.trie
+            for char in text:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(token_id)
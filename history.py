@@ -0,0 +1,212 @@
+# history.py
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from config import Config
+from client import binance_client
+
+# Trades per myTrades request, the maximum Binance allows
+PAGE_SIZE = 1000
+MS_PER_DAY = 86_400_000
+
+# Column name -> dtype of the columnar trade store
+COLUMNS = {
+    "id": np.int64,
+    "order_id": np.int64,
+    "time": np.int64,  # Milliseconds since the epoch
+    "price": np.float64,
+    "qty": np.float64,
+    "quote_qty": np.float64,
+    "commission": np.float64,
+    "commission_asset": "U12",
+    "is_buyer": np.bool_,
+    "is_maker": np.bool_,
+}
+
+
+class TradeHistory:
+    def __init__(self, client=binance_client, cache_dir=Config.TRADE_HISTORY_DIR, ttl=Config.TRADE_HISTORY_TTL):
+        """
+        Keep the full trade history of each symbol as NumPy columns, cached on disk.
+        Only trades newer than the last cached one are fetched, page by page through fromId.
+        :param client: BinanceClient used to fetch trades
+        :param cache_dir: Directory of the per-symbol .npz files, None to keep trades in memory only
+        :param ttl: Seconds before a symbol is checked for new trades again
+        """
+        self.client = client
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.trades = {}  # symbol -> dictionary of column -> array, ordered by trade id
+        self.synced_at = {}  # symbol -> monotonic time of the last sync
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.stats = {"syncs": 0, "pages": 0, "trades_fetched": 0, "cache_loads": 0}
+
+    def get_trades(self, symbol):
+        """
+        Get all trades of a symbol, fetching the ones not seen yet.
+        :param symbol: Trading pair, e.g., BTCUSDT
+        :return: Dictionary of column name -> array
+        """
+        with self.lock:
+            lock = self.locks.setdefault(symbol, threading.Lock())
+        with lock:
+            synced_at = self.synced_at.get(symbol)
+            if synced_at is None or time.monotonic() - synced_at >= self.ttl:
+                self._sync(symbol)
+            return self.trades[symbol]
+
+    def invalidate(self, symbol=None):
+        """
+        Check for new trades on the next lookup, e.g. after an order was placed.
+        :param symbol: Symbol to check, or None for all
+        """
+        with self.lock:
+            if symbol is None:
+                self.synced_at.clear()
+            else:
+                self.synced_at.pop(symbol, None)
+
+    def summary(self, symbol, days=None):
+        """
+        Aggregate the trades of a symbol.
+        Realized PnL uses the average-price method: the quantity sold, up to the quantity bought,
+        times the difference of the average sell and buy prices.
+        :param symbol: Trading pair, e.g., BTCUSDT
+        :param days: Only count trades of the last `days` days
+        :return: Dictionary with trade count, buy/sell quantity and VWAP, volume, realized PnL, net position and fees
+        """
+        trades = self._window(self.get_trades(symbol), days)
+        buys = trades["is_buyer"]
+        sells = ~buys
+        buy_qty, sell_qty = trades["qty"][buys].sum(), trades["qty"][sells].sum()
+        buy_quote, sell_quote = trades["quote_qty"][buys].sum(), trades["quote_qty"][sells].sum()
+        buy_vwap = buy_quote / buy_qty if buy_qty else 0.0
+        sell_vwap = sell_quote / sell_qty if sell_qty else 0.0
+        volume = trades["qty"].sum()
+
+        assets, inverse = np.unique(trades["commission_asset"], return_inverse=True)
+        fees = np.bincount(inverse, weights=trades["commission"], minlength=len(assets))
+        return {
+            "trades": int(len(trades["id"])),
+            "buy_qty": float(buy_qty),
+            "sell_qty": float(sell_qty),
+            "buy_vwap": float(buy_vwap),
+            "sell_vwap": float(sell_vwap),
+            "vwap": float(trades["quote_qty"].sum() / volume) if volume else 0.0,
+            "quote_volume": float(buy_quote + sell_quote),
+            "realized_pnl": float(min(buy_qty, sell_qty) * (sell_vwap - buy_vwap)) if buy_qty and sell_qty else 0.0,
+            "net_qty": float(buy_qty - sell_qty),
+            "fees": {str(asset): float(fee) for asset, fee in zip(assets, fees)},
+        }
+
+    def daily_volume(self, symbol, days=7):
+        """
+        Traded volume of a symbol per UTC day.
+        :param symbol: Trading pair, e.g., BTCUSDT
+        :param days: Number of most recent days
+        :return: List of (YYYY-MM-DD, base volume, quote volume, trade count), oldest first, days without trades omitted
+        """
+        trades = self._window(self.get_trades(symbol), days)
+        day_numbers, inverse, counts = np.unique(trades["time"] // MS_PER_DAY, return_inverse=True, return_counts=True)
+        base = np.bincount(inverse, weights=trades["qty"], minlength=len(day_numbers))
+        quote = np.bincount(inverse, weights=trades["quote_qty"], minlength=len(day_numbers))
+        dates = np.datetime_as_string(day_numbers.astype("datetime64[D]"))
+        return [(str(date), float(b), float(q), int(count)) for date, b, q, count in zip(dates, base, quote, counts)]
+
+    def get_stats(self):
+        """
+        Get engine counters.
+        :return: Dictionary of counters and the number of trades held per symbol
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["trades"] = {symbol: int(len(trades["id"])) for symbol, trades in self.trades.items()}
+        return stats
+
+    @staticmethod
+    def _window(trades, days):
+        if days is None or not len(trades["time"]):
+            return trades
+        since = int(time.time() * 1000) - int(days * MS_PER_DAY)
+        start = int(np.searchsorted(trades["time"], since))
+        return {name: column[start:] for name, column in trades.items()}
+
+    def _sync(self, symbol):
+        trades = self.trades.get(symbol)
+        if trades is None:
+            trades = self.trades[symbol] = self._load(symbol)
+
+        pages = []
+        from_id = int(trades["id"].max()) + 1 if len(trades["id"]) else 0
+        while True:
+            response = self.client.request("GET", "/api/v3/myTrades",
+                                           {"symbol": symbol, "fromId": from_id, "limit": PAGE_SIZE}, signed=True)
+            if response.status_code != 200:
+                raise ValueError(response.text)
+            page = response.json()
+            with self.lock:
+                self.stats["pages"] += 1
+            if page:
+                pages.append(_to_columns(page))
+                from_id = page[-1]["id"] + 1
+            if len(page) < PAGE_SIZE:
+                break
+
+        if pages:
+            trades = {name: np.concatenate([trades[name]] + [page[name] for page in pages]) for name in COLUMNS}
+            # Trades are fetched by id, which follows time except for equal timestamps
+            order = np.argsort(trades["time"], kind="stable")
+            trades = {name: column[order] for name, column in trades.items()}
+            self.trades[symbol] = trades
+            self._save(symbol, trades)
+        with self.lock:
+            self.stats["syncs"] += 1
+            self.stats["trades_fetched"] += sum(len(page["id"]) for page in pages)
+            self.synced_at[symbol] = time.monotonic()
+
+    def _path(self, symbol):
+        return os.path.join(self.cache_dir, f"{symbol}.npz")
+
+    def _load(self, symbol):
+        if self.cache_dir and os.path.exists(self._path(symbol)):
+            with np.load(self._path(symbol)) as cached:
+                trades = {name: cached[name] for name in COLUMNS}
+            with self.lock:
+                self.stats["cache_loads"] += 1
+            return trades
+        return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+    def _save(self, symbol, trades):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary = self._path(symbol) + ".tmp.npz"
+        np.savez(temporary, **trades)
+        os.replace(temporary, self._path(symbol))
+
+
+def _to_columns(page):
+    """Convert a page of myTrades results into columns."""
+    return {
+        "id": np.fromiter((trade["id"] for trade in page), np.int64, len(page)),
+        "order_id": np.fromiter((trade["orderId"] for trade in page), np.int64, len(page)),
+        "time": np.fromiter((trade["time"] for trade in page), np.int64, len(page)),
+        "price": np.array([trade["price"] for trade in page], dtype=np.float64),
+        "qty": np.array([trade["qty"] for trade in page], dtype=np.float64),
+        "quote_qty": np.array([trade.get("quoteQty") or float(trade["price"]) * float(trade["qty"]) for trade in page],
+                              dtype=np.float64),
+        "commission": np.array([trade.get("commission", 0) for trade in page], dtype=np.float64),
+        "commission_asset": np.array([trade.get("commissionAsset") or "" for trade in page],
+                                     dtype=COLUMNS["commission_asset"]),
+        "is_buyer": np.fromiter((trade["isBuyer"] for trade in page), np.bool_, len(page)),
+        "is_maker": np.fromiter((trade.get("isMaker", False) for trade in page), np.bool_, len(page)),
+    }
+
+
+# Initialize TradeHistory
+trade_history = TradeHistory()
@@ -0,0 +1,374 @@
+# kline.py
+
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within a process
+    fcntl = None
+
+from config import Config
+from client import binance_client
+
+# Candles per /api/v3/klines request, the maximum Binance allows
+PAGE_SIZE = 1000
+
+# Supported intervals and their length in milliseconds; 1M is left out because months vary in length
+INTERVAL_MS = {
+    "1m": 60_000, "3m": 180_000, "5m": 300_000, "15m": 900_000, "30m": 1_800_000,
+    "1h": 3_600_000, "2h": 7_200_000, "4h": 14_400_000, "6h": 21_600_000, "8h": 28_800_000, "12h": 43_200_000,
+    "1d": 86_400_000, "3d": 259_200_000, "1w": 604_800_000,
+}
+
+# Record layout of the cache files, one fixed-size record per closed candle
+CANDLE = np.dtype([
+    ("open_time", "<i8"),  # Milliseconds since the epoch
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("volume", "<f8"),
+    ("quote_volume", "<f8"),
+    ("trades", "<i8"),
+])
+
+INDICATORS = ("sma", "ema", "rsi", "volatility")
+
+
+class KlineStore:
+    def __init__(self, client=binance_client, cache_dir=Config.KLINE_DIR, warmup=Config.KLINE_WARMUP):
+        """
+        Keep closed candles per symbol and interval in append-only files, read through np.memmap.
+        Only candles that closed after the last stored one are fetched; older ones are fetched once when
+        a query reaches further back than the file does.
+        :param client: BinanceClient used to fetch candles
+        :param cache_dir: Directory of the <symbol>_<interval>.bin files, None to keep candles in memory only
+        :param warmup: Periods of history per indicator period, so EMA and RSI have converged from their seed
+        """
+        self.client = client
+        self.cache_dir = cache_dir
+        self.warmup = warmup
+        self.candles = {}  # (symbol, interval) -> structured array or memmap of CANDLE, oldest first
+        self.complete = set()  # Keys whose file reaches back to the first candle the exchange has
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.stats = {"syncs": 0, "pages": 0, "candles_fetched": 0, "cache_opens": 0}
+
+    def get_candles(self, symbol, interval, limit):
+        """
+        Get the most recent closed candles.
+        :param symbol: Trading pair, e.g., BTCUSDT
+        :param interval: Candle interval, e.g., 1h or 1d
+        :param limit: Number of candles
+        :return: Structured array of CANDLE, oldest first; shorter than limit if the pair has less history
+        """
+        if interval not in INTERVAL_MS:
+            raise ValueError(f"Unsupported interval {interval}, use one of {', '.join(INTERVAL_MS)}")
+        key = (symbol, interval)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            candles = self._open(key)
+            if not len(candles) or _now_ms() >= int(candles["open_time"][-1]) + 2 * INTERVAL_MS[interval]:
+                # A candle has closed since the last one stored
+                candles = self._sync(key, limit)
+            if len(candles) < limit and key not in self.complete:
+                candles = self._backfill(key, limit - len(candles))
+            return candles[-limit:]
+
+    def indicator(self, symbol, name, period=14, interval="1d"):
+        """
+        Compute an indicator over the closed candles of a pair.
+        :param symbol: Trading pair, e.g., BTCUSDT
+        :param name: sma, ema, rsi or volatility (annualized standard deviation of log returns)
+        :param period: Indicator period in candles
+        :param interval: Candle interval
+        :return: Tuple of (latest value, open time of the last candle in milliseconds)
+        """
+        if name not in INDICATORS:
+            raise ValueError(f"Unknown indicator {name}, use one of {', '.join(INDICATORS)}")
+        if period < 1:
+            raise ValueError("Period must be at least 1")
+        needed = period * self.warmup if name in ("ema", "rsi") else period + 1
+        candles = self.get_candles(symbol, interval, needed)
+        close = np.asarray(candles["close"], dtype=np.float64)
+        if len(close) < period + (name != "sma"):
+            raise ValueError(f"{symbol} has only {len(close)} {interval} candles")
+        if name == "sma":
+            values = sma(close, period)
+        elif name == "ema":
+            values = ema(close, period)
+        elif name == "rsi":
+            values = rsi(close, period)
+        else:
+            values = volatility(close, period, periods_per_year=365 * 86_400_000 / INTERVAL_MS[interval])
+        return float(values[-1]), int(candles["open_time"][-1])
+
+    def get_stats(self):
+        """
+        Get store counters.
+        :return: Dictionary of counters and the number of candles held per symbol and interval
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats["candles"] = {f"{symbol} {interval}": len(candles)
+                            for (symbol, interval), candles in dict(self.candles).items()}
+        return stats
+
+    def _open(self, key):
+        candles = self.candles.get(key)
+        if candles is not None:
+            return candles
+        candles = np.empty(0, dtype=CANDLE)
+        path = self._path(key)
+        if path and os.path.exists(path):
+            size = os.path.getsize(path)
+            if size % CANDLE.itemsize:
+                with _open_locked(path, "r+b") as file:
+                    # A partial record left by an interrupted append, unless the append has finished since
+                    size = file.seek(0, os.SEEK_END)
+                    file.truncate(size - size % CANDLE.itemsize)
+            if size >= CANDLE.itemsize:
+                candles = np.memmap(path, dtype=CANDLE, mode="r")
+            with self.lock:
+                self.stats["cache_opens"] += 1
+        self.candles[key] = candles
+        return candles
+
+    def _sync(self, key, limit):
+        symbol, interval = key
+        candles = self.candles[key]
+        step = INTERVAL_MS[interval]
+        if len(candles):
+            start = int(candles["open_time"][-1]) + step
+        else:
+            start = _now_ms() - (limit + 1) * step
+        pages = []
+        while True:
+            page = self._fetch(symbol, interval, startTime=start)
+            if len(page):
+                pages.append(page)
+                start = int(page["open_time"][-1]) + step
+            if len(page) < PAGE_SIZE:
+                break
+        new = np.concatenate(pages) if pages else np.empty(0, dtype=CANDLE)
+        # The last candle returned is usually still open and must not be stored
+        new = new[new["open_time"] + step <= _now_ms()]
+        if len(new):
+            candles = self._append(key, new)
+        with self.lock:
+            self.stats["syncs"] += 1
+            self.stats["candles_fetched"] += len(new)
+        return candles
+
+    def _backfill(self, key, count):
+        symbol, interval = key
+        candles = self.candles[key]
+        if not len(candles):
+            self.complete.add(key)
+            return candles
+        end = int(candles["open_time"][0]) - 1
+        pages = []
+        while count > 0:
+            wanted = min(count, PAGE_SIZE)
+            page = self._fetch(symbol, interval, endTime=end, limit=wanted)
+            if len(page):
+                pages.append(page)
+                end = int(page["open_time"][0]) - 1
+                count -= len(page)
+            if len(page) < wanted:
+                self.complete.add(key)  # The pair was listed after this point
+                break
+        if not pages:
+            return candles
+        older = np.concatenate(pages[::-1])
+        with self.lock:
+            self.stats["candles_fetched"] += len(older)
+        return self._rewrite(key, older)
+
+    def _fetch(self, symbol, interval, limit=PAGE_SIZE, **window):
+        response = self.client.request("GET", "/api/v3/klines",
+                                       dict({"symbol": symbol, "interval": interval, "limit": limit}, **window))
+        if response.status_code != 200:
+            raise ValueError(response.text)
+        with self.lock:
+            self.stats["pages"] += 1
+        return _to_records(response.json())
+
+    def _append(self, key, new):
+        path = self._path(key)
+        if not path:
+            candles = self.candles[key] = np.concatenate([self.candles[key], new])
+            return candles
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with _open_locked(path, "a+b") as file:
+            size = file.seek(0, os.SEEK_END)
+            if size % CANDLE.itemsize:
+                size -= size % CANDLE.itemsize
+                file.truncate(size)
+            if size:
+                # Another process sharing the directory may have stored some of these candles already
+                file.seek(size - CANDLE.itemsize)
+                last = np.frombuffer(file.read(CANDLE.itemsize), dtype=CANDLE)["open_time"][0]
+                new = new[new["open_time"] > last]
+            file.write(new.tobytes())
+        candles = self.candles[key] = np.memmap(path, dtype=CANDLE, mode="r")
+        return candles
+
+    def _rewrite(self, key, older):
+        path = self._path(key)
+        if not path:
+            candles = self.candles[key] = np.concatenate([older, self.candles[key]])
+            return candles
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with _open_locked(path, "a+b") as file:
+            # Another process sharing the directory may have appended or backfilled since the file was opened
+            size = file.seek(0, os.SEEK_END)
+            file.seek(0)
+            stored = np.frombuffer(file.read(size - size % CANDLE.itemsize), dtype=CANDLE)
+            if len(stored):
+                older = older[older["open_time"] < stored["open_time"][0]]
+            if len(older):
+                descriptor, temporary = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+                try:
+                    with os.fdopen(descriptor, "wb") as out:
+                        out.write(older.tobytes())
+                        out.write(stored.tobytes())
+                    os.replace(temporary, path)
+                except BaseException:
+                    os.unlink(temporary)
+                    raise
+        candles = self.candles[key] = np.memmap(path, dtype=CANDLE, mode="r")
+        return candles
+
+    def _path(self, key):
+        if not self.cache_dir:
+            return None
+        symbol, interval = key
+        return os.path.join(self.cache_dir, f"{symbol}_{interval}.bin")
+
+
+def sma(values, period):
+    """
+    Simple moving average.
+    :return: Array of len(values) - period + 1 averages, the first over values[:period]
+    """
+    sums = np.cumsum(values, dtype=np.float64)
+    sums[period:] = sums[period:] - sums[:-period]
+    return sums[period - 1:] / period
+
+
+def ema(values, period):
+    """
+    Exponential moving average with alpha = 2 / (period + 1), seeded with the first value.
+    :return: Array of the same length as values
+    """
+    return _smooth(np.asarray(values, dtype=np.float64), 2 / (period + 1), values[0])
+
+
+def rsi(values, period):
+    """
+    Relative strength index with Wilder's smoothing, seeded with the mean gain and loss of the first period.
+    :return: Array of len(values) - period values between 0 and 100
+    """
+    changes = np.diff(np.asarray(values, dtype=np.float64))
+    gains, losses = np.maximum(changes, 0.0), np.maximum(-changes, 0.0)
+    alpha = 1 / period
+    average_gain = _smooth(gains[period - 1:], alpha, gains[:period].mean(), seeded=True)
+    average_loss = _smooth(losses[period - 1:], alpha, losses[:period].mean(), seeded=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        strength = average_gain / average_loss
+    return np.where(average_loss == 0, 100.0, 100 - 100 / (1 + strength))
+
+
+def volatility(values, period, periods_per_year):
+    """
+    Rolling annualized volatility: sample standard deviation of the last `period` log returns.
+    :return: Array of len(values) - period values
+    """
+    returns = np.diff(np.log(np.asarray(values, dtype=np.float64)))
+    sums = np.cumsum(np.concatenate([[0.0], returns]))
+    squares = np.cumsum(np.concatenate([[0.0], returns * returns]))
+    window_sum = sums[period:] - sums[:-period]
+    window_squares = squares[period:] - squares[:-period]
+    variance = np.maximum(window_squares - window_sum * window_sum / period, 0.0) / max(period - 1, 1)
+    return np.sqrt(variance * periods_per_year)
+
+
+def _smooth(values, alpha, initial, seeded=False):
+    """
+    Exponential smoothing s[i] = (1 - alpha) * s[i - 1] + alpha * values[i], vectorized in blocks.
+    Within a block s[k] = decay^(k+1) * carry + alpha * decay^k * cumsum(values / decay^j); blocks are
+    sized so decay^-k stays below 1e150, far from overflow for any price, while the rounding error stays
+    relative to the newest term.
+    :param initial: Value before values[0]; with seeded, values[0] is replaced by it instead
+    """
+    result = np.empty_like(values)
+    if not len(values):
+        return result
+    decay = 1 - alpha
+    if seeded:
+        result[0] = initial
+        if len(values) > 1:
+            result[1:] = _smooth(values[1:], alpha, initial)
+        return result
+    if decay <= 0:
+        result[:] = values
+        return result
+    block = max(1, min(len(values), int(np.log(1e-150) / np.log(decay))))
+    powers = decay ** np.arange(block)
+    carry = float(initial)
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        scale = powers[:len(chunk)]
+        smoothed = decay * scale * carry + alpha * scale * np.cumsum(chunk / scale)
+        result[start:start + len(chunk)] = smoothed
+        carry = smoothed[-1]
+    return result
+
+
+def _lock(file):
+    """Hold an exclusive lock on a cache file until it is closed, on platforms with flock."""
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_EX)
+
+
+def _open_locked(path, mode):
+    """
+    Open a cache file and lock it, reopening if a rewrite replaced the file while waiting for the lock.
+    :return: The open, locked file
+    """
+    while True:
+        file = open(path, mode)
+        _lock(file)
+        try:
+            if fcntl is None or os.fstat(file.fileno()).st_ino == os.stat(path).st_ino:
+                return file
+        except FileNotFoundError:
+            pass
+        file.close()
+
+
+def _to_records(rows):
+    """Convert /api/v3/klines rows into CANDLE records."""
+    records = np.empty(len(rows), dtype=CANDLE)
+    if rows:
+        records["open_time"] = [row[0] for row in rows]
+        for index, name in enumerate(("open", "high", "low", "close", "volume"), start=1):
+            records[name] = np.array([row[index] for row in rows], dtype=np.float64)
+        records["quote_volume"] = np.array([row[7] for row in rows], dtype=np.float64)
+        records["trades"] = [row[8] for row in rows]
+    return records
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+# Initialize KlineStore
+kline_store = KlineStore()
@@ -0,0 +1,265 @@
+# local_model.py
+#
+# Local-model backend. Imported by ModelManager on first use, so processes that only talk to
+# OpenAI or Azure never load torch and transformers.
+
+import copy
+import json
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessor, LogitsProcessorList, TextIteratorStreamer
+
+from config import Config
+from grammar import DEAD, ReplyGrammar, Vocabulary
+from model import ReplyStream, parse_reply
+
+
+class PrefixKVCache:
+    def __init__(self, max_entries=Config.LOCAL_KV_CACHE_ENTRIES, max_tokens=Config.LOCAL_KV_CACHE_TOKENS,
+                 min_prefix=Config.LOCAL_KV_CACHE_MIN_PREFIX):
+        """
+        Keep the past_key_values of recent local-model calls, one entry per session, so a call can
+        skip the prefill of the longest token prefix it shares with an earlier call.
+        :param max_entries: Number of sessions kept before the least recently used one is evicted
+        :param max_tokens: Total cached tokens kept before the least recently used entries are evicted
+        :param min_prefix: Shortest shared prefix worth reusing
+        """
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.min_prefix = min_prefix
+        self.entries = OrderedDict()  # session_id -> (token ids, cache), least recently used first
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0, "prefill_tokens": 0, "prefill_tokens_saved": 0, "evictions": 0}
+
+    def lookup(self, session_id, input_ids):
+        """
+        Find a cache to continue from.
+        The session's own entry is handed over without a copy, entries of other sessions are copied.
+        :param session_id: Session ID
+        :param input_ids: 1-D tensor of prompt token ids
+        :return: Cache cropped to the reusable prefix, or None
+        """
+        # At least one prompt token must go through the model to produce logits
+        limit = len(input_ids) - 1
+        with self.lock:
+            best, best_length = None, 0
+            for key, (ids, _) in self.entries.items():
+                length = _common_prefix(ids, input_ids, limit)
+                if length > best_length or (length == best_length and key == session_id):
+                    best, best_length = key, length
+            self.stats["prefill_tokens"] += len(input_ids)
+            if best is None or best_length < self.min_prefix:
+                self.stats["misses"] += 1
+                return None
+            if best == session_id:
+                _, cache = self.entries.pop(best)
+            else:
+                cache = copy.deepcopy(self.entries[best][1])
+                self.entries.move_to_end(best)
+            self.stats["hits"] += 1
+            self.stats["prefill_tokens_saved"] += best_length
+        excess = cache.get_seq_length() - best_length
+        if excess > 0:
+            cache.crop(-excess)
+        return cache
+
+    def store(self, session_id, token_ids, cache):
+        """
+        Remember the cache left by a call.
+        :param session_id: Session ID
+        :param token_ids: 1-D tensor of the tokens the cache covers
+        :param cache: past_key_values returned by generate
+        """
+        length = cache.get_seq_length()
+        with self.lock:
+            self.entries[session_id] = (token_ids[:length], cache)
+            self.entries.move_to_end(session_id)
+            while len(self.entries) > self.max_entries or (
+                    len(self.entries) > 1 and sum(len(ids) for ids, _ in self.entries.values()) > self.max_tokens):
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get_stats(self):
+        """
+        Get cache counters.
+        :return: Dictionary with hits, misses, prefill tokens seen and prefill tokens saved
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["cached_tokens"] = sum(len(ids) for ids, _ in self.entries.values())
+        return stats
+
+
+def _common_prefix(a, b, limit):
+    """Length of the common prefix of two 1-D token tensors, capped at limit."""
+    length = min(len(a), len(b), limit)
+    if length <= 0:
+        return 0
+    mismatch = (a[:length] != b[:length]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else length
+
+
+class ReplyConstraint(LogitsProcessor):
+    def __init__(self, grammar, prompt_length, eos_token_ids, masks):
+        """
+        Mask the logits of every token that would take the output outside a ReplyGrammar.
+        The end of sequence is allowed once the output is a complete reply.
+        :param grammar: ReplyGrammar with the tokenizer's vocabulary
+        :param prompt_length: Number of prompt tokens in the input_ids seen by the processor
+        :param eos_token_ids: End-of-sequence token ids
+        :param masks: Dictionary of DFA state -> tensor of allowed token ids, shared by calls with the same grammar
+        """
+        self.grammar = grammar
+        self.prompt_length = prompt_length
+        self.eos_token_ids = list(eos_token_ids)
+        self.masks = masks
+        self.rows = {}  # batch row -> (generated tokens read, DFA state)
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            read, state = self.rows.get(row, (0, self.grammar.start))
+            generated = input_ids[row, self.prompt_length:].tolist()
+            for token_id in generated[read:]:
+                if state != DEAD:
+                    state = self.grammar.walk(state, self.grammar.vocabulary.texts.get(token_id, ""))
+            self.rows[row] = (len(generated), state)
+
+            allowed = self.masks.get(state)
+            if allowed is None:
+                token_ids = self.grammar.allowed_tokens(state) if state != DEAD else []
+                if state == DEAD or not token_ids or self.grammar.accepts(state):
+                    token_ids = token_ids + self.eos_token_ids
+                allowed = self.masks[state] = torch.tensor(token_ids, dtype=torch.long, device=scores.device)
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] += mask
+        return scores
+
+
+class LocalModel:
+    def __init__(self, model_path=None):
+        """
+        Load a local model (supports .safetensors format).
+        :param model_path: Model directory, defaults to Config.LOCAL_MODEL_PATH
+        """
+        self.model_path = model_path or Config.LOCAL_MODEL_PATH
+        if not self.model_path:
+            raise ValueError("Local model is not loaded.")
+
+        self.kv_cache = PrefixKVCache()
+        self.batching_engine = None
+        self.vocabulary = None  # Built on the first constrained call
+        self.grammars = {}  # tool descriptions as JSON -> (ReplyGrammar, allowed token masks)
+        self.lock = Lock()
+        try:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_path,
+                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+                device_map="auto"
+            )
+            if Config.LOCAL_BATCHING:
+                from batching import BatchingEngine
+                self.batching_engine = BatchingEngine(self.model, self.tokenizer, kv_cache=self.kv_cache)
+            print(f"Loaded local model from {self.model_path}")
+        except Exception as e:
+            raise ValueError(f"Failed to load local model: {e}")
+
+    def call(self, prompt, max_tokens=5000, stream=False, session_id=None, tools=None, on_tool_call=None):
+        """
+        Call the local model.
+        :param prompt: Input prompt text, or a list of chat messages
+        :param max_tokens: Maximum number of tokens to generate
+        :param stream: Return an iterator of text deltas instead of the full text
+        :param session_id: Session ID, used to reuse the KV cache of the session's previous call
+        :param tools: Tool descriptions; the output is then constrained to the tool-calling JSON format,
+                      with the arguments of each call following its tool's schema
+        :param on_tool_call: Function called with each tool call as soon as it is complete
+        :return: Generated text, or an iterator of text deltas when streaming; with tools, the parsed reply,
+                 or a ReplyStream when streaming
+        """
+        try:
+            inputs = self.tokenizer(self._prompt_text(prompt), return_tensors="pt").to(self.model.device)
+            constraint = self._constraint(tools, inputs.input_ids.shape[1]) if tools else None
+            if stream:
+                deltas = self._stream(inputs, max_tokens, session_id, constraint)
+                return ReplyStream(deltas, on_call=on_tool_call) if tools else deltas
+            outputs = self.generate(inputs.input_ids, max_tokens, session_id, logits_processor=constraint)
+            # Only the new tokens, not the prompt they continue
+            text = self.tokenizer.decode(outputs[0][inputs.input_ids.shape[1]:], skip_special_tokens=True)
+            return parse_reply(text) if tools else text
+        except Exception as e:
+            raise ValueError(f"Local model call failed: {e}")
+
+    def generate(self, input_ids, max_tokens, session_id, streamer=None, logits_processor=None):
+        """Generate from the longest cached prefix, then cache the result for the next call."""
+        if self.batching_engine is not None:
+            sequence = self.batching_engine.submit(input_ids[0], max_tokens, session_id, streamer, logits_processor)
+            return self.batching_engine.wait(sequence).unsqueeze(0)
+
+        cache = self.kv_cache.lookup(session_id, input_ids[0])
+        outputs = self.model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=cache,
+            max_new_tokens=max_tokens,
+            pad_token_id=self.tokenizer.eos_token_id,
+            streamer=streamer,
+            logits_processor=LogitsProcessorList([logits_processor] if logits_processor is not None else []),
+            return_dict_in_generate=True
+        )
+        if outputs.past_key_values is not None:
+            self.kv_cache.store(session_id, outputs.sequences[0], outputs.past_key_values)
+        return outputs.sequences
+
+    def _prompt_text(self, prompt):
+        """Render chat messages with the tokenizer's chat template, or as role-prefixed lines without one."""
+        if isinstance(prompt, str):
+            return prompt
+        if self.tokenizer.chat_template:
+            try:
+                return self.tokenizer.apply_chat_template(prompt, tokenize=False, add_generation_prompt=True)
+            except Exception as e:
+                # Some templates only know the system, user and assistant roles
+                print(f"Chat template failed, using plain lines: {e}")
+        lines = [f"{message['role']}: {message['content']}" for message in prompt]
+        return "\n".join(lines + ["assistant: "])
+
+    def _constraint(self, tools, prompt_length):
+        """A ReplyConstraint for the tools, reusing the grammar and masks of earlier calls with the same tools."""
+        key = json.dumps(tools, sort_keys=True)
+        with self.lock:
+            if self.vocabulary is None:
+                self.vocabulary = Vocabulary(self.tokenizer)
+            if key not in self.grammars:
+                self.grammars[key] = (ReplyGrammar(tools, self.vocabulary), {})
+            grammar, masks = self.grammars[key]
+        eos = self.model.generation_config.eos_token_id
+        if eos is None:
+            eos = self.tokenizer.eos_token_id
+        return ReplyConstraint(grammar, prompt_length, eos if isinstance(eos, (list, tuple)) else [eos], masks)
+
+    def _stream(self, inputs, max_tokens, session_id, logits_processor=None):
+        """Run generate in a background thread and yield decoded text as the streamer receives it."""
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def generate():
+            try:
+                self.generate(inputs.input_ids, max_tokens, session_id, streamer=streamer,
+                              logits_processor=logits_processor)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        thread.join()
+        if errors:
+            raise ValueError(f"Local model call failed: {errors[0]}")
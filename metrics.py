@@ -0,0 +1,110 @@
+# metrics.py
+
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Upper bounds in seconds of the latency histogram buckets, a last bucket catches the rest
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class LatencyStats:
+    def __init__(self, window=1024, buckets=LATENCY_BUCKETS):
+        """
+        Track call latencies per key.
+        :param window: Number of most recent samples kept per key for percentiles
+        :param buckets: Ascending upper bounds in seconds of the histogram buckets
+        """
+        self.window = window
+        self.buckets = tuple(buckets)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, seconds):
+        """
+        Record one latency sample.
+        :param key: Name of the thing being timed, e.g., an endpoint
+        :param seconds: Elapsed time in seconds
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {"count": 0, "total": 0.0, "max": 0.0,
+                                             "samples": deque(maxlen=self.window),
+                                             "buckets": [0] * (len(self.buckets) + 1)}
+            entry["count"] += 1
+            entry["buckets"][bisect_left(self.buckets, seconds)] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["samples"].append(seconds)
+
+    def snapshot(self):
+        """
+        Summarize the recorded latencies.
+        :return: Dictionary of key -> count, mean, p50, p99 and max, in milliseconds, the total in seconds,
+                 and a cumulative histogram mapping each bucket bound in seconds ("+Inf" for the last)
+                 to the count at or below it
+        """
+        with self.lock:
+            entries = {key: (entry["count"], entry["total"], entry["max"], sorted(entry["samples"]),
+                             list(entry["buckets"]))
+                       for key, entry in self.entries.items()}
+        summary = {}
+        for key, (count, total, maximum, samples, buckets) in entries.items():
+            cumulative, histogram = 0, {}
+            for bound, bucket in zip(self.buckets + ("+Inf",), buckets):
+                cumulative += bucket
+                histogram[str(bound)] = cumulative
+            summary[key] = {
+                "count": count,
+                "mean_ms": total / count * 1000,
+                "p50_ms": _percentile(samples, 0.50) * 1000,
+                "p99_ms": _percentile(samples, 0.99) * 1000,
+                "max_ms": maximum * 1000,
+                "total_s": total,
+                "histogram": histogram,
+            }
+        return summary
+
+
+def prometheus_histogram(name, description, label, snapshot):
+    """
+    Render a LatencyStats snapshot in the Prometheus text format, one histogram series per key.
+    :param name: Metric name, e.g., binance_agent_stage_seconds
+    :param description: HELP text
+    :param label: Name of the label holding the key
+    :param snapshot: Result of LatencyStats.snapshot
+    :return: List of lines
+    """
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for key, entry in sorted(snapshot.items()):
+        series = f'{label}="{_escape(key)}"'
+        lines.extend(f'{name}_bucket{{{series},le="{bound}"}} {count}' for bound, count in entry["histogram"].items())
+        lines.append(f"{name}_sum{{{series}}} {entry['total_s']:.6f}")
+        lines.append(f"{name}_count{{{series}}} {entry['count']}")
+    return lines
+
+
+def prometheus_counter(name, description, samples):
+    """
+    Render a counter in the Prometheus text format.
+    :param name: Metric name, ending in _total
+    :param description: HELP text
+    :param samples: List of (dictionary of label -> value, count)
+    :return: List of lines
+    """
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+    for labels, count in samples:
+        series = ",".join(f'{label}="{_escape(value)}"' for label, value in labels.items())
+        lines.append(f"{name}{{{series}}} {count}")
+    return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _percentile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
@@ -1,110 +1,564 @@
-import openai
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
+import asyncio
+import contextvars
+import importlib
 import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+from threading import Lock, Thread
 from config import Config
+from metrics import LatencyStats
+from tracing import tracer
 
 
-class ModelManager:
+class _JsonScanner:
+    """Track the nesting of JSON text fed in pieces, reporting each object or array as it closes."""
+
     def __init__(self):
+        self.stack = []  # (opening character, offset) of the open containers
+        self.offset = 0  # Offset of the next character fed
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text):
+        """
+        Scan the next piece of text.
+        :param text: Continuation of the text fed so far
+        :return: List of (opening character, start offset, end offset, openings of the enclosing containers)
+                 of the containers closed in it, e.g. ("{", 20, 64, "{[") for an object in a list in an object
+        """
+        closed = []
+        for index, char in enumerate(text, start=self.offset):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.stack.append((char, index))
+            elif char in "}]" and self.stack:
+                opening, start = self.stack.pop()
+                closed.append((opening, start, index + 1, "".join(parent for parent, _ in self.stack)))
+        self.offset += len(text)
+        return closed
+
+
+class StreamingReplyParser:
+    """
+    Incrementally parse a reply in the tool-calling JSON format while it streams in.
+    The text of a `content` field is released as soon as it is decoded, while a reply
+    that turns out to be a `function_call` is held back until it is complete. Each call
+    is still reported to `on_call` as soon as its object closes.
+    """
+
+    ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self, on_call=None):
+        """
+        :param on_call: Function called with each complete call dictionary (name, arguments) of a function_call reply
+        """
+        self.text = ""
+        self.mode = None  # None until decided, then "content", "function_call" or "plain"
+        self.position = 0  # Next unread character of the content string
+        self.closed = False  # Whether the content string has ended
+        self.content = []  # Content released so far
+        self.on_call = on_call
+        self.calls = []  # Calls whose objects have closed, in order
+        self.scanner = _JsonScanner()
+
+    def feed(self, delta):
+        """
+        Add a chunk of model output.
+        :param delta: Raw text chunk
+        :return: Text that can be shown to the user now
+        """
+        self.text += delta
+        for opening, start, end, parents in self.scanner.feed(delta):
+            # A call is the function_call object, or an object in the function_call list
+            if opening == "{" and parents in ("{", "{["):
+                self._found_call(self.text[start:end])
+        if self.mode is None:
+            self._decide()
+        if self.mode == "plain":
+            visible, self.position = self.text[self.position:], len(self.text)
+        elif self.mode == "content" and not self.closed:
+            visible = self._read_string()
+        else:
+            visible = ""
+        if visible:
+            self.content.append(visible)
+        return visible
+
+    def result(self):
+        """
+        Parse the complete reply the same way as a non-streamed call.
+        A function_call reply that is not valid JSON is reported as an `error` instead of being shown as text.
+        :return: Dictionary with `function_call` and/or `content`, or with `error`
+        """
+        message = self.text.strip()
+        if message.startswith("```"):
+            # A fenced block, as models without a JSON mode tend to send
+            message = message[3:].removeprefix("json").rstrip("`").strip()
+        try:
+            reply = json.loads(message)
+            if isinstance(reply, dict):
+                return reply
+        except ValueError as e:
+            if self.mode != "plain":
+                print(f"Error while parsing the streamed response: {e}")
+        if self.mode == "function_call":
+            return {"error": f"Malformed function call: {message[:200]}"}
+        if self.mode == "content":
+            return {"content": "".join(self.content)}
+        return {"content": message}
+
+    def _found_call(self, text):
+        try:
+            call = json.loads(text)
+        except ValueError:
+            return
+        if isinstance(call, dict) and "name" in call and "arguments" in call:
+            self.calls.append(call)
+            if self.on_call is not None:
+                self.on_call(call)
+
+    def _decide(self):
+        stripped = self.text.lstrip()
+        if stripped.startswith("```"):
+            # A fenced block, with or without the json tag, as in result()
+            stripped = stripped[3:]
+            if "json".startswith(stripped):
+                return
+            stripped = stripped.removeprefix("json").lstrip()
+        elif "```".startswith(stripped):
+            return
+        if not stripped:
+            return
+        if not stripped.startswith("{"):
+            self.mode = "plain"
+            return
+
+        # Wait for the first key and the opening quote of its value
+        key_start = stripped.find('"')
+        key_end = stripped.find('"', key_start + 1) if key_start >= 0 else -1
+        if key_end < 0:
+            return
+        key = stripped[key_start + 1:key_end]
+        if key != "content":
+            self.mode = "function_call"
+            return
+        colon = stripped.find(":", key_end)
+        quote = stripped.find('"', colon) if colon >= 0 else -1
+        if quote < 0:
+            if colon >= 0 and stripped[colon + 1:].strip():
+                self.mode = "function_call"  # Not a string value, wait for the full reply
+            return
+        self.mode = "content"
+        self.position = len(self.text) - len(stripped) + quote + 1
+
+    def _read_string(self):
+        visible = []
+        text = self.text
+        while self.position < len(text):
+            char = text[self.position]
+            if char == '"':
+                self.closed = True
+                self.position += 1
+                break
+            if char != "\\":
+                visible.append(char)
+                self.position += 1
+                continue
+            if self.position + 1 >= len(text):
+                break
+            escape = text[self.position + 1]
+            if escape == "u":
+                if self.position + 6 > len(text):
+                    break
+                visible.append(chr(int(text[self.position + 2:self.position + 6], 16)))
+                self.position += 6
+            else:
+                visible.append(self.ESCAPES.get(escape, escape))
+                self.position += 2
+        return "".join(visible)
+
+
+# A piece of a natively streamed tool call: the call's position in the reply, its name once known,
+# and the next fragment of its JSON arguments
+ToolCallDelta = namedtuple("ToolCallDelta", ["index", "name", "arguments"])
+
+
+class NativeReplyParser:
+    """
+    Parse a reply streamed by an API with native tool calling, whose text deltas are plain content
+    and whose tool calls arrive as ToolCallDelta pieces.
+    """
+
+    def __init__(self, on_call=None):
+        """
+        :param on_call: Function called with each call dictionary (name, arguments) once its arguments close
+        """
+        self.mode = None  # "content" or "function_call" once known
+        self.content = []
+        self.on_call = on_call
+        self.calls = {}  # index -> {"name", "arguments"}
+        self.scanners = {}  # index -> _JsonScanner of the arguments
+        self.reported = set()
+
+    def feed(self, delta):
+        """
+        Add a delta of model output.
+        :param delta: Text, or a ToolCallDelta
+        :return: Text that can be shown to the user now
+        """
+        if not isinstance(delta, ToolCallDelta):
+            self.mode = self.mode or "content"
+            self.content.append(delta)
+            return delta
+        self.mode = "function_call"
+        call = self.calls.setdefault(delta.index, {"name": "", "arguments": ""})
+        scanner = self.scanners.setdefault(delta.index, _JsonScanner())
+        call["name"] += delta.name or ""
+        call["arguments"] += delta.arguments or ""
+        closed = scanner.feed(delta.arguments or "")
+        if any(not parents for _, _, _, parents in closed) and delta.index not in self.reported:
+            self.reported.add(delta.index)
+            if self.on_call is not None:
+                self.on_call(dict(call))
+        return ""
+
+    def result(self):
+        """
+        Build the reply in the same shape as the JSON format.
+        :return: Dictionary with `function_call` and/or `content`, or with `error` if arguments are not valid JSON
+        """
+        content = "".join(self.content)
+        if not self.calls:
+            return {"content": content}
+        calls = [self.calls[index] for index in sorted(self.calls)]
+        for call in calls:
+            try:
+                json.loads(call["arguments"] or "{}")
+            except ValueError:
+                return {"error": f"Malformed arguments for {call['name']}: {call['arguments'][:200]}"}
+        return {"function_call": calls[0] if len(calls) == 1 else calls, "content": content}
+
+
+def parse_reply(text):
+    """
+    Parse a complete reply in the tool-calling JSON format.
+    :param text: Model output
+    :return: Dictionary with `function_call` and/or `content`, or with `error`
+    """
+    parser = StreamingReplyParser()
+    parser.feed(text)
+    return parser.result()
+
+
+class ReplyStream:
+    def __init__(self, deltas, on_call=None, parser=None):
+        """
+        Iterate over the user-visible text of a streamed reply.
+        Once exhausted, `result` holds the parsed reply.
+        :param deltas: Iterator of raw text chunks from the model
+        :param on_call: Function called with each tool call as soon as it is complete, before the reply ends
+        :param parser: Parser of the deltas, defaults to a StreamingReplyParser for the JSON format
+        """
+        self.deltas = deltas
+        self.parser = parser or StreamingReplyParser(on_call)
+        self.result = None
+
+    def __iter__(self):
+        for delta in self.deltas:
+            visible = self.parser.feed(delta)
+            if visible:
+                yield visible
+        self.result = self.parser.result()
+
+    @property
+    def is_function_call(self):
+        return self.parser.mode == "function_call"
+
+    def close(self):
+        """Release the underlying stream without reading it, e.g. when a hedged request lost."""
+        close = getattr(self.deltas, "close", None)
+        if close is not None:
+            close()
+
+
+class AsyncReplyStream(ReplyStream):
+    """ReplyStream over an async iterator of raw text chunks."""
+
+    async def __aiter__(self):
+        async for delta in self.deltas:
+            visible = self.parser.feed(delta)
+            if visible:
+                yield visible
+        self.result = self.parser.result()
+
+    async def aclose(self):
+        aclose = getattr(self.deltas, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+# Built-in backends as "module:attribute", imported and constructed on first use
+BACKENDS = {
+    "openai": "openai_backend:OpenAIBackend",
+    "azure": "openai_backend:AzureBackend",
+    "azure_secondary": "openai_backend:secondary_azure",
+    "local": "local_model:LocalModel",
+}
+
+
+class ModelManager:
+    def __init__(self, backends=None):
         """
         Initialize the model manager, supporting OpenAI, Azure, and local models.
+        Backends are imported and initialized on first use, so startup does not pay for unused ones.
+        :param backends: Backend name -> factory, a callable or a "module:attribute" path; defaults to BACKENDS
+        """
+        self.factories = dict(BACKENDS if backends is None else backends)
+        self.backends = {}
+        self.locks = {}
+        self.lock = Lock()
+        self.warmup_thread = None
+        self.latency = LatencyStats()  # Per backend, until the reply or the start of its stream
+        self.hedges = {"hedged": 0, "hedge_wins": 0}
+        self.hedge_executor = None
+
+        if Config.LOCAL_MODEL_PATH and Config.LOCAL_MODEL_WARMUP:
+            self.warm_up("local")
+
+    def register_backend(self, name, factory):
+        """
+        Register a backend, replacing any loaded instance of the same name.
+        :param name: Backend name
+        :param factory: Callable returning the backend, or a "module:attribute" path to one
+        """
+        with self.lock:
+            self.factories[name] = factory
+            self.backends.pop(name, None)
+
+    def get_backend(self, name):
+        """
+        Get a backend, importing and initializing it on first use.
+        Concurrent first calls wait for a single initialization.
+        :param name: Backend name
+        :return: Backend instance
+        """
+        backend = self.backends.get(name)
+        if backend is not None:
+            return backend
+        with self.lock:
+            if name not in self.factories:
+                raise ValueError(f"Backend {name} not found.")
+            lock = self.locks.setdefault(name, Lock())
+        with lock:
+            backend = self.backends.get(name)
+            if backend is None:
+                factory = self.factories[name]
+                if isinstance(factory, str):
+                    module, attribute = factory.split(":")
+                    factory = getattr(importlib.import_module(module), attribute)
+                backend = self.backends[name] = factory()
+        return backend
+
+    def warm_up(self, name="local"):
         """
-        self.openai_api_key = Config.OPENAI_API_KEY
-        self.azure_api_key = Config.AZURE_API_KEY
-        self.azure_endpoint = Config.AZURE_ENDPOINT
-        self.azure_api_version = Config.AZURE_API_VERSION
-        self.local_model_path = Config.LOCAL_MODEL_PATH
-        self.base_url = Config.OPENAI_BASE_URL
-
-        # Initialize the local model
-        self.local_model = None
-        self.local_tokenizer = None
-        if self.local_model_path:
-            self._load_local_model()
-
-    def _load_local_model(self):
-        """Load the local model (supports .safetensors format)"""
+        Initialize a backend in a background thread, so the first call does not pay for it.
+        :param name: Backend name
+        :return: The warm-up thread
+        """
+        def load():
+            try:
+                self.get_backend(name)
+            except Exception as e:
+                print(f"Warm-up of the {name} backend failed: {e}")
+
+        self.warmup_thread = Thread(target=load, daemon=True, name=f"warm-up-{name}")
+        self.warmup_thread.start()
+        return self.warmup_thread
+
+    def call(self, name, prompt, **kwargs):
+        """
+        Call a backend, hedging it with a second backend if Config.LLM_HEDGE says so.
+        :param name: Backend name
+        :param prompt: Input prompt
+        :param kwargs: Arguments of the backend's call method, also passed to the hedge backend
+        :return: Result of whichever backend answered first
+        """
+        hedge = Config.LLM_HEDGE.get(name)
+        if hedge is None:
+            return self._timed_call(name, prompt, kwargs)
+
+        hedge_name, delay = hedge
+        if self.hedge_executor is None:
+            with self.lock:
+                if self.hedge_executor is None:
+                    self.hedge_executor = ThreadPoolExecutor(thread_name_prefix="llm-hedge")
+        primary = self.hedge_executor.submit(contextvars.copy_context().run, self._timed_call, name, prompt, kwargs)
         try:
-            self.local_tokenizer = AutoTokenizer.from_pretrained(self.local_model_path)
-            self.local_model = AutoModelForCausalLM.from_pretrained(
-                self.local_model_path,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto"
-            )
-            print(f"Loaded local model from {self.local_model_path}")
-        except Exception as e:
-            raise ValueError(f"Failed to load local model: {e}")
-
-    def call_openai(self, prompt, model="gpt-3.5-turbo"):
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        # The primary is slow: race it against the hedge backend and keep the first success
+        with self.lock:
+            self.hedges["hedged"] += 1
+        secondary = self.hedge_executor.submit(contextvars.copy_context().run, self._timed_call, hedge_name, prompt,
+                                               kwargs)
+        pending = {primary, secondary}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                (secondary if future is primary else primary).add_done_callback(_discard)
+                if future is secondary:
+                    with self.lock:
+                        self.hedges["hedge_wins"] += 1
+                return future.result()
+        raise primary.exception()
+
+    async def acall(self, name, prompt, **kwargs):
         """
-        Call the OpenAI model.
-        :param prompt: Input prompt text
-        :param model: OpenAI model name to use
-        :return: Generated text
+        Call a backend without blocking the event loop, hedging it like call.
+        :param name: Backend name
+        :param prompt: Input prompt
+        :param kwargs: Arguments of the backend's acall method, also passed to the hedge backend
+        :return: Result of whichever backend answered first
         """
-        if not self.openai_api_key:
-            raise ValueError("OpenAI API key is not provided.")
+        hedge = Config.LLM_HEDGE.get(name)
+        if hedge is None:
+            return await self._timed_acall(name, prompt, kwargs)
 
-        client = openai.OpenAI(api_key=self.openai_api_key, base_url=self.base_url)
+        hedge_name, delay = hedge
+        primary = asyncio.ensure_future(self._timed_acall(name, prompt, kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
 
+        with self.lock:
+            self.hedges["hedged"] += 1
+        secondary = asyncio.ensure_future(self._timed_acall(hedge_name, prompt, kwargs))
+        pending = {primary, secondary}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    continue
+                loser = secondary if task is primary else primary
+                if not loser.done():
+                    loser.cancel()
+                elif loser.exception() is None and hasattr(loser.result(), "aclose"):
+                    await loser.result().aclose()
+                if task is secondary:
+                    with self.lock:
+                        self.hedges["hedge_wins"] += 1
+                return task.result()
+        raise primary.exception()
+
+    def get_stats(self):
+        """
+        Get per-backend latency statistics and hedging counters.
+        :return: Dictionary with "latency" and "hedging" entries
+        """
+        with self.lock:
+            hedges = dict(self.hedges)
+        return {"latency": self.latency.snapshot(), "hedging": hedges}
+
+    def _timed_call(self, name, prompt, kwargs):
+        backend = self.get_backend(name)
+        start = time.perf_counter()
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=prompt,
-                stream=False
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            raise ValueError(f"OpenAI API call failed: {e}")
+            with tracer.upstream(f"llm.{name}", stream=bool(kwargs.get("stream"))) as span:
+                reply = backend.call(prompt, **kwargs)
+                span.set(status="ok")
+            return reply
+        finally:
+            self.latency.record(name, time.perf_counter() - start)
 
-    def call_azure(self, prompt, deployment_name="gpt-4o-mini"):
+    async def _timed_acall(self, name, prompt, kwargs):
+        backend = self.get_backend(name)
+        start = time.perf_counter()
+        try:
+            with tracer.upstream(f"llm.{name}", stream=bool(kwargs.get("stream"))) as span:
+                reply = await backend.acall(prompt, **kwargs)
+                span.set(status="ok")
+            return reply
+        finally:
+            self.latency.record(name, time.perf_counter() - start)
+
+    def call_openai(self, prompt, model="gpt-3.5-turbo", stream=False, **structured):
+        """
+        Call the OpenAI model.
+        :param prompt: Input prompt text
+        :param model: OpenAI model name to use
+        :param stream: Return an iterator of text deltas instead of the full text
+        :param structured: tools, json_mode and on_tool_call of OpenAIBackend.call, for a parsed reply
+        :return: Generated text, or an iterator of text deltas when streaming
+        """
+        return self.call("openai", prompt, model=model, stream=stream, **structured)
+
+    def call_azure(self, prompt, deployment_name="gpt-4o-mini", stream=False, **structured):
         """
         Call the Azure OpenAI model.
         :param prompt: Input prompt text
         :param deployment_name: Azure deployment name
-        :return: Generated text
+        :param stream: Return a ReplyStream that yields the reply text as it is generated
+        :param structured: tools, json_mode and on_tool_call of AzureBackend.call
+        :return: Parsed reply, or a ReplyStream when streaming
         """
-        if not self.azure_api_key or not self.azure_endpoint:
-            raise ValueError("Azure API key or endpoint is not provided.")
+        return self.call("azure", prompt, deployment_name=deployment_name, stream=stream, **structured)
 
-        client = openai.AzureOpenAI(
-            api_key=self.azure_api_key,
-            api_version=self.azure_api_version,
-            azure_endpoint=self.azure_endpoint
-        )
+    async def acall_openai(self, prompt, model="gpt-3.5-turbo", stream=False, **structured):
+        """
+        Call the OpenAI model without blocking the event loop.
+        :param prompt: Input prompt text
+        :param model: OpenAI model name to use
+        :param stream: Return an async iterator of text deltas instead of the full text
+        :param structured: tools, json_mode and on_tool_call of OpenAIBackend.acall, for a parsed reply
+        :return: Generated text, or an async iterator of text deltas when streaming
+        """
+        return await self.acall("openai", prompt, model=model, stream=stream, **structured)
 
-        try:
-            response = client.chat.completions.create(
-                model=deployment_name,
-                messages=prompt
-            )
-            response_message = response.choices[0].message.content.replace("```json", "").replace("```", '').strip()
-            try:
-                return json.loads(response_message)
-            except Exception as e:
-                print(f"Error while parsing the Azure response: {e}")
-                return {"content": response_message}
-        except Exception as e:
-            raise ValueError(f"Azure API call failed: {e}")
+    async def acall_azure(self, prompt, deployment_name="gpt-4o-mini", stream=False, **structured):
+        """
+        Call the Azure OpenAI model without blocking the event loop.
+        :param prompt: Input prompt text
+        :param deployment_name: Azure deployment name
+        :param stream: Return an AsyncReplyStream that yields the reply text as it is generated
+        :param structured: tools, json_mode and on_tool_call of AzureBackend.acall
+        :return: Parsed reply, or an AsyncReplyStream when streaming
+        """
+        return await self.acall("azure", prompt, deployment_name=deployment_name, stream=stream, **structured)
 
-    def call_local_model(self, prompt, max_tokens=5000):
+    def call_local_model(self, prompt, max_tokens=5000, stream=False, session_id=None, tools=None,
+                         on_tool_call=None):
         """
         Call the local model.
         :param prompt: Input prompt text
         :param max_tokens: Maximum number of tokens to generate
-        :return: Generated text
+        :param stream: Return an iterator of text deltas instead of the full text
+        :param session_id: Session ID, used to reuse the KV cache of the session's previous call
+        :param tools: Tool descriptions; the output is then constrained to the tool-calling JSON format
+                      with arguments following each tool's schema
+        :param on_tool_call: Function called with each tool call as soon as it is complete
+        :return: Generated text, or an iterator of text deltas when streaming; with tools, the parsed reply,
+                 or a ReplyStream when streaming
         """
-        if not self.local_model or not self.local_tokenizer:
-            raise ValueError("Local model is not loaded.")
+        structured = {"tools": tools, "on_tool_call": on_tool_call} if tools else {}
+        return self.call("local", prompt, max_tokens=max_tokens, stream=stream, session_id=session_id, **structured)
 
-        try:
-            inputs = self.local_tokenizer(prompt, return_tensors="pt").to(self.local_model.device)
-            outputs = self.local_model.generate(
-                inputs.input_ids,
-                max_new_tokens=max_tokens,
-                pad_token_id=self.local_tokenizer.eos_token_id
-            )
-            return self.local_tokenizer.decode(outputs[0], skip_special_tokens=True)
-        except Exception as e:
-            raise ValueError(f"Local model call failed: {e}")
+
+def _discard(future):
+    """Release the stream of a hedged call that lost the race."""
+    if future.exception() is None:
+        close = getattr(future.result(), "close", None)
+        if close is not None:
+            close()
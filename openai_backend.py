@@ -0,0 +1,314 @@
+# openai_backend.py
+#
+# OpenAI and Azure OpenAI backends. Imported by ModelManager on first use.
+
+import abc
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import openai
+
+from config import Config
+from model import ReplyStream, AsyncReplyStream, NativeReplyParser, ToolCallDelta, parse_reply
+
+# Errors worth another attempt: the request may succeed on a fresh connection or after a pause
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+class _PooledBackend(abc.ABC):
+    """Long-lived sync and async clients with a bounded connection pool, plus retries with jittered backoff."""
+
+    provider = None
+
+    def __init__(self):
+        self.client = None
+        self.async_client = None
+        self.async_loop = None  # An async connection pool belongs to the event loop it was created on
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _new_client(self, http_client):
+        """
+        Create the provider's sync client.
+        :param http_client: Pooled httpx client to send requests through
+        :return: openai.OpenAI or openai.AzureOpenAI
+        """
+
+    @abc.abstractmethod
+    def _new_async_client(self, http_client):
+        """
+        Create the provider's async client.
+        :param http_client: Pooled httpx async client to send requests through
+        :return: openai.AsyncOpenAI or openai.AsyncAzureOpenAI
+        """
+
+    @staticmethod
+    def _http_options():
+        return {
+            "limits": httpx.Limits(max_connections=Config.LLM_POOL_SIZE,
+                                   max_keepalive_connections=Config.LLM_POOL_SIZE),
+            "timeout": httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+        }
+
+    def _get_client(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = self._new_client(openai.DefaultHttpxClient(**self._http_options()))
+        return self.client
+
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if self.async_loop is not loop:
+            self.async_client = self._new_async_client(openai.DefaultAsyncHttpxClient(**self._http_options()))
+            self.async_loop = loop
+        return self.async_client
+
+    def _create(self, **kwargs):
+        """Create a chat completion, retrying transient failures."""
+        client = self._get_client()
+        for attempt in range(Config.LLM_MAX_RETRIES + 1):
+            try:
+                return client.chat.completions.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == Config.LLM_MAX_RETRIES:
+                    raise
+                time.sleep(_backoff(attempt, e))
+
+    async def _acreate(self, **kwargs):
+        """Create a chat completion without blocking the event loop, retrying transient failures."""
+        client = self._get_async_client()
+        for attempt in range(Config.LLM_MAX_RETRIES + 1):
+            try:
+                return await client.chat.completions.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == Config.LLM_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(_backoff(attempt, e))
+
+
+class OpenAIBackend(_PooledBackend):
+    provider = "OpenAI"
+
+    def __init__(self):
+        """
+        Backend for the OpenAI chat completions API.
+        """
+        super().__init__()
+        self.api_key = Config.OPENAI_API_KEY
+        self.base_url = Config.OPENAI_BASE_URL
+
+    def _new_client(self, http_client):
+        return openai.OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0, http_client=http_client)
+
+    def _new_async_client(self, http_client):
+        return openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                  http_client=http_client)
+
+    def call(self, prompt, model="gpt-3.5-turbo", stream=False, tools=None, json_mode=False, on_tool_call=None):
+        """
+        Call the OpenAI model.
+        :param prompt: Input prompt text
+        :param model: OpenAI model name to use
+        :param stream: Return an iterator of text deltas instead of the full text
+        :param tools: Tool descriptions (name, description, parameters) to offer through native tool calling
+        :param json_mode: Ask for a reply in the tool-calling JSON format through JSON mode
+        :param on_tool_call: Function called with each tool call as soon as its arguments are complete
+        :return: Generated text, or an iterator of text deltas when streaming; with tools or json_mode,
+                 the parsed reply, or a ReplyStream when streaming
+        """
+        if not self.api_key:
+            raise ValueError("OpenAI API key is not provided.")
+
+        try:
+            response = self._create(model=model, messages=prompt, stream=stream,
+                                    **_structured_options(tools, json_mode))
+            if not tools and not json_mode:
+                return _Deltas(response, self.provider) if stream else response.choices[0].message.content
+            return _reply(response, self.provider, stream, tools, on_tool_call)
+        except Exception as e:
+            raise ValueError(f"OpenAI API call failed: {e}")
+
+    async def acall(self, prompt, model="gpt-3.5-turbo", stream=False, tools=None, json_mode=False,
+                    on_tool_call=None):
+        """
+        Call the OpenAI model without blocking the event loop.
+        :param prompt: Input prompt text
+        :param model: OpenAI model name to use
+        :param stream: Return an async iterator of text deltas instead of the full text
+        :param tools: Tool descriptions (name, description, parameters) to offer through native tool calling
+        :param json_mode: Ask for a reply in the tool-calling JSON format through JSON mode
+        :param on_tool_call: Function called with each tool call as soon as its arguments are complete
+        :return: Generated text, or an async iterator of text deltas when streaming; with tools or json_mode,
+                 the parsed reply, or an AsyncReplyStream when streaming
+        """
+        if not self.api_key:
+            raise ValueError("OpenAI API key is not provided.")
+
+        try:
+            response = await self._acreate(model=model, messages=prompt, stream=stream,
+                                           **_structured_options(tools, json_mode))
+            if not tools and not json_mode:
+                return _Deltas(response, self.provider) if stream else response.choices[0].message.content
+            return _reply(response, self.provider, stream, tools, on_tool_call, AsyncReplyStream)
+        except Exception as e:
+            raise ValueError(f"OpenAI API call failed: {e}")
+
+
+class AzureBackend(_PooledBackend):
+    provider = "Azure"
+
+    def __init__(self, api_key=None, endpoint=None, api_version=None):
+        """
+        Backend for Azure OpenAI deployments, replying in the tool-calling JSON format.
+        :param api_key: API key, defaults to Config.AZURE_API_KEY
+        :param endpoint: Resource endpoint, defaults to Config.AZURE_ENDPOINT
+        :param api_version: API version, defaults to Config.AZURE_API_VERSION
+        """
+        super().__init__()
+        self.api_key = api_key or Config.AZURE_API_KEY
+        self.endpoint = endpoint or Config.AZURE_ENDPOINT
+        self.api_version = api_version or Config.AZURE_API_VERSION
+
+    def _new_client(self, http_client):
+        return openai.AzureOpenAI(api_key=self.api_key, api_version=self.api_version, azure_endpoint=self.endpoint,
+                                  max_retries=0, http_client=http_client)
+
+    def _new_async_client(self, http_client):
+        return openai.AsyncAzureOpenAI(api_key=self.api_key, api_version=self.api_version,
+                                       azure_endpoint=self.endpoint, max_retries=0, http_client=http_client)
+
+    def call(self, prompt, deployment_name="gpt-4o-mini", stream=False, tools=None, json_mode=False,
+             on_tool_call=None):
+        """
+        Call the Azure OpenAI model.
+        :param prompt: Input prompt text
+        :param deployment_name: Azure deployment name
+        :param stream: Return a ReplyStream that yields the reply text as it is generated
+        :param tools: Tool descriptions (name, description, parameters) to offer through native tool calling
+        :param json_mode: Constrain the reply to a JSON object through JSON mode
+        :param on_tool_call: Function called with each tool call as soon as its arguments are complete
+        :return: Parsed reply, or a ReplyStream when streaming
+        """
+        if not self.api_key or not self.endpoint:
+            raise ValueError("Azure API key or endpoint is not provided.")
+
+        try:
+            response = self._create(model=deployment_name, messages=prompt, stream=stream,
+                                    **_structured_options(tools, json_mode))
+            return _reply(response, self.provider, stream, tools, on_tool_call)
+        except Exception as e:
+            raise ValueError(f"Azure API call failed: {e}")
+
+    async def acall(self, prompt, deployment_name="gpt-4o-mini", stream=False, tools=None, json_mode=False,
+                    on_tool_call=None):
+        """
+        Call the Azure OpenAI model without blocking the event loop.
+        :param prompt: Input prompt text
+        :param deployment_name: Azure deployment name
+        :param stream: Return an AsyncReplyStream that yields the reply text as it is generated
+        :param tools: Tool descriptions (name, description, parameters) to offer through native tool calling
+        :param json_mode: Constrain the reply to a JSON object through JSON mode
+        :param on_tool_call: Function called with each tool call as soon as its arguments are complete
+        :return: Parsed reply, or an AsyncReplyStream when streaming
+        """
+        if not self.api_key or not self.endpoint:
+            raise ValueError("Azure API key or endpoint is not provided.")
+
+        try:
+            response = await self._acreate(model=deployment_name, messages=prompt, stream=stream,
+                                           **_structured_options(tools, json_mode))
+            return _reply(response, self.provider, stream, tools, on_tool_call, AsyncReplyStream)
+        except Exception as e:
+            raise ValueError(f"Azure API call failed: {e}")
+
+
+def secondary_azure():
+    """The second Azure deployment from the config, used as a hedge or fallback target."""
+    return AzureBackend(Config.AZURE_SECONDARY_API_KEY, Config.AZURE_SECONDARY_ENDPOINT)
+
+
+class _Deltas:
+    def __init__(self, response, provider, tool_calls=False):
+        """
+        Text deltas of a streamed chat completion, iterable with `for` or `async for`.
+        :param response: Stream or AsyncStream returned by the SDK
+        :param provider: Provider name for error messages
+        :param tool_calls: Also yield the pieces of native tool calls, as ToolCallDelta
+        """
+        self.response = response
+        self.provider = provider
+        self.tool_calls = tool_calls
+
+    def __iter__(self):
+        try:
+            for chunk in self.response:
+                yield from self._split(chunk)
+        except Exception as e:
+            raise ValueError(f"{self.provider} API stream failed: {e}")
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.response:
+                for delta in self._split(chunk):
+                    yield delta
+        except Exception as e:
+            raise ValueError(f"{self.provider} API stream failed: {e}")
+
+    def _split(self, chunk):
+        # Azure sends content-filter chunks without choices
+        if not chunk.choices:
+            return []
+        delta = chunk.choices[0].delta
+        deltas = [delta.content] if delta.content else []
+        if self.tool_calls:
+            for tool_call in delta.tool_calls or []:
+                function = tool_call.function
+                deltas.append(ToolCallDelta(tool_call.index, function.name if function else None,
+                                            function.arguments if function else None))
+        return deltas
+
+    def close(self):
+        """Release the connection of a stream that will not be read."""
+        self.response.close()
+
+    async def aclose(self):
+        await self.response.close()
+
+
+def _backoff(attempt, error):
+    """Seconds to wait before the next attempt: Retry-After if the server sent one, else full jitter."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), Config.LLM_RETRY_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(Config.LLM_RETRY_BACKOFF_MAX, Config.LLM_RETRY_BACKOFF * 2 ** attempt))
+
+
+def _structured_options(tools, json_mode):
+    """Request arguments for native tool calling or JSON mode."""
+    if tools:
+        return {"tools": [{"type": "function", "function": tool} for tool in tools]}
+    if json_mode:
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+
+def _reply(response, provider, stream, tools, on_tool_call, stream_type=ReplyStream):
+    """Wrap a chat completion into the reply format: a ReplyStream, or the parsed reply."""
+    if stream:
+        parser = NativeReplyParser(on_tool_call) if tools else None
+        return stream_type(_Deltas(response, provider, tool_calls=bool(tools)), on_call=on_tool_call, parser=parser)
+    message = response.choices[0].message
+    if not tools:
+        return parse_reply(message.content or "")
+    parser = NativeReplyParser()
+    if message.content:
+        parser.feed(message.content)
+    for index, tool_call in enumerate(message.tool_calls or []):
+        parser.feed(ToolCallDelta(index, tool_call.function.name, tool_call.function.arguments))
+    return parser.result()
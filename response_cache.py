@@ -0,0 +1,175 @@
+# response_cache.py
+
+import hashlib
+import inspect
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from config import Config
+
+# Tool calls a question was answered with; steps and reply are set while the data behind them is fresh
+CachedTurn = namedtuple("CachedTurn", "calls steps reply")
+
+
+class ResponseCache:
+    def __init__(self, tool_manager, router, max_entries=Config.RESPONSE_CACHE_MAX_ENTRIES,
+                 max_ttl=Config.RESPONSE_CACHE_MAX_TTL, enabled=Config.RESPONSE_CACHE_ENABLED):
+        """
+        Share the replies to market questions across sessions.
+        A question is keyed on its normalized text, the assets and pairs it names and the session's latest
+        tool, so a follow-up like "and ETH?" only matches follow-ups to the same tool. An answer is shared
+        only if every argument of its tool calls comes from the question itself: a named asset or pair, a
+        word of the question, or the tool's default. Questions like "what's its price?" depend on earlier
+        turns and are never shared. A question asked before skips the first model call and makes the tool
+        calls it was answered with. While their data is fresh, the earlier results and reply are served as
+        they are. Afterwards the calls run again, and the reply is reused if the results have the same
+        fingerprint. Only calls of read-only tools with a reply TTL are shared, so account-scoped and
+        side-effecting tools never are.
+        :param tool_manager: Tool manager giving each call's reply TTL
+        :param router: Intent router finding the assets and pairs a question names
+        :param max_entries: Questions, and replies, kept before the least recently used ones are evicted
+        :param max_ttl: Seconds a question's tool calls are reused, and cap of the freshness of any reply
+        :param enabled: Cache at all
+        """
+        self.tool_manager = tool_manager
+        self.router = router
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.enabled = enabled
+        self.questions = OrderedDict()  # key -> (calls, expires, steps, reply, fresh until), least recent first
+        self.replies = OrderedDict()  # (key, fingerprint) -> (reply, expires)
+        self.lock = threading.Lock()
+        self.stats = {"lookups": 0, "fresh_hits": 0, "call_hits": 0, "reply_hits": 0, "misses": 0, "stored": 0,
+                      "not_shared": 0, "evictions": 0, "llm_calls_avoided": 0}
+
+    def key(self, prompt, messages):
+        """
+        Cache key of a question.
+        :param prompt: User input
+        :param messages: Chat messages of the turn, with the session history
+        :return: Key, or None if the cache is disabled
+        """
+        if not self.enabled or not isinstance(prompt, str):
+            return None
+        context = next((message.get("name") for message in reversed(messages) if message.get("role") == "function"),
+                       None)
+        assets, symbols = self.router.entities(prompt)
+        return " ".join(re.findall(r"[a-z0-9]+", prompt.lower())), tuple(assets), tuple(symbols), context
+
+    def lookup(self, key):
+        """
+        Find the earlier answer to a question.
+        :param key: Key from key()
+        :return: CachedTurn, with steps and reply only while they are fresh, or None
+        """
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            self.stats["lookups"] += 1
+            entry = self.questions.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.questions[key]
+                self.stats["misses"] += 1
+                return None
+            self.questions.move_to_end(key)
+            calls, _, steps, reply, fresh_until = entry
+            if fresh_until > now:
+                # Neither model call is needed
+                self.stats["fresh_hits"] += 1
+                self.stats["llm_calls_avoided"] += 2
+                return CachedTurn(calls, steps, reply)
+            self.stats["call_hits"] += 1
+            self.stats["llm_calls_avoided"] += 1
+        return CachedTurn(calls, None, None)
+
+    def reply_for(self, key, steps):
+        """
+        Find the reply given to a question with the same tool results.
+        :param key: Key from key()
+        :param steps: Function messages with this turn's tool results
+        :return: Reply, or None
+        """
+        if key is None:
+            return None
+        reply_key = (key, _fingerprint(steps))
+        now = time.monotonic()
+        with self.lock:
+            found = self.replies.get(reply_key)
+            if found is None or found[1] <= now:
+                return None
+            self.replies.move_to_end(reply_key)
+            self.stats["reply_hits"] += 1
+            self.stats["llm_calls_avoided"] += 1
+        return found[0]
+
+    def store(self, key, calls, steps, reply):
+        """
+        Remember the answer to a question, if all of its tool calls may be shared.
+        :param key: Key from key()
+        :param calls: List of (tool name, arguments dictionary) the model answered with
+        :param steps: Function messages with the tool results
+        :param reply: Final reply
+        """
+        if key is None:
+            return
+        ttls = [self.tool_manager.get_reply_ttl(tool_name, arguments) for tool_name, arguments in calls]
+        if not ttls or None in ttls or not all(self._from_question(key, tool_name, arguments)
+                                               for tool_name, arguments in calls):
+            with self.lock:
+                self.stats["not_shared"] += 1
+            return
+        reply_key = (key, _fingerprint(steps))
+        now = time.monotonic()
+        expires = now + self.max_ttl
+        fresh_until = now + max(0.0, min(ttls + [self.max_ttl]))
+        with self.lock:
+            self.questions[key] = (calls, expires, steps, reply, fresh_until)
+            self.questions.move_to_end(key)
+            self.replies[reply_key] = (reply, expires)
+            self.replies.move_to_end(reply_key)
+            self.stats["stored"] += 1
+            for entries in (self.questions, self.replies):
+                while len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+
+    def _from_question(self, key, tool_name, arguments):
+        """Whether every argument of a call is named by the question, or the tool's default."""
+        text, assets, symbols, _ = key
+        words = set(text.split())
+        try:
+            defaults = {name: parameter.default
+                        for name, parameter in inspect.signature(self.tool_manager.tools[tool_name]).parameters.items()
+                        if parameter.default is not inspect.Parameter.empty}
+        except (KeyError, TypeError, ValueError):
+            defaults = {}
+        for name, value in arguments.items():
+            if value in assets or value in symbols or str(value).lower() in words:
+                continue
+            if name in defaults and str(defaults[name]) == str(value):
+                continue
+            return False
+        return True
+
+    def get_stats(self):
+        """
+        Get cache counters.
+        :return: Dictionary with lookups, hits, misses, LLM calls avoided and the hit rate
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.questions)
+        hits = stats["fresh_hits"] + stats["call_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+
+def _fingerprint(steps):
+    """Digest of the tool results of a turn."""
+    text = json.dumps([step["content"] for step in steps])
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
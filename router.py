@@ -0,0 +1,271 @@
+# router.py
+
+import re
+import threading
+from decimal import Decimal, InvalidOperation
+
+from config import Config
+from metrics import LatencyStats
+
+# Base assets the router recognizes, with the names people use for them
+ASSETS = {
+    "BTC": ("bitcoin",),
+    "ETH": ("ethereum", "ether"),
+    "BNB": ("binance coin",),
+    "SOL": ("solana",),
+    "XRP": ("ripple",),
+    "ADA": ("cardano",),
+    "DOGE": ("dogecoin",),
+    "DOT": ("polkadot",),
+    "LTC": ("litecoin",),
+    "TRX": ("tron",),
+    "AVAX": ("avalanche",),
+    "LINK": ("chainlink",),
+    "USDT": ("tether",),
+    "USDC": ("usd coin",),
+}
+# Quote assets of the trading pairs the router recognizes, the first one is used when none is named
+QUOTE_ASSETS = ("USDT", "USDC", "FDUSD", "BTC", "ETH", "BNB")
+
+_ENTITY = r"(?P<entity>[a-z0-9/\-]+(?: coin)?)"
+_ASK = r"(?:(?:what is|get|show(?: me)?|tell me|check|give me)\s+)?"
+_NOW = r"(?:\s+(?:now|right now|today))?"
+
+# (tool, argument, entity kind, patterns matched against the whole normalized prompt)
+INTENTS = [
+    ("get_symbol_price", "symbol", "symbol", [
+        _ASK + r"(?:the\s+)?(?:current\s+|latest\s+)?price\s+(?:of|for)\s+" + _ENTITY + _NOW,
+        _ASK + r"(?:the\s+)?(?:current\s+|latest\s+)?" + _ENTITY + r"\s+price" + _NOW,
+        r"how much is\s+(?:one\s+|1\s+)?" + _ENTITY + r"(?:\s+worth)?" + _NOW,
+    ]),
+    ("get_account_balance", "asset", "asset", [
+        _ASK + r"my\s+" + _ENTITY + r"\s+balance",
+        _ASK + r"my\s+balance\s+(?:of|for|in)\s+" + _ENTITY,
+        r"how much\s+" + _ENTITY + r"\s+do i (?:have|hold|own)",
+    ]),
+    ("get_open_orders", "symbol", "symbol", [
+        r"(?:(?:show(?: me)?|list|get|what are|check)\s+)?my\s+open\s+orders\s+(?:for|on|in)\s+" + _ENTITY,
+        r"(?:show(?: me)?|list|get)\s+(?:the\s+)?open\s+orders\s+(?:for|on|in)\s+" + _ENTITY,
+    ]),
+]
+
+
+# Words that point at a tool when a prompt names assets, for speculative prefetch
+PREFETCH_HINTS = [
+    ("get_open_orders", "symbol", re.compile(r"\bopen\s+orders?\b")),
+    ("get_symbol_price", "symbol", re.compile(r"\b(?:price|prices|worth|cost|costs|trading|quote)\b")),
+    ("get_account_balance", "asset", re.compile(r"\b(?:balance|balances|hold|holding|own|have)\b")),
+]
+
+
+class Route:
+    def __init__(self, tool_name, arguments):
+        """
+        A prompt the router can answer by calling one tool.
+        :param tool_name: Name of the tool
+        :param arguments: Tool arguments
+        """
+        self.tool_name = tool_name
+        self.arguments = arguments
+
+
+class IntentRouter:
+    def __init__(self, tool_manager, assets=ASSETS, quote_assets=QUOTE_ASSETS, enabled=Config.ROUTER_ENABLED):
+        """
+        Answer simple, unambiguous requests by calling the tool directly, without the LLM.
+        A prompt is routed only if it matches an intent pattern as a whole, names a known asset or
+        pair, and the arguments fit the schema of a registered tool; anything else goes to the LLM.
+        :param tool_manager: Tool management module the tools are registered with
+        :param assets: Base asset -> names it is also known by
+        :param quote_assets: Quote assets of recognized pairs, the first is the default
+        :param enabled: Route prompts at all
+        """
+        self.tool_manager = tool_manager
+        self.enabled = enabled
+        self.quote_assets = quote_assets
+        self.assets = {}  # Lowercase name or ticker -> asset
+        for asset, names in assets.items():
+            for name in (asset.lower(),) + tuple(names):
+                self.assets[name] = asset
+        for asset in quote_assets:
+            self.assets.setdefault(asset.lower(), asset)
+        self.intents = [(tool_name, argument, kind, [re.compile(pattern) for pattern in patterns])
+                        for tool_name, argument, kind, patterns in INTENTS]
+        self.latency = LatencyStats()  # "routed" turns, and "llm" turns that fell back to the model
+        self.lock = threading.Lock()
+        self.stats = {"routed": 0, "fallbacks": 0}
+
+    def match(self, prompt):
+        """
+        Find the tool call that answers a prompt.
+        :param prompt: User input
+        :return: Route, or None when the prompt should go to the LLM
+        """
+        route = self._match(prompt) if self.enabled and isinstance(prompt, str) else None
+        with self.lock:
+            self.stats["routed" if route else "fallbacks"] += 1
+        return route
+
+    def guess_calls(self, prompt, messages=(), limit=Config.PREFETCH_MAX_CALLS):
+        """
+        Guess the read-only tool calls the model is likely to make for a prompt, to prefetch them.
+        The tool comes from hint words in the prompt, or else from the session's latest tool call;
+        the arguments come from the assets and pairs the prompt names.
+        :param prompt: User input
+        :param messages: Earlier messages of the session
+        :param limit: Maximum number of calls
+        :return: List of (tool name, arguments dictionary)
+        """
+        if not isinstance(prompt, str):
+            return []
+        text = " ".join(prompt.lower().replace("what's", "what is").split())
+        assets, symbols = self.entities(text)
+        if not assets and not symbols:
+            return []
+
+        tools = [(tool_name, argument) for tool_name, argument, hint in PREFETCH_HINTS if hint.search(text)][:1]
+        if not tools:
+            # A follow-up like "and ETH?" most likely repeats the previous tool with another asset
+            known = {tool_name: argument for tool_name, argument, _ in PREFETCH_HINTS}
+            for message in reversed(list(messages)):
+                if message.get("role") == "function" and message.get("name") in known:
+                    tools = [(message["name"], known[message["name"]])]
+                    break
+
+        calls = []
+        for tool_name, argument in tools:
+            for value in assets if argument == "asset" else symbols:
+                if self._fits_schema(tool_name, {argument: value}) and (tool_name, {argument: value}) not in calls:
+                    calls.append((tool_name, {argument: value}))
+        return calls[:limit]
+
+    def entities(self, prompt):
+        """
+        Assets and trading pairs a prompt names.
+        :param prompt: User input
+        :return: (assets, symbols), symbols holding the named pairs and the pairs of the named assets
+        """
+        words = re.findall(r"[a-z0-9/\-]+", prompt.lower())
+        assets, pairs = [], []
+        for index, word in enumerate(words):
+            phrase = " ".join(words[index:index + 2])
+            asset = self.assets.get(phrase) or self.assets.get(word)
+            if asset is not None:
+                if asset not in assets:
+                    assets.append(asset)
+                continue
+            symbol = self._symbol(word)
+            if symbol is not None and symbol not in pairs:
+                pairs.append(symbol)
+        for symbol in map(self._symbol, (asset.lower() for asset in assets)):
+            if symbol is not None and symbol not in pairs:
+                pairs.append(symbol)
+        return assets, pairs
+
+    def render(self, route, tool_result):
+        """
+        Phrase a tool result as the reply to the user.
+        :param route: Route the result belongs to
+        :param tool_result: Result of the tool call
+        :return: Reply text
+        """
+        arguments = route.arguments
+        if route.tool_name == "get_symbol_price":
+            found = re.search(r"current price is: (\S+)", str(tool_result))
+            if found:
+                base, quote = self._split_pair(arguments["symbol"])
+                return f"The current price of {base} is {_amount(found.group(1))} {quote}."
+        elif route.tool_name == "get_account_balance":
+            asset = arguments["asset"]
+            found = re.search(r"balance is: (\S+)", str(tool_result))
+            if found:
+                return f"Your {asset} balance is {_amount(found.group(1))} {asset}."
+            if str(tool_result).startswith("No balance found"):
+                return f"You have no {asset} balance."
+        elif route.tool_name == "get_open_orders" and isinstance(tool_result, list):
+            symbol = arguments["symbol"]
+            if not tool_result:
+                return f"You currently have no open orders for {symbol}."
+            lines = "\n".join(f"- {order}" for order in tool_result)
+            return f"You have {len(tool_result)} open order(s) for {symbol}:\n{lines}"
+        # Errors and unexpected results are shown as the tool reported them
+        return str(tool_result)
+
+    def record(self, routed, seconds):
+        """
+        Record how long a chat turn took.
+        :param routed: Whether the router answered the turn
+        :param seconds: Duration of the turn
+        """
+        self.latency.record("routed" if routed else "llm", seconds)
+
+    def get_stats(self):
+        """
+        Get router counters.
+        :return: Dictionary with routed and fallback turns, the hit rate, the mean duration of both
+                 kinds of turns, and the latency saved by routing
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        total = stats["routed"] + stats["fallbacks"]
+        stats["hit_rate"] = stats["routed"] / total if total else 0.0
+        latency = self.latency.snapshot()
+        routed_ms = latency.get("routed", {}).get("mean_ms", 0.0)
+        llm_ms = latency.get("llm", {}).get("mean_ms")
+        stats["routed_mean_ms"] = routed_ms
+        stats["llm_mean_ms"] = llm_ms or 0.0
+        # Each routed turn saves what an LLM turn costs on average, less its own tool call
+        stats["latency_saved_s"] = latency.get("routed", {}).get("count", 0) * max(
+            0.0, (llm_ms or 0.0) - routed_ms) / 1000
+        return stats
+
+    def _match(self, prompt):
+        text = " ".join(prompt.lower().replace("what's", "what is").split()).rstrip("?.! ")
+        for tool_name, argument, kind, patterns in self.intents:
+            for pattern in patterns:
+                found = pattern.fullmatch(text)
+                if not found:
+                    continue
+                entity = found.group("entity")
+                value = self._symbol(entity) if kind == "symbol" else self.assets.get(entity)
+                if value is None:
+                    return None  # The intent is clear but the asset is not, let the LLM sort it out
+                arguments = {argument: value}
+                return Route(tool_name, arguments) if self._fits_schema(tool_name, arguments) else None
+        return None
+
+    def _symbol(self, entity):
+        """Trading pair for a pair or asset name, e.g. "btc", "bitcoin" or "eth/btc"."""
+        name = self.assets.get(entity)
+        if name is not None:
+            if name == self.quote_assets[0]:
+                return None
+            return name + self.quote_assets[0]
+        pair = entity.replace("/", "").replace("-", "").upper()
+        base, quote = self._split_pair(pair)
+        if base and self.assets.get(base.lower()) == base:
+            return pair
+        return None
+
+    def _split_pair(self, pair):
+        for quote in self.quote_assets:
+            if pair.endswith(quote) and len(pair) > len(quote):
+                return pair[:-len(quote)], quote
+        return None, None
+
+    def _fits_schema(self, tool_name, arguments):
+        """Whether the tool is registered and the arguments cover its required parameters."""
+        for description in self.tool_manager.get_tool_descriptions():
+            if description["name"] == tool_name:
+                parameters = description["parameters"]
+                return (set(parameters.get("required", [])) <= set(arguments)
+                        and set(arguments) <= set(parameters.get("properties", {})))
+        return False
+
+
+def _amount(value):
+    """Drop the trailing zeros Binance pads amounts with."""
+    try:
+        return format(Decimal(value).normalize(), "f")
+    except InvalidOperation:
+        return value
@@ -1,10 +1,18 @@
 from flask import Flask, request, Response
 import json
-import time
 import random
+import time
+import uuid
+from collections import namedtuple
 
+from config import Config
 from model import ModelManager
-from tool import tool_manager
+from response_cache import ResponseCache
+from router import IntentRouter
+from session import create_session_manager
+from tokenizer import count_message_tokens, count_tokens
+from tool import tool_manager, Speculation
+from tracing import tracer, TRACE_HEADER
 
 app = Flask(__name__)
 
@@ -13,23 +21,87 @@ model_manager = ModelManager()
 
 
 # Initialize SessionManager
-class SessionManager:
-    def __init__(self):
-        self.sessions = {}
+session_manager = create_session_manager()
+
+# Initialize IntentRouter
+intent_router = IntentRouter(tool_manager)
 
-    def create_session(self, session_id):
-        self.sessions[session_id] = {"history": []}
+# Initialize ResponseCache
+response_cache = ResponseCache(tool_manager, intent_router)
+
+
+def build_messages(prompt, session_id, tool_manager):
+    """
+    Build the prompt for the first model call from the session history and the tool catalog.
+    :param prompt: User input
+    :param session_id: Session ID
+    :param tool_manager: Tool management module
+    :return: List of chat messages
+    """
+    # The static system prompt goes first so the prompt prefix is shared across turns and sessions
+    native = Config.LLM_STRUCTURED_OUTPUT == "tools"
+    messages = [{"role": "system", "content": tool_manager.get_system_prompt(native=native)}]
+    messages.extend(session_manager.get_history(session_id))
+    messages.append({"role": "user", "content": prompt})
 
-    def add_to_history(self, session_id, message):
-        if session_id not in self.sessions:
-            self.create_session(session_id)
-        self.sessions[session_id]["history"].append(message)
+    return messages
 
-    def get_history(self, session_id):
-        return self.sessions.get(session_id, {}).get("history", [])
+
+def parse_function_call(response_data):
+    """
+    Extract the tool call from a model reply.
+    :param response_data: Parsed model reply containing `function_call`
+    :return: Tool name and a dictionary of arguments
+    """
+    # Extract tool name and parameters
+    function_name = response_data["function_call"]["name"]
+    function_args = response_data["function_call"]["arguments"]
+
+    # Parse parameters
+    if isinstance(function_args, str):
+        function_args = json.loads(function_args)
+    elif not isinstance(function_args, dict):
+        raise ValueError("function_args must be a dictionary or JSON string")
+
+    return function_name, function_args
+
+
+def structured_options(tool_manager, speculation=None, follow_up=False):
+    """
+    Arguments of a model call that ask for structured output, as set by Config.LLM_STRUCTURED_OUTPUT.
+    :param tool_manager: Tool management module
+    :param speculation: Speculation to start the read-only calls of a streaming reply in as soon as each is complete
+    :param follow_up: The call answers with the tool results, so no tools are offered
+    :return: Dictionary of keyword arguments for ModelManager.call_azure
+    """
+    options = {}
+    if Config.LLM_STRUCTURED_OUTPUT == "json":
+        options["json_mode"] = True
+    elif Config.LLM_STRUCTURED_OUTPUT == "tools" and not follow_up:
+        options["tools"] = tool_manager.get_tool_descriptions()
+    if speculation is not None and not follow_up:
+        options["on_tool_call"] = lambda call: start_early(call, speculation)
+    return options
 
 
-session_manager = SessionManager()
+def start_early(call, speculation):
+    """Start a tool call of a reply that is still streaming, if its arguments parse."""
+    try:
+        speculation.add(*parse_function_call({"function_call": call}))
+    except Exception as e:
+        print(f"Could not start {call.get('name')} early: {e}")
+
+
+def parse_function_calls(response_data):
+    """
+    Extract all tool calls from a model reply, whose `function_call` is one call or a list of calls.
+    :param response_data: Parsed model reply containing `function_call`
+    :return: List of tool names and dictionaries of arguments
+    """
+    function_calls = response_data["function_call"]
+    if not isinstance(function_calls, list):
+        function_calls = [function_calls]
+    return [parse_function_call({"function_call": function_call}) for function_call in function_calls]
 
 
 def handle_chat(prompt, session_id, model_manager, tool_manager):
@@ -41,107 +113,279 @@ def handle_chat(prompt, session_id, model_manager, tool_manager):
     :param tool_manager: Tool management module
     :return: AI-generated response
     """
-    # Retrieve session history
-    history = session_manager.get_history(session_id)
-    messages = history.copy()
-    tool_prompt = (
-            "You are a helpful AI assistant. You have access to the following tools:\n"
-            + "\n".join(
-        [f"- {tool['name']}: {tool['description']} - parameters: arguments: {tool['parameters']}" for tool in
-         tool_manager.get_tool_descriptions()])
-            + "\n\n"
-              "If you need to use a tool, respond with a JSON object containing the following fields:\n"
-              "1. `function_call`: A dictionary with `name` (the tool name) and `arguments` (a JSON string of the tool's input parameters).\n"
-              "2. `content`: A brief explanation of why you are calling the tool.\n"
-              "Remember, if some argument is missing, and the argument itself is rather trivial, you can fill it with a default value. For example, if the argument LIMIT is missing, put a 5 or 1."
-              "Example:\n"
-              "```json\n"
-              "{\n"
-              '  "function_call": {\n'
-              '    "name": "get_symbol_price",\n'
-              '    "arguments": "{\"symbol\": \"BTCUSDT\"}"\n'
-              "  },\n"
-              '  "content": "I need to get the current price of BTC."\n'
-              "}\n"
-              "```\n"
-              "If you do not need to use a tool, respond with a normal message in the `content` field.\n"
-              "Example:\n"
-              "```json\n"
-              "{\n"
-              '  "content": "The current price of BTC is 50000 USDT."\n'
-              "}\n"
-              "```"
-    )
-    messages.append({"role": "system", "content": tool_prompt})
-    messages.append({"role": "user", "content": prompt})
+    stream = handle_chat_stream(prompt, session_id, model_manager, tool_manager)
+    while True:
+        try:
+            next(stream)
+        except StopIteration as done:
+            return done.value
+
+
+def handle_chat_stream(prompt, session_id, model_manager, tool_manager):
+    """
+    Same as handle_chat, but yields the reply text as the model generates it.
+    :param prompt: User input
+    :param session_id: Session ID
+    :param model_manager: Model management module
+    :param tool_manager: Tool management module
+    :return: Generator of text deltas, returning the final reply and the function call step
+             (a list of steps when the model called several tools)
+    """
+    # Serialize turns of the same session, also across worker processes with a shared backend
+    lock = session_manager.lock(session_id)
+    with tracer.span("chat.session_lock"):
+        lock.acquire()
+    try:
+        return (yield from _drive(chat_turn(prompt, session_id, tool_manager), model_manager, tool_manager))
+    finally:
+        lock.release()
+
+
+# Upstream calls a chat turn leaves to the service running it, see chat_turn
+Blocking = namedtuple("Blocking", "function args")  # Session reads and writes, which may wait on a shared store
+UseTools = namedtuple("UseTools", "calls speculation")  # Tool calls, speculation is None for a routed turn
+CallModel = namedtuple("CallModel", "messages options span")  # A streaming model call, relayed to the user
 
-    # Call the model, passing in the tool descriptions
-    response_data = model_manager.call_azure(messages)
+
+def chat_turn(prompt, session_id, tool_manager):
+    """
+    The steps of a chat turn, shared by this service and async_service.
+    Besides the text deltas for the user, it yields the upstream calls it needs as Blocking, UseTools and
+    CallModel requests. The service makes each call in its own way and sends the result back: the result
+    of the function, the list of tool results, or the parsed reply and the text streamed of it.
+    :param prompt: User input
+    :param session_id: Session ID
+    :param tool_manager: Tool management module
+    :return: Generator of text deltas and calls, returning the final reply and the function call step
+    """
+    start = time.perf_counter()
+    with tracer.span("chat.route") as span:
+        route = intent_router.match(prompt)
+        span.set(routed=route is not None)
+    if route is not None:
+        return (yield from _routed_turn(prompt, session_id, route, tool_manager, start))
+
+    messages = yield Blocking(build_messages, (prompt, session_id, tool_manager))
+    cache_key, cached = lookup_response(prompt, messages)
+    if cached is not None and cached.reply is not None:
+        return (yield from cached_turn(prompt, session_id, cached))
+
+    if cached is not None:
+        # Asked before: make the same tool calls without asking the model again
+        response_data = {"function_call": [{"name": name, "arguments": arguments} for name, arguments in cached.calls]}
+        speculation = Speculation(tool_manager, [])
+    else:
+        # Start the read-only tools the model will likely ask for while it is deciding
+        speculation = None
+        if Config.PREFETCH_ENABLED:
+            speculation = tool_manager.prefetch(intent_router.guess_calls(prompt, messages))
+        if speculation is None:
+            # Still collects the calls started while the reply streams in
+            speculation = Speculation(tool_manager, [])
+
+    # Discard the speculative calls the model did not ask for, also when the turn fails or is abandoned
+    try:
+        streamed = ""
+        if cached is None:
+            # Call the model, passing in the tool descriptions
+            with tracer.span("chat.llm", speculated=len(speculation.flights)) as span:
+                response_data, streamed = yield CallModel(messages, structured_options(tool_manager, speculation),
+                                                          span)
+                if "error" in response_data:
+                    span.set(parse_error=response_data["error"])
+
+        history = [{"role": "user", "content": prompt}]
+        function_call_step = {}
+        preamble = ""
+
+        # Check if a tool needs to be called
+        if "function_call" in response_data:
+            function_calls = parse_function_calls(response_data)
+
+            # Call the tools, concurrently when the model asked for several, reusing speculative results
+            with tracer.span("chat.tools", calls=len(function_calls), tools=[name for name, _ in function_calls]):
+                tool_results = yield UseTools(function_calls, speculation)
+
+            function_call_steps = [{
+                "role": "function",
+                "name": function_name,
+                "content": f"Tool call result: {tool_manager.render_result(function_name, function_args, tool_result)}"
+            } for (function_name, function_args), tool_result in zip(function_calls, tool_results)]
+            function_call_step = function_call_steps[0] if len(function_call_steps) == 1 else function_call_steps
+            history.extend(function_call_steps)
+
+            # Add the tool results to the prompt, all of them answered by one follow-up call
+            messages.extend(function_call_steps)
+
+            # Another session may have asked the same question with the same results
+            final_reply = response_cache.reply_for(cache_key, function_call_steps)
+            # Content streamed along with the function call, e.g. "Let me check.", is part of the reply the user saw
+            preamble, streamed = streamed, ""
+            if preamble and not preamble[-1].isspace():
+                preamble += "\n\n"
+                yield "\n\n"
+            if final_reply is None:
+                with tracer.span("chat.follow_up") as span:
+                    follow_up, streamed = yield CallModel(messages, structured_options(tool_manager, follow_up=True),
+                                                          span)
+                final_reply = follow_up.get("content")
+            if final_reply is not None:
+                response_cache.store(cache_key, function_calls, function_call_steps, final_reply)
+            else:
+                final_reply = "The model did not return a valid response"
+        else:
+            # If no tool call is needed, return AI's response directly
+            final_reply = response_data.get("content", "The model did not return a valid response")
+    finally:
+        speculation.close()
+
+    if not streamed:
+        # Nothing could be streamed, e.g. the reply was not in the expected format
+        yield final_reply
+    final_reply = preamble + final_reply
 
     # Save session history
-    session_manager.add_to_history(session_id, {"role": "user", "content": prompt})
+    history.append({"role": "assistant", "content": final_reply})
+    yield Blocking(save_turn, (session_id, history))
+    intent_router.record(False, time.perf_counter() - start)
 
-    function_call_step = {}
+    return final_reply, function_call_step
 
-    # Check if a tool needs to be called
-    if "function_call" in response_data:
-        # Extract tool name and parameters
-        function_name = response_data["function_call"]["name"]
-        function_args = response_data["function_call"]["arguments"]
 
-        # Parse parameters
-        if isinstance(function_args, str):
-            function_args = json.loads(function_args)
-        elif not isinstance(function_args, dict):
-            raise ValueError("function_args must be a dictionary or JSON string")
+def save_turn(session_id, messages):
+    """
+    Add the messages of a finished turn to the session history.
+    :param session_id: Session ID
+    :param messages: The user message, the function call steps and the reply
+    """
+    for message in messages:
+        session_manager.add_to_history(session_id, message)
 
-        # Call the tool
-        tool_result = tool_manager.use_tool(function_name, **function_args)
 
-        function_call_step = {
-            "role": "function",
-            "name": function_name,
-            "content": f"Tool call result: {tool_result}"
-        }
+def lookup_response(prompt, messages):
+    """
+    Look a question up in the response cache.
+    :param prompt: User input
+    :param messages: Chat messages of the turn
+    :return: Tuple of (cache key, CachedTurn or None)
+    """
+    cache_key = response_cache.key(prompt, messages)
+    with tracer.span("chat.response_cache") as span:
+        cached = response_cache.lookup(cache_key)
+        span.set(cache_hit=cached is not None)
+    return cache_key, cached
 
-        print(f"This is the function call step: {function_call_step}")
 
-        # Add tool result to session history
-        messages.append(function_call_step)
+def cached_turn(prompt, session_id, cached):
+    """Answer a turn with the tool results and reply another session got moments ago."""
+    yield cached.reply
 
-        final_reply = model_manager.call_azure(messages).get("content", "The model did not return a valid response")
+    # Same history as a turn the LLM answered with a tool call
+    yield Blocking(save_turn, (session_id, [{"role": "user", "content": prompt}, *cached.steps,
+                                            {"role": "assistant", "content": cached.reply}]))
 
-        session_manager.add_to_history(session_id, function_call_step)
-    else:
-        # If no tool call is needed, return AI's response directly
-        final_reply = response_data.get("content", "The model did not return a valid response")
+    return cached.reply, cached.steps[0] if len(cached.steps) == 1 else cached.steps
 
-    session_manager.add_to_history(session_id, {"role": "assistant", "content": final_reply})
+
+def _routed_turn(prompt, session_id, route, tool_manager, start):
+    """Answer a turn the intent router recognized by calling the tool directly."""
+    with tracer.span("chat.tools", calls=1, tools=[route.tool_name]):
+        tool_result = (yield UseTools([(route.tool_name, route.arguments)], None))[0]
+    function_call_step = {
+        "role": "function",
+        "name": route.tool_name,
+        "content": f"Tool call result: {tool_manager.render_result(route.tool_name, route.arguments, tool_result)}"
+    }
+    final_reply = intent_router.render(route, tool_result)
+    yield final_reply
+
+    # Same history as a turn the LLM answered with a tool call
+    yield Blocking(save_turn, (session_id, [{"role": "user", "content": prompt}, function_call_step,
+                                            {"role": "assistant", "content": final_reply}]))
+    intent_router.record(True, time.perf_counter() - start)
 
     return final_reply, function_call_step
 
 
-# Flask route
-def chat_stream(response_text):
-    gen_text = ""
-    tok_cnt = 0
-    words = response_text.split()
-
-    for word in words:
-        tok_cnt += 1
-        gen_text += word + " "
-        tok = {
-            "token": {
-                "id": random.randrange(0, 2 ** 32),
-                "text": word,
-                "logprob": 0,
-                "special": False,
-            },
-            "generated_text": None,
-            "details": None
-        }
-        yield f"data:{json.dumps(tok, separators=(',', ':'))}\n\n"
-        time.sleep(0.1)
+def _drive(turn, model_manager, tool_manager):
+    """
+    Run a chat turn, making its upstream calls in the calling thread.
+    A call that fails raises its error in the turn.
+    :return: Generator of text deltas, returning the result of the turn
+    """
+    send, value = turn.send, None
+    try:
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as done:
+                return done.value
+            send, value = turn.send, None
+            try:
+                if isinstance(step, str):
+                    yield step
+                elif isinstance(step, Blocking):
+                    value = step.function(*step.args)
+                elif isinstance(step, UseTools):
+                    if len(step.calls) == 1 and (step.speculation is None or not step.speculation.flights):
+                        function_name, function_args = step.calls[0]
+                        value = [tool_manager.use_tool(function_name, **function_args)]
+                    else:
+                        value = tool_manager.use_tools(step.calls, step.speculation)
+                else:
+                    reply = model_manager.call_azure(step.messages, stream=True, **step.options)
+                    streamed = yield from _relay(reply, step.span, step.messages)
+                    value = reply.result, streamed
+            except Exception as e:
+                send, value = turn.throw, e
+    finally:
+        turn.close()
+
+
+def _relay(reply, span, messages):
+    """
+    Yield the deltas of a streaming reply, noting its time to first token and token counts on the span.
+    :return: The streamed text
+    """
+    start = time.perf_counter()
+    streamed = ""
+    for delta in reply:
+        if not streamed:
+            span.set(first_token_ms=round((time.perf_counter() - start) * 1000, 3))
+        streamed += delta
+        yield delta
+    if span.recording:
+        span.set(prompt_tokens=sum(map(count_message_tokens, messages)), completion_tokens=count_tokens(streamed))
+    return streamed
+
+
+def format_token(text):
+    """
+    Format one streamed chunk as a TGI-style SSE event.
+    :param text: Text of the chunk
+    :return: SSE event string
+    """
+    tok = {
+        "token": {
+            "id": random.randrange(0, 2 ** 32),
+            "text": text,
+            "logprob": 0,
+            "special": False,
+        },
+        "generated_text": None,
+        "details": None
+    }
+    return f"data:{json.dumps(tok, separators=(',', ':'))}\n\n"
+
+
+def format_final_token(gen_text, tok_cnt, trace=None):
+    """
+    Format the closing TGI-style SSE event carrying the full text.
+    :param gen_text: Generated text
+    :param tok_cnt: Number of chunks that were streamed
+    :param trace: Trace of the turn, from Span.details, added to the details when the request asked for it
+    :return: SSE event string
+    """
     final_tok = {
         "token": {
             "id": random.randrange(0, 2 ** 32),
@@ -156,7 +400,26 @@ def chat_stream(response_text):
             "seed": None
         }
     }
-    yield f"data:{json.dumps(final_tok, separators=(',', ':'))}\n\n\n"
+    if trace is not None:
+        final_tok["details"]["trace"] = trace
+    return f"data:{json.dumps(final_tok, separators=(',', ':'))}\n\n\n"
+
+
+# Flask route
+def chat_stream(deltas, trace_id=None):
+    gen_text = ""
+    tok_cnt = 0
+
+    with tracer.span("chat", trace_id=trace_id) as span:
+        sending = 0.0  # Time spent handing events to the server, between a yield and the next delta
+        for delta in deltas:
+            tok_cnt += 1
+            gen_text += delta
+            sent = time.perf_counter()
+            yield format_token(delta)
+            sending += time.perf_counter() - sent
+        tracer.record("chat.sse", sending, events=tok_cnt)
+    yield format_final_token(gen_text, tok_cnt, span.details())
 
 
 @app.route('/chat', methods=['POST'])
@@ -164,11 +427,22 @@ def chat():
     data = request.json
     session_id = data.get('session_id', "root_session")
     prompt = data.get('inputs')
+    # A client that sends a trace header gets the spans of its turn in the final event
+    trace_id = request.headers.get(TRACE_HEADER)
+    if trace_id is not None:
+        trace_id = trace_id or uuid.uuid4().hex
+
+    deltas = handle_chat_stream(prompt, session_id, model_manager, tool_manager)
+
+    headers = {"Content-Type": "text/event-stream"}
+    if trace_id is not None:
+        headers[TRACE_HEADER] = trace_id
+    return Response(chat_stream(deltas, trace_id), content_type='text/event-stream', headers=headers)
 
-    response, _ = handle_chat(prompt, session_id, model_manager, tool_manager)
 
-    return Response(chat_stream(response), content_type='text/event-stream',
-                    headers={"Content-Type": "text/event-stream"})
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(tracer.render_prometheus(), content_type="text/plain; version=0.0.4")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,480 @@
+# session.py
+
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from config import Config
+from tokenizer import count_tokens, count_message_tokens
+
+# Header of the rolling summary that replaces compacted turns
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class SessionManager(abc.ABC):
+    """
+    Interface of a session backend.
+    A turn holds lock(session_id) while it reads the history, calls the model and appends the new
+    messages, so two concurrent requests on one session never interleave.
+    """
+
+    @abc.abstractmethod
+    def create_session(self, session_id):
+        """
+        Create an empty session, if it does not exist yet.
+        :param session_id: Session ID
+        """
+
+    @abc.abstractmethod
+    def add_to_history(self, session_id, message):
+        """
+        Append a message to the history of a session, creating the session and compacting its history as needed.
+        :param session_id: Session ID
+        :param message: Chat message
+        """
+
+    @abc.abstractmethod
+    def get_history(self, session_id):
+        """
+        Get the history of a session.
+        :param session_id: Session ID
+        :return: List of chat messages, empty for an unknown or evicted session
+        """
+
+    @abc.abstractmethod
+    def lock(self, session_id):
+        """
+        Get the lock serializing the turns of a session.
+        :param session_id: Session ID
+        :return: Lock usable with `with`, or through acquire() and release()
+        """
+
+    @abc.abstractmethod
+    def get_metrics(self):
+        """
+        Get session counters.
+        :return: Dictionary with live sessions, retained bytes and tokens, evictions and compactions
+        """
+
+
+class InMemorySessionManager(SessionManager):
+    def __init__(self, max_sessions=Config.SESSION_MAX_SESSIONS, idle_timeout=Config.SESSION_IDLE_TIMEOUT,
+                 token_budget=Config.SESSION_TOKEN_BUDGET, keep_recent=Config.SESSION_KEEP_RECENT,
+                 lock_timeout=Config.SESSION_LOCK_TIMEOUT):
+        """
+        Keep chat history per session in process memory, within memory and prompt-size bounds.
+        :param max_sessions: Number of sessions kept before the least recently used one is evicted
+        :param idle_timeout: Seconds of inactivity before a session is evicted
+        :param token_budget: Tokens of history per session before old turns are compacted
+        :param keep_recent: Number of most recent messages that are never compacted
+        :param lock_timeout: Seconds a turn waits for a busy session
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.lock_timeout = lock_timeout
+        self.sessions = OrderedDict()  # Least recently used first
+        self.session_locks = {}
+        self.mutex = threading.Lock()
+        self.stats = {"evicted_lru": 0, "evicted_idle": 0, "compactions": 0}
+
+    def create_session(self, session_id):
+        with self.mutex:
+            self._create(session_id)
+
+    def add_to_history(self, session_id, message):
+        with self.mutex:
+            session = self._touch(session_id) or self._create(session_id)
+            session["history"].append(message)
+            session["tokens"] += count_message_tokens(message)
+            session["bytes"] += _message_bytes(message)
+            if session["tokens"] > self.token_budget:
+                self.stats["compactions"] += 1
+                session["history"] = compact_history(session["history"], self.token_budget, self.keep_recent)
+                session["tokens"] = sum(count_message_tokens(message) for message in session["history"])
+                session["bytes"] = sum(_message_bytes(message) for message in session["history"])
+
+    def get_history(self, session_id):
+        with self.mutex:
+            session = self._touch(session_id)
+            return list(session["history"]) if session else []
+
+    def lock(self, session_id):
+        with self.mutex:
+            lock = self.session_locks.get(session_id)
+            if lock is None:
+                lock = self.session_locks[session_id] = _ThreadLock(self, session_id)
+            lock.users += 1
+            return lock
+
+    def get_metrics(self):
+        """
+        Get session counters.
+        :return: Dictionary with live sessions, retained bytes and tokens, evictions and compactions
+        """
+        with self.mutex:
+            self._evict_idle(time.monotonic())
+            metrics = dict(self.stats)
+            metrics["live_sessions"] = len(self.sessions)
+            metrics["bytes_retained"] = sum(session["bytes"] for session in self.sessions.values())
+            metrics["tokens_retained"] = sum(session["tokens"] for session in self.sessions.values())
+        return metrics
+
+    def _create(self, session_id):
+        now = time.monotonic()
+        self._evict_idle(now)
+        session = {"history": [], "tokens": 0, "bytes": 0, "last_active": now}
+        self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_sessions:
+            self._evict(next(iter(self.sessions)))
+            self.stats["evicted_lru"] += 1
+        return session
+
+    def _touch(self, session_id):
+        now = time.monotonic()
+        self._evict_idle(now)
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session["last_active"] = now
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def _evict_idle(self, now):
+        # Sessions are ordered by last activity, so idle ones sit at the front
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session["last_active"] < self.idle_timeout:
+                break
+            self._evict(session_id)
+            self.stats["evicted_idle"] += 1
+
+    def _evict(self, session_id):
+        del self.sessions[session_id]
+
+    def _drop_lock(self, lock):
+        # The lock lives as long as a turn holds or waits for it, independently of the session
+        with self.mutex:
+            lock.users -= 1
+            if lock.users == 0:
+                del self.session_locks[lock.session_id]
+
+
+class SQLiteSessionManager(SessionManager):
+    def __init__(self, path=Config.SESSION_DB_PATH, max_sessions=Config.SESSION_MAX_SESSIONS,
+                 idle_timeout=Config.SESSION_IDLE_TIMEOUT, token_budget=Config.SESSION_TOKEN_BUDGET,
+                 keep_recent=Config.SESSION_KEEP_RECENT, lock_timeout=Config.SESSION_LOCK_TIMEOUT,
+                 lock_lease=Config.SESSION_LOCK_LEASE):
+        """
+        Keep chat history in a SQLite database in WAL mode, shared by all worker processes on a host.
+        Compaction appends the compacted history, moves the session's base pointer past the old rows
+        and deletes them, all in one transaction, so readers see either the old or the new history.
+        :param path: Database file
+        :param max_sessions: Number of sessions kept before the least recently used ones are evicted
+        :param idle_timeout: Seconds of inactivity before a session is evicted
+        :param token_budget: Tokens of history per session before old turns are compacted
+        :param keep_recent: Number of most recent messages that are never compacted
+        :param lock_timeout: Seconds a turn waits for a busy session
+        :param lock_lease: Seconds after which a lock left by a crashed worker expires
+        """
+        self.path = path
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.lock_timeout = lock_timeout
+        self.lock_lease = lock_lease
+        self.local = threading.local()
+        self.last_sweep = 0.0
+        self.stats = {"evicted_lru": 0, "evicted_idle": 0, "compactions": 0}
+        self.stats_lock = threading.Lock()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                last_active REAL NOT NULL,
+                base_seq INTEGER NOT NULL DEFAULT 0,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_session ON messages (session_id, seq);
+            CREATE INDEX IF NOT EXISTS sessions_by_activity ON sessions (last_active);
+            CREATE TABLE IF NOT EXISTS session_locks (
+                session_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """)
+
+    def create_session(self, session_id):
+        with self._write() as connection:
+            connection.execute("INSERT OR IGNORE INTO sessions (session_id, last_active) VALUES (?, ?)",
+                               (session_id, time.time()))
+        self._sweep()
+
+    def add_to_history(self, session_id, message):
+        tokens = count_message_tokens(message)
+        size = _message_bytes(message)
+        with self._write() as connection:
+            connection.execute(
+                "INSERT INTO sessions (session_id, last_active, tokens, bytes) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET last_active = excluded.last_active, "
+                "tokens = tokens + excluded.tokens, bytes = bytes + excluded.bytes",
+                (session_id, time.time(), tokens, size))
+            connection.execute("INSERT INTO messages (session_id, message, tokens, bytes) VALUES (?, ?, ?, ?)",
+                               (session_id, json.dumps(message), tokens, size))
+            total, = connection.execute("SELECT tokens FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if total > self.token_budget:
+                self._compact(connection, session_id)
+        self._sweep()
+
+    def get_history(self, session_id):
+        rows = self._connection().execute(
+            "SELECT m.message FROM messages m JOIN sessions s ON s.session_id = m.session_id "
+            "WHERE m.session_id = ? AND m.seq >= s.base_seq ORDER BY m.seq", (session_id,)).fetchall()
+        return [json.loads(message) for message, in rows]
+
+    def lock(self, session_id):
+        return _SQLiteLock(self, session_id)
+
+    def get_metrics(self):
+        """
+        Get session counters. Eviction and compaction counts are for this process only.
+        :return: Dictionary with live sessions, retained bytes and tokens, evictions and compactions
+        """
+        live, size, tokens = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(tokens), 0) FROM sessions").fetchone()
+        with self.stats_lock:
+            metrics = dict(self.stats)
+        metrics.update({"live_sessions": live, "bytes_retained": size, "tokens_retained": tokens})
+        return metrics
+
+    def _compact(self, connection, session_id):
+        rows = connection.execute(
+            "SELECT m.message FROM messages m JOIN sessions s ON s.session_id = m.session_id "
+            "WHERE m.session_id = ? AND m.seq >= s.base_seq ORDER BY m.seq", (session_id,)).fetchall()
+        history = compact_history([json.loads(message) for message, in rows], self.token_budget, self.keep_recent)
+        # AUTOINCREMENT keeps new rows above every existing one
+        base_seq, = connection.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM messages").fetchone()
+        for message in history:
+            connection.execute(
+                "INSERT INTO messages (session_id, message, tokens, bytes) VALUES (?, ?, ?, ?)",
+                (session_id, json.dumps(message), count_message_tokens(message), _message_bytes(message)))
+        connection.execute(
+            "UPDATE sessions SET base_seq = ?, tokens = ?, bytes = ? WHERE session_id = ?",
+            (base_seq, sum(count_message_tokens(message) for message in history),
+             sum(_message_bytes(message) for message in history), session_id))
+        # Rows before the base pointer are no longer readable
+        connection.execute("DELETE FROM messages WHERE session_id = ? AND seq < ?", (session_id, base_seq))
+        with self.stats_lock:
+            self.stats["compactions"] += 1
+
+    def _sweep(self):
+        """Evict idle and least recently used sessions, at most once per SESSION_SWEEP_INTERVAL."""
+        now = time.time()
+        if now - self.last_sweep < Config.SESSION_SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        with self._write() as connection:
+            idle = [session_id for session_id, in connection.execute(
+                "SELECT session_id FROM sessions WHERE last_active < ?", (now - self.idle_timeout,))]
+            overflow = [session_id for session_id, in connection.execute(
+                "SELECT session_id FROM sessions WHERE last_active >= ? ORDER BY last_active DESC LIMIT -1 OFFSET ?",
+                (now - self.idle_timeout, self.max_sessions))]
+            for session_id in idle + overflow:
+                connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        with self.stats_lock:
+            self.stats["evicted_idle"] += len(idle)
+            self.stats["evicted_lru"] += len(overflow)
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def _write(self):
+        return _Transaction(self._connection())
+
+
+class _ThreadLock:
+    """
+    Lock of an in-memory session, shared by the turns that got it from lock().
+    Each of them either fails to acquire it or releases it, and the last one drops it from the manager.
+    """
+
+    def __init__(self, manager, session_id):
+        self.manager = manager
+        self.session_id = session_id
+        self.users = 0  # Turns that got the lock and have not released it or given up on it yet
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._lock.acquire(timeout=self.manager.lock_timeout):
+            self.manager._drop_lock(self)
+            raise ValueError(f"Session {self.session_id} is busy with another request.")
+
+    def release(self):
+        self._lock.release()
+        self.manager._drop_lock(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _SQLiteLock:
+    """
+    Lease-based lock row, visible to every process sharing the database.
+    While held, a heartbeat thread renews the lease, so only the locks of crashed workers expire.
+    """
+
+    def __init__(self, manager, session_id):
+        self.manager = manager
+        self.session_id = session_id
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.released = None  # Event stopping the heartbeat of the held lock
+
+    def acquire(self):
+        deadline = time.monotonic() + self.manager.lock_timeout
+        delay = 0.005
+        while True:
+            now = time.time()
+            with self.manager._write() as connection:
+                connection.execute("DELETE FROM session_locks WHERE session_id = ? AND expires_at < ?",
+                                   (self.session_id, now))
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO session_locks (session_id, owner, expires_at) VALUES (?, ?, ?)",
+                    (self.session_id, self.owner, now + self.manager.lock_lease))
+            if cursor.rowcount == 1:
+                self.released = threading.Event()
+                threading.Thread(target=self._heartbeat, args=(self.released,), daemon=True).start()
+                return
+            if time.monotonic() > deadline:
+                raise ValueError(f"Session {self.session_id} is busy with another request.")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def release(self):
+        self.released.set()
+        with self.manager._write() as connection:
+            connection.execute("DELETE FROM session_locks WHERE session_id = ? AND owner = ?",
+                               (self.session_id, self.owner))
+
+    def _heartbeat(self, released):
+        lease = self.manager.lock_lease
+        while not released.wait(lease / 3):
+            try:
+                with self.manager._write() as connection:
+                    cursor = connection.execute(
+                        "UPDATE session_locks SET expires_at = ? WHERE session_id = ? AND owner = ?",
+                        (time.time() + lease, self.session_id, self.owner))
+            except sqlite3.Error as e:
+                print(f"Could not renew the lock of session {self.session_id}: {e}")
+                continue
+            if cursor.rowcount == 0 and not released.is_set():
+                print(f"Session {self.session_id} lost its lock")
+                return
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE transaction that commits on success and rolls back on error."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, *exc):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def create_session_manager(backend=Config.SESSION_BACKEND):
+    """
+    Create the configured session backend.
+    :param backend: "memory" or "sqlite"
+    :return: SessionManager
+    """
+    if backend == "memory":
+        return InMemorySessionManager()
+    if backend == "sqlite":
+        return SQLiteSessionManager()
+    raise ValueError(f"Unknown session backend {backend}")
+
+
+def compact_history(history, token_budget, keep_recent):
+    """
+    Shrink a history below its token budget, oldest turns first.
+    Tool outputs of older turns are dropped, then the oldest turns are folded into a rolling summary.
+    :param history: List of chat messages, possibly starting with an earlier summary
+    :param token_budget: Tokens of history to stay under
+    :param keep_recent: Number of most recent messages that are kept as they are
+    :return: Compacted list of chat messages
+    """
+    history = list(history)
+    summary = history.pop(0)["content"] if history and _is_summary(history[0]) else None
+    split = max(len(history) - keep_recent, 0)
+    old, recent = history[:split], history[split:]
+
+    # First drop the bulky tool outputs of older turns
+    old = [dict(message, content=f"Tool call result omitted ({message.get('name')})")
+           if message.get("role") == "function" else message for message in old]
+
+    # Then fold the oldest turns into a rolling summary until the rest fits
+    lines = summary[len(SUMMARY_PREFIX):].split("\n") if summary else []
+    tokens = sum(count_message_tokens(message) for message in old + recent)
+    while old and tokens > token_budget // 2:
+        message = old.pop(0)
+        tokens -= count_message_tokens(message)
+        if message.get("role") in ("user", "assistant"):
+            lines.append(f"{message['role']}: {_shorten(str(message['content']), 200)}")
+    # Keep the summary itself within a quarter of the budget
+    while lines and count_tokens("\n".join(lines)) > token_budget // 4:
+        lines.pop(0)
+
+    history = old + recent
+    if lines:
+        history.insert(0, {"role": "system", "content": SUMMARY_PREFIX + "\n".join(lines)})
+    return history
+
+
+def _is_summary(message):
+    return message.get("role") == "system" and str(message.get("content")).startswith(SUMMARY_PREFIX)
+
+
+def _message_bytes(message):
+    return len(str(message.get("content") or "").encode())
+
+
+def _shorten(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
@@ -0,0 +1,320 @@
+# stub_binance.py
+#
+# Local stand-in for the Binance REST API. It mimics the endpoints used by tool.py,
+# the X-MBX-USED-WEIGHT / X-MBX-ORDER-COUNT headers and 429/418 throttling, so the
+# client and scheduler can be exercised without touching the real exchange. Account
+# changes are also published as user-data-stream events through user_data_stream().
+#
+# Usage: python stub_binance.py --port 8081, then set Config.BINANCE_BASE_URL.
+
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import queue
+import random
+import threading
+import time
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from client import ENDPOINT_WEIGHTS, DEFAULT_WEIGHT, ORDER_ENDPOINTS, endpoint_key
+from kline import INTERVAL_MS
+
+
+class StubBinance:
+    def __init__(self, host="127.0.0.1", port=0, weight_limit=6000, order_limit=50, latency=0.0,
+                 secret_key=None, prices=None, balances=None, listed_at=1_502_928_000_000):
+        """
+        Stub Binance server.
+        :param host: Host to bind
+        :param port: Port to bind, 0 picks a free one
+        :param weight_limit: Request weight allowed per minute
+        :param order_limit: Orders allowed per 10 seconds
+        :param latency: Seconds added to every response
+        :param secret_key: Verify signatures with this key when given
+        :param prices: Dictionary of symbol -> price
+        :param balances: Dictionary of asset -> free balance
+        :param listed_at: Milliseconds since the epoch of the first candle of every symbol
+        """
+        self.weight_limit = weight_limit
+        self.order_limit = order_limit
+        self.latency = latency
+        self.secret_key = secret_key
+        self.prices = prices or {"BTCUSDT": "83271.73000000", "ETHUSDT": "1912.45000000",
+                                 "SOLUSDT": "127.31000000", "BNBUSDT": "593.20000000"}
+        self.balances = balances or {"BTC": "0.50000000", "ETH": "2.00000000", "USDT": "1000.00000000"}
+        self.orders = {}  # orderId -> order
+        self.trades = []
+        self.order_ids = itertools.count(1)
+        self.request_log = []  # (method, endpoint key, status)
+        self.subscribers = []  # Queues of user_data_stream() readers
+        self.listed_at = listed_at
+
+        self.lock = threading.Lock()
+        self.weight_window = None
+        self.used_weight = 0
+        self.order_window = None
+        self.order_count = 0
+        self.banned_until = 0.0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.handle(self, "GET")
+
+            def do_POST(self):
+                stub.handle(self, "POST")
+
+            def do_DELETE(self):
+                stub.handle(self, "DELETE")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serve in a background thread.
+        :return: Base URL of the stub
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for subscriber in list(self.subscribers):
+            subscriber.put(None)
+
+    def user_data_stream(self):
+        """
+        Follow account changes the way the Binance user data stream reports them.
+        :return: Blocking iterator of outboundAccountPosition, balanceUpdate and executionReport events,
+                 ending when the stub stops
+        """
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+        def events():
+            while True:
+                event = subscriber.get()
+                if event is None:
+                    return
+                yield event
+
+        return events()
+
+    def deposit(self, asset, amount):
+        """
+        Credit an asset, as a deposit or transfer would, and publish a balanceUpdate event.
+        :param asset: Asset, e.g., USDT
+        :param amount: Amount as a string, negative for a withdrawal
+        """
+        with self.lock:
+            self.balances[asset] = f"{Decimal(self.balances.get(asset, '0')) + Decimal(amount):.8f}"
+            self._publish({"e": "balanceUpdate", "a": asset, "d": amount})
+
+    def _publish(self, event):
+        event = dict(event, E=int(time.time() * 1000))
+        for subscriber in self.subscribers:
+            subscriber.put(event)
+
+    def handle(self, handler, method):
+        parsed = urlparse(handler.path)
+        params = dict(parse_qsl(parsed.query))
+        key = endpoint_key(method, parsed.path, params)
+        if self.latency:
+            time.sleep(self.latency)
+
+        headers = {}
+        with self.lock:
+            now = time.time()
+            if now < self.banned_until:
+                # Requests sent while a Retry-After is pending turn the warning into an IP ban
+                self.banned_until = now + 120
+                status, body = 418, {"code": -1003, "msg": "Way too many requests; IP banned."}
+                headers["Retry-After"] = "120"
+            else:
+                status, body = self._account(key, now, headers)
+            headers["X-MBX-USED-WEIGHT"] = str(self.used_weight)
+            headers["X-MBX-USED-WEIGHT-1M"] = str(self.used_weight)
+            if key in ORDER_ENDPOINTS:
+                headers["X-MBX-ORDER-COUNT-10S"] = str(self.order_count)
+            if status == 200:
+                if "signature" in params and not self._signature_ok(parsed.query):
+                    status, body = 400, {"code": -1022, "msg": "Signature for this request is not valid."}
+                else:
+                    status, body = self._route(method, parsed.path, params)
+            self.request_log.append((method, key, status))
+
+        payload = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _account(self, key, now, headers):
+        minute = int(now // 60)
+        if minute != self.weight_window:
+            self.weight_window, self.used_weight = minute, 0
+        window = int(now // 10)
+        if window != self.order_window:
+            self.order_window, self.order_count = window, 0
+
+        self.used_weight += ENDPOINT_WEIGHTS.get(key, DEFAULT_WEIGHT)
+        if self.used_weight > self.weight_limit:
+            retry_after = int(60 - now % 60) + 1
+            self.banned_until = now + retry_after
+            headers["Retry-After"] = str(retry_after)
+            return 429, {"code": -1003, "msg": "Too many requests; current limit of IP is exceeded."}
+        if key in ORDER_ENDPOINTS:
+            self.order_count += 1
+            if self.order_count > self.order_limit:
+                headers["Retry-After"] = str(int(10 - now % 10) + 1)
+                return 429, {"code": -1015, "msg": "Too many new orders."}
+        return 200, None
+
+    def _signature_ok(self, query):
+        if self.secret_key is None:
+            return True
+        payload, _, signature = query.rpartition("&signature=")
+        expected = hmac.new(self.secret_key.encode(), payload.encode(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
+    def _route(self, method, path, params):
+        if path == "/api/v3/time":
+            return 200, {"serverTime": int(time.time() * 1000)}
+        if path == "/api/v3/ticker/price":
+            if "symbol" in params:
+                if params["symbol"] not in self.prices:
+                    return 400, {"code": -1121, "msg": "Invalid symbol."}
+                return 200, {"symbol": params["symbol"], "price": self.prices[params["symbol"]]}
+            return 200, [{"symbol": symbol, "price": price} for symbol, price in self.prices.items()]
+        if path == "/api/v3/klines":
+            return self._klines(params)
+        if path == "/api/v3/account":
+            return 200, {"updateTime": int(time.time() * 1000),
+                         "balances": [{"asset": asset, "free": free, "locked": "0.00000000"}
+                                      for asset, free in self.balances.items()]}
+        if path == "/api/v3/myTrades":
+            trades = [trade for trade in self.trades if trade["symbol"] == params.get("symbol")]
+            limit = min(int(params.get("limit", 500)), 1000)
+            if "fromId" in params:
+                return 200, [trade for trade in trades if trade["id"] >= int(params["fromId"])][:limit]
+            return 200, trades[-limit:]
+        if path == "/api/v3/openOrders":
+            return 200, [order for order in self.orders.values()
+                         if "symbol" not in params or order["symbol"] == params["symbol"]]
+        if path == "/api/v3/order" and method == "POST":
+            return self._place_order(params)
+        if path == "/api/v3/order" and method == "DELETE":
+            order = self.orders.pop(int(params.get("orderId", 0)), None)
+            if order is None:
+                return 400, {"code": -2011, "msg": "Unknown order sent."}
+            order = dict(order, status="CANCELED")
+            self._publish_order(order)
+            return 200, order
+        return 404, {"code": -1000, "msg": f"Unknown endpoint {method} {path}"}
+
+    def _klines(self, params):
+        """Synthetic candles: a deterministic function of the symbol and open time, so refetches agree."""
+        symbol, step = params.get("symbol"), INTERVAL_MS.get(params.get("interval"))
+        if symbol not in self.prices:
+            return 400, {"code": -1121, "msg": "Invalid symbol."}
+        if step is None:
+            return 400, {"code": -1120, "msg": "Invalid interval."}
+        limit = min(int(params.get("limit", 500)), 1000)
+        now = int(time.time() * 1000)
+        first = -(-self.listed_at // step) * step
+        last = min(int(params.get("endTime", now)), now) // step * step
+        if "startTime" in params:
+            start = max(-(-int(params["startTime"]) // step) * step, first)
+            times = range(start, min(last, start + (limit - 1) * step) + 1, step)
+        else:
+            times = range(max(first, last - (limit - 1) * step), last + 1, step)
+
+        def price(moment):
+            # Slow and fast cycles around the ticker price, plus noise
+            days = moment / 86_400_000
+            noise = random.Random(f"{symbol}{moment}").gauss(0, 0.002)
+            return float(self.prices[symbol]) * math.exp(0.3 * math.sin(days / 60) + 0.02 * math.sin(days * 6) + noise)
+
+        rows = []
+        for open_time in times:
+            open_price, close_price = price(open_time), price(open_time + step)
+            volume = random.Random(f"{symbol}{open_time}volume").uniform(1, 100) * step / 60_000
+            rows.append([open_time, f"{open_price:.8f}", f"{max(open_price, close_price) * 1.001:.8f}",
+                         f"{min(open_price, close_price) * 0.999:.8f}", f"{close_price:.8f}", f"{volume:.8f}",
+                         open_time + step - 1, f"{volume * (open_price + close_price) / 2:.8f}", int(volume) + 1,
+                         "0", "0", "0"])
+        return 200, rows
+
+    def _place_order(self, params):
+        symbol = params.get("symbol")
+        if symbol not in self.prices:
+            return 400, {"code": -1121, "msg": "Invalid symbol."}
+        order_id = next(self.order_ids)
+        order = {"symbol": symbol, "orderId": order_id, "side": params.get("side"), "type": params.get("type"),
+                 "origQty": params.get("quantity"), "price": params.get("price", "0.00000000"),
+                 "status": "FILLED" if params.get("type") == "MARKET" else "NEW"}
+        if order["status"] == "NEW":
+            self.orders[order_id] = order
+        else:
+            price, quantity = Decimal(self.prices[symbol]), Decimal(order["origQty"])
+            self.trades.append({"symbol": symbol, "id": len(self.trades) + 1, "orderId": order_id,
+                                "price": self.prices[symbol], "qty": order["origQty"],
+                                "quoteQty": f"{price * quantity:.8f}", "commission": f"{price * quantity / 1000:.8f}",
+                                "commissionAsset": "USDT", "time": int(time.time() * 1000),
+                                "isBuyer": order["side"] == "BUY", "isMaker": False, "side": order["side"]})
+            self._settle(symbol, order["side"], Decimal(order["origQty"]), Decimal(self.prices[symbol]))
+        self._publish_order(order)
+        return 200, order
+
+    def _settle(self, symbol, side, quantity, price):
+        """Move the balances of a filled market order and publish the new positions."""
+        quote = next((quote for quote in ("USDT", "USDC", "BTC", "ETH", "BNB") if symbol.endswith(quote)), None)
+        if quote is None:
+            return
+        base = symbol[:-len(quote)]
+        sign = 1 if side == "BUY" else -1
+        changes = {base: sign * quantity, quote: -sign * quantity * price}
+        for asset, change in changes.items():
+            self.balances[asset] = f"{Decimal(self.balances.get(asset, '0')) + change:.8f}"
+        self._publish({"e": "outboundAccountPosition",
+                       "B": [{"a": asset, "f": self.balances[asset], "l": "0.00000000"} for asset in changes]})
+
+    def _publish_order(self, order):
+        self._publish({"e": "executionReport", "s": order["symbol"], "i": order["orderId"], "S": order["side"],
+                       "o": order["type"], "q": order["origQty"], "p": order["price"], "X": order["status"]})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stub of the Binance REST API.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--weight-limit", type=int, default=6000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = StubBinance(port=args.port, weight_limit=args.weight_limit, latency=args.latency)
+    print(f"Stub Binance listening on {stub.url}")
+    stub.server.serve_forever()
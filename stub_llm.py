@@ -0,0 +1,228 @@
+# stub_llm.py
+#
+# Local stand-in for the OpenAI and Azure OpenAI chat completions API, for load tests. A prompt that
+# names an asset is answered with the tool call the service expects, and the tool results that come
+# back are answered with a short summary. Replies are streamed as SSE chunks after a configurable
+# time to first token, so the service can be measured end to end without a real model.
+#
+# Usage: python stub_llm.py --port 8082 --first-token 0.3, then set Config.AZURE_ENDPOINT and
+# Config.OPENAI_BASE_URL.
+
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ASSETS = ("BTC", "ETH", "SOL", "BNB")
+_ASSET = re.compile(r"\b(" + "|".join(ASSETS) + r")(?:USDT)?\b", re.IGNORECASE)
+_ORDER_ID = re.compile(r"\b(\d{6,})\b")
+
+
+class StubLLM:
+    def __init__(self, host="127.0.0.1", port=0, first_token=0.3, chunk_delay=0.02, chunk_size=4):
+        """
+        Stub chat completions server.
+        :param host: Host to bind
+        :param port: Port to bind, 0 picks a free one
+        :param first_token: Seconds before the first chunk, or before a non-streamed reply
+        :param chunk_delay: Seconds between streamed chunks
+        :param chunk_size: Characters per streamed chunk
+        """
+        self.first_token = first_token
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.completion_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "tool_calls": 0, "chunks": 0, "active": 0, "max_active": 0}
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionResetError:
+                    pass  # A pooled client connection closed while idle
+
+            def do_POST(self):
+                stub.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serve in a background thread.
+        :return: Base URL of the stub
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self):
+        """
+        Get request counters.
+        :return: Dictionary with requests, tool calls answered, chunks streamed and the peak concurrency
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    def handle(self, handler):
+        body = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))) or b"{}")
+        if not handler.path.split("?")[0].endswith("/chat/completions"):
+            self._send_json(handler, 404, {"error": {"message": "Not found"}})
+            return
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["active"] += 1
+            self.stats["max_active"] = max(self.stats["max_active"], self.stats["active"])
+        try:
+            content, tool_calls = self.reply(body)
+            with self.lock:
+                self.stats["tool_calls"] += len(tool_calls)
+            time.sleep(self.first_token)
+            if body.get("stream"):
+                self._stream(handler, body, content, tool_calls)
+            else:
+                message = {"role": "assistant", "content": content}
+                if tool_calls:
+                    message["tool_calls"] = [{"id": f"call_{index}", "type": "function",
+                                              "function": {"name": name, "arguments": arguments}}
+                                             for index, (name, arguments) in enumerate(tool_calls)]
+                self._send_json(handler, 200, self._completion(body, {"message": message}, "chat.completion"))
+        finally:
+            with self.lock:
+                self.stats["active"] -= 1
+
+    def reply(self, body):
+        """
+        Decide the reply to a chat completions request.
+        :param body: Request body
+        :return: Tuple of (content text, list of native (tool name, JSON arguments) calls)
+        """
+        messages = body.get("messages") or [{"role": "user", "content": ""}]
+        system = messages[0].get("content", "") if messages[0].get("role") == "system" else ""
+        last = messages[-1]
+        native = bool(body.get("tools"))
+        in_json = bool(body.get("response_format")) or "JSON" in system
+
+        if last.get("role") in ("function", "tool"):
+            # Follow-up: summarize the tool results of this turn
+            results = []
+            for message in reversed(messages):
+                if message.get("role") not in ("function", "tool"):
+                    break
+                results.append(message.get("content", "").removeprefix("Tool call result: ").split("\n")[0])
+            text = "Here is what I found: " + "; ".join(reversed(results))
+            return (json.dumps({"content": text}) if in_json else text), []
+
+        calls = _guess_calls(last.get("content") or "")
+        if not calls:
+            text = "I can look up prices, balances, open orders and trades on Binance."
+            return (json.dumps({"content": text}) if in_json else text), []
+        if native:
+            return "", [(name, json.dumps(arguments)) for name, arguments in calls]
+        function_call = [{"name": name, "arguments": json.dumps(arguments)} for name, arguments in calls]
+        return json.dumps({"function_call": function_call[0] if len(function_call) == 1 else function_call,
+                           "content": "Let me check."}), []
+
+    def _stream(self, handler, body, content, tool_calls):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        deltas = [{"role": "assistant", "content": content[start:start + self.chunk_size]}
+                  for start in range(0, len(content), self.chunk_size)]
+        for index, (name, arguments) in enumerate(tool_calls):
+            deltas.append({"tool_calls": [{"index": index, "id": f"call_{index}", "type": "function",
+                                           "function": {"name": name, "arguments": ""}}]})
+            deltas.extend({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + 8]}}]}
+                          for start in range(0, len(arguments), 8))
+        try:
+            for index, delta in enumerate(deltas):
+                if index:
+                    time.sleep(self.chunk_delay)
+                choice = {"index": 0, "delta": delta, "finish_reason": None}
+                self._write_event(handler, self._completion(body, choice, "chat.completion.chunk"))
+            finish = {"index": 0, "delta": {}, "finish_reason": "tool_calls" if tool_calls else "stop"}
+            self._write_event(handler, self._completion(body, finish, "chat.completion.chunk"))
+            self._write_chunk(handler, b"data: [DONE]\n\n")
+            self._write_chunk(handler, b"")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client stopped reading, e.g. a hedged request that lost
+        with self.lock:
+            self.stats["chunks"] += len(deltas)
+
+    def _completion(self, body, choice, kind):
+        if kind == "chat.completion":
+            choice = dict(choice, index=0, finish_reason="tool_calls" if "tool_calls" in choice["message"] else "stop")
+        return {"id": f"chatcmpl-{next(self.completion_ids)}", "object": kind, "created": int(time.time()),
+                "model": body.get("model", "stub"), "choices": [choice]}
+
+    def _write_event(self, handler, event):
+        self._write_chunk(handler, f"data: {json.dumps(event)}\n\n".encode())
+
+    @staticmethod
+    def _write_chunk(handler, data):
+        handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        handler.wfile.flush()
+
+    @staticmethod
+    def _send_json(handler, status, payload):
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def _guess_calls(prompt):
+    """The tool calls a model would answer a prompt with, from the assets and keywords in it."""
+    lowered = prompt.lower()
+    assets = list(dict.fromkeys(match.upper() for match in _ASSET.findall(prompt)))
+    if "balance" in lowered:
+        return [("get_account_balance", {"asset": asset}) for asset in assets or ["USDT"]]
+    if not assets:
+        return []
+    symbols = [f"{asset}USDT" for asset in assets]
+    order_id = _ORDER_ID.search(prompt)
+    if "cancel" in lowered and order_id:
+        return [("cancel_order", {"symbol": symbols[0], "order_id": order_id.group(1)})]
+    if "open order" in lowered:
+        return [("get_open_orders", {"symbol": symbol}) for symbol in symbols]
+    if "trade" in lowered or "history" in lowered:
+        return [("get_trade_history", {"symbol": symbol, "limit": 5}) for symbol in symbols]
+    if "candle" in lowered or "week" in lowered:
+        return [("get_klines", {"symbol": symbol, "interval": "1d", "limit": 7}) for symbol in symbols]
+    return [("get_symbol_price", {"symbol": symbol}) for symbol in symbols]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stub of the OpenAI chat completions API.")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--first-token", type=float, default=0.3, help="Seconds before the first chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Seconds between chunks")
+    args = parser.parse_args()
+
+    stub = StubLLM(port=args.port, first_token=args.first_token, chunk_delay=args.chunk_delay)
+    print(f"Stub LLM listening on {stub.url}")
+    stub.server.serve_forever()
@@ -1,5 +1,37 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pytest
 import requests
 
+import async_service
+import service
+import tool
+from account import AccountState
+from benchmarks.startup import measure
+from client import PRIORITY_QUERY, BinanceClient, RateLimited, RequestScheduler
+from config import Config
+from grammar import ReplyGrammar
+from history import PAGE_SIZE, TradeHistory
+from kline import CANDLE, KlineStore, ema, rsi
+from model import AsyncReplyStream, ModelManager, ReplyStream, StreamingReplyParser, parse_reply
+from response_cache import ResponseCache
+from router import IntentRouter
+from service import build_messages, handle_chat_stream, session_manager
+from session import SUMMARY_PREFIX, InMemorySessionManager, SessionManager, SQLiteSessionManager, compact_history
+from stub_binance import StubBinance
+from tool import ToolManager, tool_manager
+from tracing import NO_SPAN, Tracer
+
 # Flask service URL
 BASE_URL = "http://127.0.0.1:5000"  # Default Flask runs on local port 5000
 
@@ -9,19 +41,927 @@ def chat(session_id, prompt):
     Call the /chat endpoint to interact with AI.
     :param session_id: Session ID
     :param prompt: User input
-    :return: AI response
+    :return: AI response, the generated_text of the final SSE event
     """
     url = f"{BASE_URL}/chat"
     headers = {"Content-Type": "application/json"}
     data = {
         "session_id": session_id,
-        "prompt": prompt
+        "inputs": prompt
     }
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    response = requests.post(url, headers=headers, json=data, stream=True)
+    if response.status_code != 200:
         return f"Error: {response.status_code}, {response.text}"
+    for line in response.iter_lines():
+        if line.startswith(b"data:"):
+            event = json.loads(line[len(b"data:"):])
+            if event["token"]["special"]:
+                return event["generated_text"]
+    return ""
+
+
+def test_system_prompt_is_stable():
+    """
+    The system prompt must be the first message and byte-identical across turns, so the
+    provider can reuse the cached prompt prefix. Run with: python -m pytest test.py
+    """
+    session_id = "prompt_stability_session"
+    first = build_messages("What is the current price of BTC?", session_id, tool_manager)
+    session_manager.add_to_history(session_id, {"role": "user", "content": "What is the current price of BTC?"})
+    session_manager.add_to_history(session_id, {"role": "assistant", "content": "BTC is 83271.73 USDT."})
+    second = build_messages("And ETH?", session_id, tool_manager)
+
+    assert first[0]["role"] == "system"
+    assert first[0]["content"].encode() == second[0]["content"].encode()
+    assert "get_symbol_price" in first[0]["content"]
+    assert second[1:] == [
+        {"role": "user", "content": "What is the current price of BTC?"},
+        {"role": "assistant", "content": "BTC is 83271.73 USDT."},
+        {"role": "user", "content": "And ETH?"},
+    ]
+
+
+def test_system_prompt_changes_when_a_tool_is_registered():
+    manager = ToolManager()
+    manager.register_tool("get_time", lambda: "now", "Get the time.", {"type": "object", "properties": {}})
+    before = manager.get_system_prompt()
+    assert manager.get_system_prompt() is before
+
+    manager.register_tool("get_date", lambda: "today", "Get the date.", {"type": "object", "properties": {}})
+    assert manager.get_system_prompt() != before
+    assert "get_date" in manager.get_system_prompt()
+
+
+class FakeTickers:
+    """Answers ticker price requests the way Binance does, slowly enough for lookups to overlap."""
+
+    prices = {"BTCUSDT": "83271.73000000", "ETHUSDT": "1912.45000000", "SOLUSDT": "127.31000000"}
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.calls = []
+
+    def request(self, method, path, params=None, signed=False):
+        symbol = (params or {}).get("symbol")
+        self.calls.append(symbol or "*")
+        time.sleep(self.latency)
+        if symbol is None:
+            return self._response(200, [{"symbol": s, "price": p} for s, p in self.prices.items()])
+        if symbol not in self.prices:
+            return self._response(400, {"code": -1121, "msg": "Invalid symbol."})
+        return self._response(200, {"symbol": symbol, "price": self.prices[symbol]})
+
+    @staticmethod
+    def _response(status_code, body):
+        return SimpleNamespace(status_code=status_code, json=lambda: body, text=json.dumps(body))
+
+
+def test_market_data_cache_serves_fresh_quotes_and_coalesces_misses(monkeypatch):
+    tickers = FakeTickers()
+    monkeypatch.setattr(tool, "binance_client", tickers)
+    cache = tool.MarketDataCache(ttl=0.5)
+    prices = []
+    threads = [threading.Thread(target=lambda: prices.append(cache.get_price("BTCUSDT"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert prices == ["83271.73000000"] * 8
+    assert tickers.calls == ["BTCUSDT"] and cache.get_stats()["coalesced"] == 7  # One request for all eight
+
+    assert cache.get_price("BTCUSDT") == "83271.73000000" and len(tickers.calls) == 1
+    time.sleep(0.5)
+    cache.get_price("BTCUSDT")
+    assert len(tickers.calls) == 2 and cache.get_stats()["stale"] == 1
+    with pytest.raises(ValueError):
+        cache.get_price("FOOUSDT")
+
+    bulk = tool.MarketDataCache(ttl=60, bulk_refresh=True)
+    assert bulk.get_price("ETHUSDT") == "1912.45000000" and bulk.get_price("SOLUSDT") == "127.31000000"
+    assert tickers.calls[-1] == "*" and len(tickers.calls) == 4
+
+
+class FakeBinance(BaseHTTPRequestHandler):
+    """Serves server time and a signed account endpoint over HTTP/1.1 keep-alive."""
+
+    protocol_version = "HTTP/1.1"
+    secret_key = b"secret"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.server.request_log.append((self.client_address, url.path))
+        if url.path == "/api/v3/time":
+            status, body = 200, {"serverTime": int(time.time() * 1000)}
+        else:
+            payload, _, signature = url.query.rpartition("&signature=")
+            expected = hmac.new(self.secret_key, payload.encode(), hashlib.sha256).hexdigest()
+            if "timestamp" not in dict(parse_qsl(payload)) or not hmac.compare_digest(expected, signature):
+                status, body = 400, {"code": -1022, "msg": "Signature for this request is not valid."}
+            else:
+                status, body = 200, {"balances": []}
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_binance_client_signs_requests_over_pooled_connections(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBinance)
+    server.request_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    client = BinanceClient(secret_key="secret", base_url=url)
+    try:
+        assert client.sign("symbol=BTCUSDT") == hmac.new(b"secret", b"symbol=BTCUSDT", hashlib.sha256).hexdigest()
+        for _ in range(5):
+            assert client.request("GET", "/api/v3/account", signed=True).status_code == 200
+        # The time sync and all five calls went over one keep-alive connection
+        assert len(server.request_log) == 6 and len({address for address, _ in server.request_log}) == 1
+        assert BinanceClient(secret_key="other", base_url=url).request(
+            "GET", "/api/v3/account", signed=True).json()["code"] == -1022
+
+        # A timestamp Binance rejects resyncs the clock and retries once
+        rejected = []
+        send = client.session.request
+
+        def reject_once(method, url, **kwargs):
+            if "timestamp=" in url and not rejected:
+                rejected.append(url)
+                response = requests.Response()
+                response.status_code, response._content = 400, b'{"code": -1021, "msg": "Timestamp outside"}'
+                return response
+            return send(method, url, **kwargs)
+
+        monkeypatch.setattr(client.session, "request", reject_once)
+        syncs = [path for _, path in server.request_log].count("/api/v3/time")
+        assert client.request("GET", "/api/v3/account", signed=True).status_code == 200
+        assert len(rejected) == 1 and [path for _, path in server.request_log].count("/api/v3/time") == syncs + 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_asgi_chat_streams_sse_events(monkeypatch):
+    class Model:
+        async def acall_azure(self, messages, stream=False, **options):
+            async def deltas():
+                for chunk in ['{"content": "Hel', 'lo the', 're."}']:
+                    yield chunk
+            return AsyncReplyStream(deltas())
+
+    threads = set()
+
+    class Sessions(InMemorySessionManager):
+        def get_history(self, session_id):
+            threads.add(threading.current_thread())
+            return super().get_history(session_id)
+
+        def add_to_history(self, session_id, message):
+            threads.add(threading.current_thread())
+            super().add_to_history(session_id, message)
+
+    sessions = Sessions()
+    monkeypatch.setattr(async_service, "model_manager", Model())
+    monkeypatch.setattr(async_service, "session_manager", sessions)
+    monkeypatch.setattr(service, "session_manager", sessions)
+
+    async def call(method, path, body=b""):
+        incoming = [{"type": "http.request", "body": body}]
+        sent = []
+
+        async def receive():
+            return incoming.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await async_service.app({"type": "http", "method": method, "path": path, "headers": []}, receive, send)
+        return sent
+
+    body = json.dumps({"session_id": "test-asgi", "inputs": "Tell me a joke"}).encode()
+    sent = asyncio.run(call("POST", "/chat", body))
+    assert sent[0]["status"] == 200 and (b"content-type", b"text/event-stream") in sent[0]["headers"]
+    events = [json.loads(message["body"].decode()[len("data:"):]) for message in sent[1:]]
+    assert all(message.get("more_body") for message in sent[1:-1]) and not sent[-1].get("more_body")
+    assert "".join(event["token"]["text"] for event in events[:-1]) == "Hello there."
+    assert len(events) > 2  # Streamed as the model generated it, not in one piece
+    assert events[-1]["token"]["special"] and events[-1]["generated_text"] == "Hello there."
+    assert threads and threading.main_thread() not in threads  # Session reads and writes stay off the event loop
+    assert sessions.get_history("test-asgi")[-1] == {"role": "assistant", "content": "Hello there."}
+
+    assert asyncio.run(call("POST", "/chat", b"not json"))[0]["status"] == 400
+    assert asyncio.run(call("GET", "/chat"))[0]["status"] == 404
+
+
+def test_memory_sessions_evict_and_compact():
+    sessions = InMemorySessionManager(max_sessions=2, idle_timeout=60)
+    for session_id in ("a", "b", "c"):
+        sessions.add_to_history(session_id, {"role": "user", "content": "hi"})
+    assert sessions.get_history("a") == [] and sessions.get_history("c") != []  # Least recently used goes first
+    sessions.idle_timeout = 0.05
+    time.sleep(0.1)
+    metrics = sessions.get_metrics()
+    assert metrics["evicted_lru"] == 1 and metrics["evicted_idle"] == 2 and metrics["live_sessions"] == 0
+
+    sessions = InMemorySessionManager(token_budget=200, keep_recent=2)
+    for index in range(20):
+        sessions.add_to_history("long", {"role": "user" if index % 2 == 0 else "assistant",
+                                         "content": f"message {index} " + "word " * 20})
+    assert sessions.get_history("long")[0]["content"].startswith(SUMMARY_PREFIX)
+    assert 0 < sessions.get_metrics()["tokens_retained"] <= 200
+
+    # A tool output is dropped once it is no longer among the recent messages, the turns around it are summarized
+    history = [{"role": "user", "content": "BTC price?"},
+               {"role": "function", "name": "get_symbol_price", "content": "x" * 2000},
+               {"role": "assistant", "content": "BTC is at 1."},
+               {"role": "user", "content": "And ETH?"},
+               {"role": "assistant", "content": "ETH is at 2."}]
+    for message in history:
+        sessions.add_to_history("tool", message)
+    compacted = sessions.get_history("tool")
+    assert compacted[0] == {"role": "system", "content": SUMMARY_PREFIX + "user: BTC price?"}
+    assert compacted[1]["content"] == "Tool call result omitted (get_symbol_price)"
+    assert compacted[2:] == history[2:]
+
+    # Without recent messages to keep, every message can be compacted
+    history = [{"role": "user", "content": f"message {index} " + "word " * 20} for index in range(8)]
+    compacted = compact_history(history, token_budget=200, keep_recent=0)
+    assert compacted[0]["content"].startswith(SUMMARY_PREFIX) and len(compacted) < len(history)
+    assert compact_history(history, token_budget=200, keep_recent=20) == history
+
+    # A lock lives while turns hold or wait for it, not as long as its session
+    sessions = InMemorySessionManager(max_sessions=2, lock_timeout=0.05)
+    for index in range(1000):
+        with sessions.lock(f"random-{index}"):
+            pass
+    assert sessions.session_locks == {}
+    held = sessions.lock("a")
+    for session_id in ("a", "b", "c"):
+        sessions.add_to_history(session_id, {"role": "user", "content": "hi"})  # Evicts session a
+    held.acquire()
+    waiting = sessions.lock("a")
+    assert waiting is held
+    with pytest.raises(ValueError):
+        waiting.acquire()
+    held.release()
+    assert sessions.session_locks == {}
+
+    class PartialSessionManager(SessionManager):
+        def get_history(self, session_id):
+            return []
+
+    with pytest.raises(TypeError):
+        PartialSessionManager()  # An incomplete backend fails when it is created, not on first use
+
+
+def test_prefix_kv_cache_reuses_the_longest_shared_prefix():
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from local_model import PrefixKVCache
+
+    def cache_for(length):
+        cache = transformers.DynamicCache()
+        cache.update(torch.zeros(1, 1, length, 2), torch.zeros(1, 1, length, 2), 0)
+        return cache
+
+    kv_cache = PrefixKVCache(max_entries=2, max_tokens=100, min_prefix=3)
+    kv_cache.store("a", torch.arange(10), cache_for(10))
+    assert kv_cache.lookup("b", torch.arange(2)) is None  # Shorter than min_prefix
+
+    # Another session's entry is copied and cropped to the shared prefix
+    found = kv_cache.lookup("b", torch.tensor([0, 1, 2, 3, 4, 5, 99, 98]))
+    assert found.get_seq_length() == 6 and kv_cache.get_stats()["entries"] == 1
+    # The session's own entry is handed over; one prompt token is always left to prefill
+    found = kv_cache.lookup("a", torch.arange(10))
+    assert found.get_seq_length() == 9 and kv_cache.get_stats()["entries"] == 0
+
+    for session_id in ("a", "b", "c"):
+        kv_cache.store(session_id, torch.arange(10), cache_for(10))
+    stats = kv_cache.get_stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    assert stats["hits"] == 2 and stats["misses"] == 1 and stats["prefill_tokens_saved"] == 15
+
+
+def test_model_backends_load_on_first_use():
+    # Importing the service pulls in none of the backend dependencies
+    assert measure("service", 1)["heavy"] == []
+
+    created = []
+
+    def factory():
+        time.sleep(0.05)
+        created.append(object())
+        return created[-1]
+
+    manager = ModelManager(backends={"slow": factory, "path": "collections:OrderedDict"})
+    assert created == [] and manager.backends == {}
+    backends = []
+    threads = [threading.Thread(target=lambda: backends.append(manager.get_backend("slow"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1 and all(backend is created[0] for backend in backends)  # Initialized once
+    assert type(manager.get_backend("path")).__name__ == "OrderedDict"
+    with pytest.raises(ValueError):
+        manager.get_backend("missing")
+
+    manager.register_backend("slow", dict)
+    assert manager.get_backend("slow") == {}
+
+
+def test_model_calls_are_hedged_with_a_second_backend(monkeypatch):
+    class Backend:
+        def __init__(self, reply, delay=0.0, error=None):
+            self.reply, self.delay, self.error = reply, delay, error
+
+        def call(self, prompt, **kwargs):
+            time.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            return self.reply
+
+    manager = ModelManager(backends={"quick": lambda: Backend("quick"), "slow": lambda: Backend("slow", 0.5),
+                                     "failing": lambda: Backend(None, 0.1, RuntimeError("down")),
+                                     "backup": lambda: Backend("backup", 0.05)})
+    monkeypatch.setattr(Config, "LLM_HEDGE", {name: ("backup", 0.05) for name in ("quick", "slow", "failing")})
+    assert manager.call("quick", "hi") == "quick"  # Answered before the hedge delay
+    assert manager.call("slow", "hi") == "backup"
+    assert manager.call("failing", "hi") == "backup"
+    assert manager.get_stats()["hedging"] == {"hedged": 2, "hedge_wins": 2}
+
+    manager.register_backend("backup", lambda: Backend(None, 0.0, ValueError("also down")))
+    with pytest.raises(RuntimeError):
+        manager.call("failing", "hi")  # The primary's error when both fail
+
+
+def test_openai_backend_retries_transient_errors_with_backoff(monkeypatch):
+    httpx = pytest.importorskip("httpx")
+    openai = pytest.importorskip("openai")
+    import openai_backend
+
+    request = httpx.Request("POST", "https://llm.invalid/v1/chat/completions")
+    rate_limited = httpx.Response(429, headers={"retry-after": "3"}, request=request)
+    errors = [openai.APIConnectionError(request=request),
+              openai.RateLimitError("Slow down", response=rate_limited, body=None)]
+
+    class Completions:
+        def create(self, **kwargs):
+            if errors:
+                raise errors.pop(0)
+            return "reply"
+
+    class Backend(openai_backend._PooledBackend):
+        def _new_client(self, http_client):
+            return SimpleNamespace(chat=SimpleNamespace(completions=Completions()))
+
+        def _new_async_client(self, http_client):
+            raise AssertionError("Only the sync client is used")
+
+    delays = []
+    monkeypatch.setattr(openai_backend.time, "sleep", delays.append)
+    monkeypatch.setattr(Config, "LLM_MAX_RETRIES", 2)
+    assert Backend()._create(model="m") == "reply"
+    assert 0 <= delays[0] <= Config.LLM_RETRY_BACKOFF and delays[1] == 3.0  # Jitter, then Retry-After
+
+    errors.extend([openai.APIConnectionError(request=request)] * 3)
+    with pytest.raises(openai.APIConnectionError):
+        Backend()._create(model="m")  # Gives up after LLM_MAX_RETRIES retries
+    assert len(delays) == 4
+    errors.append(openai.BadRequestError("Bad", response=httpx.Response(400, request=request), body=None))
+    with pytest.raises(openai.BadRequestError):
+        Backend()._create(model="m")  # Not retried
+    assert len(delays) == 4
+
+    class PartialBackend(openai_backend._PooledBackend):
+        def _new_client(self, http_client):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialBackend()  # A backend without an async client fails when it is created
+
+
+def test_router_matches_simple_intents_only():
+    router = IntentRouter(tool_manager, enabled=True)
+    routes = {
+        "What is the current price of BTC?": ("get_symbol_price", {"symbol": "BTCUSDT"}),
+        "ethereum price": ("get_symbol_price", {"symbol": "ETHUSDT"}),
+        "price of eth/btc": ("get_symbol_price", {"symbol": "ETHBTC"}),
+        "What's my USDT balance?": ("get_account_balance", {"asset": "USDT"}),
+        "how much bitcoin do I have": ("get_account_balance", {"asset": "BTC"}),
+        "Show my open orders for BTCUSDT": ("get_open_orders", {"symbol": "BTCUSDT"}),
+    }
+    for prompt, (tool_name, arguments) in routes.items():
+        route = router.match(prompt)
+        assert (route.tool_name, route.arguments) == (tool_name, arguments), prompt
+
+    for prompt in ["Buy 0.01 BTC.", "What is the price of FOO?", "price of BTC and ETH",
+                   "What are the five trades in my history for BTCUSDT?", "price of usdt"]:
+        assert router.match(prompt) is None, prompt
+
+    route = router.match("price of btc")
+    assert router.render(route, "BTCUSDT current price is: 83271.73000000 USDT") == \
+        "The current price of BTC is 83271.73 USDT."
+    assert router.get_stats()["routed"] == 7
+
+
+def test_tools_run_concurrently_and_report_failures_as_results():
+    def fail():
+        raise ValueError("no such pair")
+
+    def throttled():
+        raise RateLimited("limit", 12)
+
+    tools = ToolManager()
+    tools.register_tool("slow", lambda: time.sleep(0.3) or "slow done", "Slow.", {})
+    tools.register_tool("stuck", lambda: time.sleep(1.0) or "late", "Stuck.", {}, timeout=0.2)
+    tools.register_tool("fail", fail, "Fails.", {})
+    tools.register_tool("throttled", throttled, "Throttled.", {})
+
+    start = time.monotonic()
+    results = tools.use_tools([("slow", {}), ("slow", {}), ("stuck", {}), ("fail", {}), ("throttled", {})])
+    assert time.monotonic() - start < 0.5  # Concurrent, and the stuck call is abandoned at its timeout
+    assert results == ["slow done", "slow done", "stuck did not answer within 0.2 seconds",
+                       "fail failed: no such pair",
+                       "Binance is rate limiting requests, throttled can be retried in 12 seconds"]
+
+
+def test_prefetch_never_runs_side_effecting_tools():
+    calls = []
+    manager = ToolManager()
+    manager.register_tool("get_price", lambda symbol: calls.append(symbol) or "1", "Get a price.",
+                          {"type": "object", "properties": {"symbol": {"type": "string"}}}, read_only=True)
+    manager.register_tool("place_order", lambda symbol: calls.append("ORDER") or "placed", "Place an order.",
+                          {"type": "object", "properties": {"symbol": {"type": "string"}}})
+
+    speculation = manager.prefetch([("place_order", {"symbol": "BTCUSDT"}), ("get_price", {"symbol": "BTCUSDT"}),
+                                    ("get_price", {"symbol": "ETHUSDT"})])
+    results = manager.use_tools([("get_price", {"symbol": "BTCUSDT"})], speculation)
+    speculation.close()
+    manager.executor.shutdown(wait=True)
+
+    assert results == ["1"]
+    assert "ORDER" not in calls
+    assert calls.count("BTCUSDT") == 1
+    stats = manager.get_prefetch_stats()
+    assert (stats["speculated"], stats["used"], stats["wasted"]) == (2, 1, 1)
+
+
+def test_account_state_applies_stream_events():
+    stub = StubBinance(balances={"BTC": "1.00000000", "USDT": "100.00000000"})
+    state = AccountState(client=BinanceClient(base_url=stub.start()), ttl=60)
+    try:
+        assert state.get_balance("BTC")["free"] == "1.00000000"
+        assert state.get_open_orders("BTCUSDT") == []
+        requests = len(stub.request_log)
+
+        state.apply_event({"e": "balanceUpdate", "E": 1, "a": "USDT", "d": "-40"})
+        state.apply_event({"e": "executionReport", "E": 2, "s": "BTCUSDT", "i": 7, "S": "BUY", "o": "LIMIT",
+                           "q": "0.1", "p": "50000", "X": "NEW"})
+        assert state.get_balance("USDT")["free"] == "60.00000000"
+        assert [order["orderId"] for order in state.get_open_orders("BTCUSDT")] == [7]
+
+        state.apply_event({"e": "executionReport", "E": 3, "s": "BTCUSDT", "i": 7, "S": "BUY", "o": "LIMIT",
+                           "q": "0.1", "p": "50000", "X": "CANCELED"})
+        assert state.get_open_orders("BTCUSDT") == []
+        assert len(stub.request_log) == requests  # Answered from memory
+
+        # Without a stream feed, open orders expire sooner than balances
+        state = AccountState(client=state.client, ttl=60, orders_ttl=0)
+        for _ in range(2):
+            requests = len(stub.request_log)
+            state.get_balance("BTC")
+            state.get_open_orders("BTCUSDT")
+        assert stub.request_log[requests:] == [("GET", "GET /api/v3/openOrders (all symbols)", 200)]
+    finally:
+        stub.stop()
+
+
+def test_scheduler_accounts_weights_and_backs_off(monkeypatch):
+    if time.time() % 60 > 55:
+        time.sleep(60 - time.time() % 60)  # Keep the test in one of the stub's weight windows
+
+    class Scheduler(RequestScheduler):
+        def acquire(self, endpoint, priority=PRIORITY_QUERY):
+            ticket = super().acquire(endpoint, priority)
+            events.append("acquired")
+            return ticket
+
+    events = []
+    stub = StubBinance(weight_limit=24, secret_key="secret")
+    scheduler = Scheduler(rate_limits=[{"rateLimitType": "REQUEST_WEIGHT", "interval": "MINUTE", "intervalNum": 1,
+                                        "limit": 30}], max_wait=0.2)
+    client = BinanceClient(secret_key="secret", base_url=stub.start(), scheduler=scheduler)
+    sign = client.sign
+    monkeypatch.setattr(client, "sign", lambda query_string: events.append("signed") or sign(query_string))
+    try:
+        assert client.request("GET", "/api/v3/ticker/price", {"symbol": "BTCUSDT"}).status_code == 200
+        assert client.request("GET", "/api/v3/account", signed=True).status_code == 200
+        assert events == ["acquired", "acquired", "acquired", "signed"]  # Time sync, then stamped once admitted
+
+        stats = scheduler.get_stats()
+        assert stats["weights"]["GET /api/v3/account"] == 20  # Learned from the used-weight headers
+        assert 7 <= stats["X-MBX-USED-WEIGHT-1M"] < 8
+
+        # Not enough budget left for another account call: back off without sending it
+        with pytest.raises(RateLimited) as raised:
+            client.request("GET", "/api/v3/account", signed=True)
+        assert raised.value.retry_after > 0.2
+
+        # The server counts more than the client knows about and answers 429: hold off until Retry-After
+        assert client.request("GET", "/api/v3/ticker/price", {"symbol": "BTCUSDT"}).status_code == 429
+        with pytest.raises(RateLimited):
+            client.request("GET", "/api/v3/time")
+        assert [status for _, _, status in stub.request_log] == [200, 200, 200, 429]
+        assert scheduler.get_stats()["rejected"] == 2 and scheduler.get_stats()["throttled_by_server"] == 1
+    finally:
+        stub.stop()
+
+
+def test_trade_history_fetches_only_new_trades(tmp_path):
+    stub = StubBinance(weight_limit=10 ** 6)
+    for i in range(PAGE_SIZE + 5):
+        stub.trades.append({"symbol": "BTCUSDT", "id": i + 1, "orderId": i + 1, "price": "100", "qty": "1",
+                            "quoteQty": "100", "commission": "0.1", "commissionAsset": "USDT",
+                            "time": 1_700_000_000_000 + i, "isBuyer": i % 2 == 0, "isMaker": False})
+    client = BinanceClient(base_url=stub.start())
+    try:
+        history = TradeHistory(client=client, cache_dir=str(tmp_path), ttl=0)
+        summary = history.summary("BTCUSDT")
+        assert summary["trades"] == PAGE_SIZE + 5
+        assert summary["vwap"] == 100.0
+        assert abs(summary["fees"]["USDT"] - 0.1 * (PAGE_SIZE + 5)) < 1e-6
+        assert history.get_stats()["pages"] == 2
+
+        stub.trades.append(dict(stub.trades[-1], id=PAGE_SIZE + 6, price="130", quoteQty="130", isBuyer=False))
+        reloaded = TradeHistory(client=client, cache_dir=str(tmp_path), ttl=0)
+        assert reloaded.summary("BTCUSDT")["trades"] == PAGE_SIZE + 6
+        assert reloaded.get_stats()["trades_fetched"] == 1
+        assert reloaded.daily_volume("BTCUSDT", days=None)[0][3] == PAGE_SIZE + 6
+    finally:
+        stub.stop()
+
+
+def test_kline_store_fetches_only_closed_new_candles(tmp_path):
+    stub = StubBinance()
+    client = BinanceClient(base_url=stub.start())
+    try:
+        store = KlineStore(client=client, cache_dir=str(tmp_path), warmup=10)
+        candles = store.get_candles("BTCUSDT", "1w", 30)
+        assert len(candles) == 30 and np.all(np.diff(candles["open_time"]) == 604_800_000)
+        value, _ = store.indicator("BTCUSDT", "ema", 20, "1w")  # Backfills to 200 candles
+        assert len(store.get_candles("BTCUSDT", "1w", 200)) == 200
+
+        restarted = KlineStore(client=client, cache_dir=str(tmp_path), warmup=10)
+        assert restarted.indicator("BTCUSDT", "ema", 20, "1w")[0] == value
+        assert restarted.get_stats()["pages"] == 0
+    finally:
+        stub.stop()
+
+    # Two workers sharing the directory sync the same new candles: the second keeps only what is missing
+    key = ("ETHUSDT", "1h")
+    candles = np.zeros(6, dtype=CANDLE)
+    candles["open_time"] = np.arange(6) * 3_600_000
+    first, second = KlineStore(client=None, cache_dir=str(tmp_path)), KlineStore(client=None, cache_dir=str(tmp_path))
+    first._open(key)
+    second._open(key)
+    first._append(key, candles[:4])
+    assert list(second._append(key, candles[2:])["open_time"]) == list(candles["open_time"])
+
+    # A backfill keeps the candles another worker appended or backfilled since this one opened the file
+    key = ("SOLUSDT", "1h")
+    candles = np.zeros(8, dtype=CANDLE)
+    candles["open_time"] = np.arange(8) * 3_600_000
+    first._append(key, candles[4:6])
+    second._open(key)
+    first._append(key, candles[6:])
+    assert list(second._rewrite(key, candles[:4])["open_time"]) == list(candles["open_time"])
+    assert list(first._rewrite(key, candles[2:4])["open_time"]) == list(candles["open_time"])
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    closes = [100.0, 101.0, 99.5, 102.0, 103.5, 101.0, 104.0]
+    expected = [closes[0]]
+    for close in closes[1:]:
+        expected.append(expected[-1] + 0.5 * (close - expected[-1]))
+    assert np.allclose(ema(np.array(closes), 3), expected)
+    assert rsi(np.array([1.0, 2.0, 3.0, 4.0]), 2)[-1] == 100.0
+
+
+def test_tool_results_are_rendered_compactly_within_budget():
+    manager = ToolManager()
+    manager.register_tool("get_trades", lambda symbol: [], "Get trades.",
+                          {"type": "object", "properties": {"symbol": {"type": "string"}}},
+                          formatter=lambda result, arguments: (f"{arguments['symbol']} trades:", result))
+    rows = [f"BUY 0.01000000 @ {80000 + i}.50000000" for i in range(250)]
+
+    text = manager.render_result("get_trades", {"symbol": "BTCUSDT"}, rows, max_tokens=100)
+    lines = text.split("\n")
+    assert lines[0] == "BTCUSDT trades:"
+    assert lines[1] == "BUY 0.01 @ 80000.5"
+    assert lines[-1] == f"…and {250 - (len(lines) - 2)} more"
+    assert manager.render_result("get_trades", {"symbol": "BTCUSDT"}, "Failed to get trades: 429") == \
+        "Failed to get trades: 429"
+    assert manager.render_result("get_trades", {"symbol": "BTCUSDT"}, ["SELL 1.00000000 @ 2"]) == \
+        "BTCUSDT trades:\nSELL 1 @ 2"
+    stats = manager.get_result_stats()
+    assert stats["truncated"] == 1 and stats["compact_tokens"] < stats["raw_tokens"]
+
+
+def test_streaming_parser_reports_calls_early_and_malformed_replies_as_errors():
+    reply = ('```json\n{"function_call": [{"name": "get_symbol_price", "arguments": "{\\"symbol\\": \\"BTC}\\"}"}, '
+             '{"name": "get_account_balance", "arguments": {"asset": "BTC"}}], "content": "Checking."}\n```')
+    calls = []
+    parser = StreamingReplyParser(on_call=lambda call: calls.append((call["name"], len(parser.text))))
+    for start in range(0, len(reply), 7):
+        assert parser.feed(reply[start:start + 7]) == ""
+    assert [name for name, _ in calls] == ["get_symbol_price", "get_account_balance"]
+    assert calls[0][1] < reply.index("get_account_balance")  # Reported before the next call arrived
+    assert parser.result()["content"] == "Checking."
+
+    # A fence without the json tag hides the call as well
+    parser = StreamingReplyParser()
+    reply = '```\n{"function_call": {"name": "get_symbol_price", "arguments": {"symbol": "BTCUSDT"}}}\n```'
+    assert "".join(parser.feed(reply[start:start + 2]) for start in range(0, len(reply), 2)) == ""
+    assert parser.result()["function_call"]["name"] == "get_symbol_price"
+
+    assert "error" in parse_reply('{"function_call": {"name": "get_symbol_price", "arguments": {"sym')
+    assert parse_reply('{"content": "Hi"}') == {"content": "Hi"}
+    assert parse_reply("Hi there") == {"content": "Hi there"}
+
+
+def test_chat_turn_saves_the_preamble_it_streamed_with_a_function_call(monkeypatch):
+    tools = ToolManager()
+    tools.register_tool("get_quote", lambda symbol: f"{symbol} is 1", "Quote.",
+                        {"type": "object", "properties": {"symbol": {"type": "string"}}, "required": ["symbol"]})
+
+    class Model:
+        replies = ['{"content": "Let me check.", "function_call": {"name": "get_quote", "arguments": {"symbol": "X"}}}',
+                   '{"content": "X is at 1."}']
+
+        def call_azure(self, messages, stream=False, **options):
+            reply = self.replies.pop(0)
+            return ReplyStream(reply[start:start + 5] for start in range(0, len(reply), 5))
+
+    tracer = Tracer(enabled=True)
+    monkeypatch.setattr(service, "tracer", tracer)
+    with tracer.span("chat", trace_id="t1") as root:
+        stream = service.handle_chat_stream("How is my coin doing?", "test-preamble", Model(), tools)
+        deltas = []
+        while True:
+            try:
+                deltas.append(next(stream))
+            except StopIteration as done:
+                final_reply, step = done.value
+                break
+    assert "".join(deltas) == final_reply == "Let me check.\n\nX is at 1."
+    assert step["content"] == "Tool call result: X is 1"
+    assert service.session_manager.get_history("test-preamble")[-1] == {"role": "assistant", "content": final_reply}
+    # The calls of the turn are recorded on its trace
+    spans = {span["name"]: span for span in root.details()["spans"]}
+    assert spans["chat.tools"]["tools"] == ["get_quote"] and spans["chat.tools"]["calls"] == 1
+
+    # A reply that cannot be parsed is noted on the trace of the turn
+    Model.replies.append('{"function_call": {"name": "get_quote", "argu')
+    with tracer.span("chat", trace_id="t2") as root:
+        final_reply, step = service.handle_chat("How is my coin doing?", "test-preamble", Model(), tools)
+    assert final_reply == "The model did not return a valid response" and step == {}
+    spans = {span["name"]: span for span in root.details()["spans"]}
+    assert spans["chat.llm"]["parse_error"].startswith("Malformed function call")
+
+
+def test_reply_grammar_follows_tool_schemas():
+    grammar = ReplyGrammar([{"name": "get_klines", "description": "Get candles.", "parameters": {
+        "type": "object",
+        "properties": {"symbol": {"type": "string"}, "interval": {"type": "string", "enum": ["1h", "1d"]},
+                       "limit": {"type": "integer"}},
+        "required": ["symbol"]}}])
+
+    def accepts(text):
+        return grammar.accepts(grammar.walk(grammar.start, text))
+
+    assert accepts('{"content": "No tool needed."}')
+    assert accepts('{"function_call": {"name": "get_klines", "arguments": {"symbol": "BTCUSDT", "limit": 7}}}')
+    assert accepts('{\n  "function_call": [\n    {"name": "get_klines", "arguments": {"symbol": "A"}},\n'
+                   '    {"name": "get_klines", "arguments": {"symbol": "B", "interval": "1h"}}\n  ],\n'
+                   '  "content": "Comparing."\n}')
+    assert not accepts('{"function_call": {"name": "get_klines", "arguments": {"limit": 7}}}')  # symbol is required
+    assert not accepts('{"function_call": {"name": "get_klines", "arguments": {"symbol": "A", "interval": "2d"}}}')
+    assert not accepts('{"function_call": {"name": "get_klines", "arguments": {"symbol": "A", "limit": 7.5}}}')
+    assert not accepts('{"function_call": {"name": "get_price", "arguments": {"symbol": "A"}}}')
+    assert not accepts('{"content": "Unfinished')
+
+
+def test_tracer_nests_spans_and_exports_prometheus_metrics():
+    tracer = Tracer(enabled=True)
+    with tracer.span("chat", trace_id="t1") as root:
+        with tracer.span("tool.get_symbol_price") as tool:
+            with tracer.upstream("binance") as upstream:
+                upstream.set(status=200)
+            tool.set(cache_hit=tool.upstream_calls == 0)
+        with tracer.span("chat.llm") as llm:
+            llm.set(prompt_tokens=120, completion_tokens=8)
+    with tracer.span("tool.get_symbol_price") as tool:  # Outside the trace
+        tool.set(cache_hit=tool.upstream_calls == 0)
+
+    trace = root.details()
+    assert trace["id"] == "t1"
+    assert [span["name"] for span in trace["spans"]] == ["chat", "tool.get_symbol_price", "binance", "chat.llm"]
+    assert trace["spans"][1]["cache_hit"] is False
+
+    metrics = tracer.render_prometheus()
+    assert 'binance_agent_stage_seconds_count{stage="tool.get_symbol_price"} 2' in metrics
+    assert 'binance_agent_stage_seconds_bucket{stage="chat",le="+Inf"} 1' in metrics
+    assert 'binance_agent_stage_status_total{stage="binance",status="200"} 1' in metrics
+    assert 'binance_agent_cache_lookups_total{stage="tool.get_symbol_price",result="hit"} 1' in metrics
+    assert 'binance_agent_tokens_total{stage="chat.llm",kind="prompt"} 120' in metrics
+
+    disabled = Tracer(enabled=False)
+    assert disabled.span("chat", trace_id="t2") is NO_SPAN
+    with disabled.span("chat") as span:
+        assert span.details() is None
+    assert "_count" not in disabled.render_prometheus()
+
+
+def test_response_cache_shares_market_answers_only():
+    tools = ToolManager()
+    tools.register_tool("get_symbol_price", lambda symbol: "1", "Price.", {}, read_only=True, reply_ttl=60)
+    tools.register_tool("get_klines", lambda symbol: "2", "Candles.", {}, read_only=True, reply_ttl=lambda arguments: 0)
+    tools.register_tool("get_account_balance", lambda asset: "3", "Balance.", {}, read_only=True)
+    tools.register_tool("cancel_order", lambda order_id: "4", "Cancel.", {}, reply_ttl=60)  # Not read-only
+    cache = ResponseCache(tools, IntentRouter(tools), max_entries=2, enabled=True)
+
+    def step(content):
+        return [{"role": "function", "name": "get_symbol_price", "content": content}]
+
+    key = cache.key("BTC price, please?", [])
+    assert key == cache.key("btc price please", [{"role": "user", "content": "hi"}])
+    assert key != cache.key("btc price please", [{"role": "function", "name": "get_klines", "content": "..."}])
+    assert cache.lookup(key) is None
+    cache.store(key, [("get_symbol_price", {"symbol": "BTCUSDT"})], step("BTCUSDT is 1"), "BTC is at 1.")
+    assert cache.lookup(key).reply == "BTC is at 1."  # Fresh: neither model call is needed
+
+    # Once the data is stale only the tool calls are reused, and the reply if the results did not change
+    key = cache.key("How did ETH do?", [])
+    cache.store(key, [("get_klines", {"symbol": "ETHUSDT"})], step("ETH candles"), "ETH went up.")
+    cached = cache.lookup(key)
+    assert cached.calls == [("get_klines", {"symbol": "ETHUSDT"})] and cached.reply is None
+    assert cache.reply_for(key, step("ETH candles")) == "ETH went up."
+    assert cache.reply_for(key, step("New ETH candles")) is None
+
+    for calls in ([("get_account_balance", {"asset": "BTC"})], [("cancel_order", {"order_id": 1})],
+                  [("get_symbol_price", {"symbol": "BTCUSDT"}), ("get_account_balance", {"asset": "BTC"})]):
+        key = cache.key("mine", [])
+        cache.store(key, calls, step("private"), "Yours.")
+        assert cache.lookup(key) is None
+
+    stats = cache.get_stats()
+    assert stats["fresh_hits"] == 1 and stats["call_hits"] == 1 and stats["not_shared"] == 3
+    assert stats["llm_calls_avoided"] == 4 and stats["entries"] <= 2
+
+
+def test_response_cache_never_shares_answers_that_depend_on_earlier_turns():
+    def get_klines(symbol, interval="1d", limit=7):
+        return "candles"
+
+    tools = ToolManager()
+    tools.register_tool("get_symbol_price", lambda symbol: "1", "Price.", {}, read_only=True, reply_ttl=60)
+    tools.register_tool("get_klines", get_klines, "Candles.", {}, read_only=True, reply_ttl=60)
+    cache = ResponseCache(tools, IntentRouter(tools), enabled=True)
+
+    def history(asset):
+        return [{"role": "user", "content": f"I'm looking at {asset}"},
+                {"role": "function", "name": "get_symbol_price", "content": f"{asset}USDT is 1"}]
+
+    # Session A asks about SOL, then "its" price; session B asks the same about BTC
+    key = cache.key("What's its price?", history("SOL"))
+    assert cache.lookup(key) is None
+    cache.store(key, [("get_symbol_price", {"symbol": "SOLUSDT"})],
+                [{"role": "function", "name": "get_symbol_price", "content": "SOLUSDT is 1"}], "SOL is at 1.")
+    assert cache.lookup(cache.key("what's its price", history("BTC"))) is None
+
+    # Arguments the question names, or the tool defaults, are shared; ones taken from earlier turns are not
+    key = cache.key("How did SOL do this week?", history("SOL"))
+    cache.store(key, [("get_klines", {"symbol": "SOLUSDT", "interval": "1d", "limit": 7})], [], "SOL went up.")
+    assert cache.lookup(cache.key("how did sol do this week", history("BTC"))).reply == "SOL went up."
+    key = cache.key("and ETH?", history("BTC"))
+    cache.store(key, [("get_klines", {"symbol": "ETHUSDT", "interval": "1h"})], [], "ETH went down.")
+    assert cache.lookup(key) is None
+    key = cache.key("and ETH 1h?", history("BTC"))
+    cache.store(key, [("get_klines", {"symbol": "ETHUSDT", "interval": "1h"})], [], "ETH went down.")
+    assert cache.lookup(key).reply == "ETH went down."
+    assert cache.get_stats()["not_shared"] == 2
+
+
+def test_batching_engine_survives_failing_sequences():
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from types import SimpleNamespace
+
+    from batching import BatchingEngine
+
+    torch.manual_seed(0)
+    model = transformers.LlamaForCausalLM(transformers.LlamaConfig(
+        vocab_size=32, hidden_size=16, intermediate_size=32, num_hidden_layers=1, num_attention_heads=2,
+        num_key_value_heads=2, max_position_embeddings=64, eos_token_id=31)).eval()
+    model.generation_config.do_sample = False
+    engine = BatchingEngine(model, SimpleNamespace(eos_token_id=31, pad_token_id=0), max_batch_size=4)
+
+    def broken(input_ids, scores):
+        raise RuntimeError("processor failed")
+
+    def run(input_ids, logits_processor=None):
+        sequence = engine.submit(torch.tensor(input_ids), 4, logits_processor=logits_processor)
+        assert sequence.done.wait(30)
+        return sequence
+
+    assert isinstance(run([1, 2, 3], broken).error, RuntimeError)
+    assert run([1, 2, 3], lambda input_ids, scores: scores).error is None
+    assert run([1, 2, 99]).error is not None  # Out of the vocabulary: the prefill fails
+    healthy = run([4, 5, 6])
+    assert healthy.error is None and len(engine.wait(healthy)) > 3
+    assert engine.thread.is_alive() and not engine.active
+
+
+def test_sqlite_sessions_serialize_turns_and_renew_lock_leases(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    sessions = SQLiteSessionManager(path=path, lock_timeout=5, lock_lease=0.3)
+
+    def turn(index):
+        with sessions.lock("shared"):
+            seen = len(sessions.get_history("shared"))
+            sessions.add_to_history("shared", {"role": "user", "content": f"question {index}"})
+            time.sleep(0.05)
+            sessions.add_to_history("shared", {"role": "assistant", "content": f"answer {index} after {seen}"})
+
+    threads = [threading.Thread(target=turn, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    history = sessions.get_history("shared")
+    assert len(history) == 8
+    for position in range(0, 8, 2):
+        # Every turn saw all earlier turns, and its messages are not interleaved with another's
+        index = history[position]["content"].split()[-1]
+        assert history[position + 1]["content"] == f"answer {index} after {position}"
+
+    # A turn running longer than the lease keeps the session, also against other processes
+    lock = sessions.lock("shared")
+    lock.acquire()
+    time.sleep(1.0)
+    other = SQLiteSessionManager(path=path, lock_timeout=0.2, lock_lease=0.3)
+    with pytest.raises(ValueError):
+        other.lock("shared").acquire()
+    lock.release()
+    with other.lock("shared"):
+        pass
+
+
+def test_sqlite_sessions_compact_and_evict(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "SESSION_SWEEP_INTERVAL", 0)
+    sessions = SQLiteSessionManager(path=str(tmp_path / "sessions.db"), max_sessions=2, token_budget=200,
+                                    keep_recent=2)
+    for index in range(20):
+        sessions.add_to_history("long", {"role": "user" if index % 2 == 0 else "assistant",
+                                         "content": f"message {index} " + "word " * 20})
+    history = sessions.get_history("long")
+    assert history[0]["content"].startswith(SUMMARY_PREFIX)
+    assert [message["content"].split()[1] for message in history[-2:]] == ["18", "19"]
+    metrics = sessions.get_metrics()
+    assert metrics["compactions"] >= 1 and metrics["tokens_retained"] <= 200
+    # Compacted rows are deleted, not just skipped
+    assert sessions._connection().execute("SELECT COUNT(*) FROM messages").fetchone()[0] == len(history)
+
+    # The least recently used session goes first, then the idle ones
+    sessions.add_to_history("a", {"role": "user", "content": "hi"})
+    sessions.add_to_history("b", {"role": "user", "content": "hi"})
+    assert sessions.get_history("long") == [] and sessions.get_history("a") != []
+    sessions.idle_timeout = 0.05
+    time.sleep(0.1)
+    sessions.create_session("c")
+    metrics = sessions.get_metrics()
+    assert metrics["evicted_lru"] == 1 and metrics["evicted_idle"] == 2 and metrics["live_sessions"] == 1
+
+
+def test_chat_turn_discards_prefetched_calls_when_the_model_fails():
+    tools = ToolManager()
+    tools.register_tool("get_symbol_price", lambda symbol: f"{symbol} current price is: 1 USDT", "Price.",
+                        {"type": "object", "properties": {"symbol": {"type": "string"}}, "required": ["symbol"]},
+                        read_only=True)
+
+    class Model:
+        def call_azure(self, messages, stream=False, **options):
+            raise RuntimeError("model unavailable")
+
+    with pytest.raises(RuntimeError):
+        list(handle_chat_stream("Is the BTC price going up?", "test-prefetch", Model(), tools))
+    stats = tools.get_prefetch_stats()
+    assert stats["speculated"] == 1 and stats["wasted"] == 1
 
 
 if __name__ == "__main__":
@@ -40,7 +980,5 @@ if __name__ == "__main__":
         print(f"User: {prompt}")
         response = chat(session_id, prompt)
 
-        print(f"Function Calling: {response.get('function_call_step')}")
-
-        print(f"AI: {response.get('response')}")
+        print(f"AI: {response}")
         print("-" * 50)
@@ -0,0 +1,43 @@
+# tokenizer.py
+
+from config import Config
+
+_encoding = None
+_loaded = False
+
+
+def _get_encoding():
+    """Load the tiktoken encoding on first use, None if tiktoken is not available."""
+    global _encoding, _loaded
+    if not _loaded:
+        _loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(Config.TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"tiktoken is not available, estimating token counts: {e}")
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Count the tokens of a text.
+    Falls back to an estimate of 4 characters per token when tiktoken is not installed.
+    :param text: Text to measure
+    :return: Number of tokens
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message):
+    """
+    Count the tokens a chat message takes in a prompt.
+    :param message: Chat message dictionary
+    :return: Number of tokens, including the per-message overhead
+    """
+    return count_tokens(str(message.get("content") or "")) + 4
@@ -1,32 +1,111 @@
 # tool.py
 
-import requests
-import hmac
-import hashlib
+import contextvars
+import json
+import re
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from config import Config
-from functools import lru_cache
+from client import binance_client, RateLimited
+from account import account_state
+from history import trade_history
+from kline import kline_store, INDICATORS, INTERVAL_MS
+from tokenizer import count_tokens
+from tracing import tracer
+
+# Static parts of the system prompt, around the rendered tool catalog
+SYSTEM_PROMPT_HEAD = "You are a helpful AI assistant. You have access to the following tools:\n"
+SYSTEM_PROMPT_TAIL = (
+    "\n\n"
+    "If you need to use a tool, respond with a JSON object containing the following fields:\n"
+    "1. `function_call`: A dictionary with `name` (the tool name) and `arguments` (a JSON string of the tool's input parameters).\n"
+    "2. `content`: A brief explanation of why you are calling the tool.\n"
+    "Always put `function_call` before `content`.\n"
+    "If you need several tools, or one tool for several arguments, make `function_call` a list of such dictionaries; they run in parallel and you get all results at once.\n"
+    "Remember, if some argument is missing, and the argument itself is rather trivial, you can fill it with a default value. For example, if the argument LIMIT is missing, put a 5 or 1."
+    "Example:\n"
+    "```json\n"
+    "{\n"
+    '  "function_call": {\n'
+    '    "name": "get_symbol_price",\n'
+    '    "arguments": "{\"symbol\": \"BTCUSDT\"}"\n'
+    "  },\n"
+    '  "content": "I need to get the current price of BTC."\n'
+    "}\n"
+    "```\n"
+    "If you do not need to use a tool, respond with a normal message in the `content` field.\n"
+    "Example:\n"
+    "```json\n"
+    "{\n"
+    '  "content": "The current price of BTC is 50000 USDT."\n'
+    "}\n"
+    "```"
+)
+# With native tool calling the catalog and the call format come with the request, not the prompt
+SYSTEM_PROMPT_NATIVE = (
+    "You are a helpful AI assistant with tools for live Binance market data and the user's account. "
+    "Call a tool whenever the answer depends on them; call several at once when you need several results. "
+    "If some argument is missing, and the argument itself is rather trivial, fill it with a default value."
+)
+
+# Trailing zeros Binance pads amounts with, e.g. 0.01000000
+_TRAILING_ZEROS = re.compile(r"(?<![\w.])(\d+\.\d*?)0+(?![\w.])")
 
 
 class ToolManager:
-    def __init__(self):
+    def __init__(self, max_workers=Config.TOOL_MAX_WORKERS):
+        """
+        Initialize the tool manager.
+        :param max_workers: Tool calls of one turn that run at the same time
+        """
         self.tools = {}
         self.tool_descriptions = []
+        self.timeouts = {}  # tool name -> seconds, for tools that differ from Config.TOOL_TIMEOUT
+        self.read_only = set()  # Tools without side effects, the only ones that may run speculatively
+        self.formatters = {}  # tool name -> function shaping its results for the prompt
+        self.reply_ttls = {}  # tool name -> seconds, or function (arguments) -> seconds, replies may be shared
+        self.lock = threading.Lock()
+        self.prefetch_stats = {"speculated": 0, "used": 0, "wasted": 0, "early": 0, "time_saved_s": 0.0}
+        self.result_stats = {"results": 0, "truncated": 0, "raw_tokens": 0, "compact_tokens": 0}
+        self.system_prompts = {}  # native -> prompt, rendered on first use, reset when a tool is registered
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
 
-    def register_tool(self, tool_name, tool_function, description, parameters):
+    def register_tool(self, tool_name, tool_function, description, parameters, timeout=None, read_only=False,
+                      formatter=None, reply_ttl=None):
         """
         Register a tool.
         :param tool_name: Name of the tool
         :param tool_function: Function of the tool
         :param description: Description of the tool
         :param parameters: Parameters of the tool
+        :param timeout: Seconds a call may take in use_tools, defaults to Config.TOOL_TIMEOUT
+        :param read_only: The tool has no side effects, so it may run before the model asks for it
+        :param formatter: Function (result, arguments) -> text, or (header, rows) for results that may be
+                          cut short, used by render_result; text results such as errors bypass it
+        :param reply_ttl: Seconds the reply to a question answered with this tool may be reused for other
+                          sessions, or a function (arguments) -> seconds; None for tools whose results depend
+                          on the account, which are never shared
         """
         self.tools[tool_name] = tool_function
+        if timeout is not None:
+            self.timeouts[tool_name] = timeout
+        if formatter is not None:
+            self.formatters[tool_name] = formatter
+        if reply_ttl is not None:
+            self.reply_ttls[tool_name] = reply_ttl
+        else:
+            self.reply_ttls.pop(tool_name, None)
+        if read_only:
+            self.read_only.add(tool_name)
+        else:
+            self.read_only.discard(tool_name)
         self.tool_descriptions.append({
             "name": tool_name,
             "description": description,
             "parameters": parameters
         })
+        self.system_prompts = {}
 
     def use_tool(self, tool_name, *args, **kwargs):
         """
@@ -38,7 +117,153 @@ class ToolManager:
         """
         if tool_name not in self.tools:
             raise ValueError(f"Tool {tool_name} not found.")
-        return self.tools[tool_name](*args, **kwargs)
+        with tracer.span(f"tool.{tool_name}") as span:
+            try:
+                result = self.tools[tool_name](*args, **kwargs)
+            except RateLimited as e:
+                # Report backpressure to the chat layer instead of failing the turn
+                span.set(status="rate_limited")
+                return f"Binance is rate limiting requests, {tool_name} can be retried in {e.retry_after:.0f} seconds"
+            if tool_name in self.read_only:
+                # Served without a Binance request, e.g. from the price cache or the account state
+                span.set(cache_hit=span.upstream_calls == 0)
+        return result
+
+    def use_tools(self, calls, speculation=None):
+        """
+        Run several tool calls concurrently, each within its timeout.
+        A call that fails or times out yields an error message as its result, so the others still count.
+        A timed-out call is abandoned, not interrupted, and keeps its worker until it returns.
+        :param calls: List of (tool name, arguments dictionary)
+        :param speculation: Speculation from prefetch, whose matching calls are reused instead of run again
+        :return: List of results, in the order of the calls
+        """
+        start = time.monotonic()
+        futures = []
+        for tool_name, arguments in calls:
+            future = speculation.take(tool_name, arguments) if speculation is not None else None
+            if future is None:
+                # The worker nests its spans in the current one
+                future = self.executor.submit(contextvars.copy_context().run, self.use_tool, tool_name, **arguments)
+            futures.append(future)
+        results = []
+        for (tool_name, _), future in zip(calls, futures):
+            # Each call gets its own timeout, counted from the start of the batch
+            remaining = start + self.get_timeout(tool_name) - time.monotonic()
+            try:
+                results.append(future.result(timeout=max(remaining, 0)))
+            except FutureTimeout as e:
+                future.cancel()
+                results.append(self.failure_result(tool_name, e))
+            except Exception as e:
+                results.append(self.failure_result(tool_name, e))
+        return results
+
+    def prefetch(self, calls):
+        """
+        Start likely tool calls before the model has asked for them.
+        Only read-only tools are started; other calls are ignored.
+        :param calls: List of (tool name, arguments dictionary)
+        :return: Speculation to pass to use_tools and to close once the turn is decided, or None
+        """
+        calls = [(tool_name, arguments) for tool_name, arguments in calls if tool_name in self.read_only]
+        if not calls:
+            return None
+        with self.lock:
+            self.prefetch_stats["speculated"] += len(calls)
+        return Speculation(self, calls)
+
+    def get_prefetch_stats(self):
+        """
+        Get speculative prefetch counters.
+        :return: Dictionary with speculated, used and wasted calls, the share used, calls started early from a
+                 streaming reply, and the time saved
+        """
+        with self.lock:
+            stats = dict(self.prefetch_stats)
+        stats["hit_rate"] = stats["used"] / stats["speculated"] if stats["speculated"] else 0.0
+        return stats
+
+    def render_result(self, tool_name, arguments, result, max_tokens=Config.TOOL_RESULT_MAX_TOKENS):
+        """
+        Render a tool result compactly for the prompt and the session history.
+        Lists become one line per item instead of a Python repr, padded zeros are dropped, and rows that
+        do not fit in max_tokens are replaced by a count of the ones left out.
+        :param tool_name: Name of the tool
+        :param arguments: Arguments of the call
+        :param result: Result of the tool call
+        :param max_tokens: Tokens the rendered result may take
+        :return: Result text
+        """
+        formatter = self.formatters.get(tool_name)
+        shaped = result
+        if formatter is not None and not isinstance(result, str):
+            try:
+                shaped = formatter(result, arguments)
+            except Exception as e:
+                print(f"Formatting the result of {tool_name} failed: {e}")
+        if isinstance(shaped, tuple):
+            header, rows = shaped
+        elif isinstance(shaped, list):
+            header, rows = None, shaped
+        elif isinstance(shaped, dict):
+            header, rows = None, [f"{key}: {value}" for key, value in shaped.items()]
+        else:
+            header, rows = None, [shaped]
+        if header is None and not rows:
+            header = "No results"
+
+        lines, truncated = _fit([_TRAILING_ZEROS.sub(_strip_zeros, str(row)) for row in rows],
+                                _TRAILING_ZEROS.sub(_strip_zeros, header) if header else None, max_tokens)
+        text = "\n".join(lines)
+        raw_tokens = count_tokens(str(result))
+        with self.lock:
+            self.result_stats["results"] += 1
+            self.result_stats["truncated"] += truncated
+            self.result_stats["raw_tokens"] += raw_tokens
+            self.result_stats["compact_tokens"] += count_tokens(text)
+        return text
+
+    def get_result_stats(self):
+        """
+        Get result rendering counters.
+        :return: Dictionary with results rendered and cut short, their tokens before and after, and the share saved
+        """
+        with self.lock:
+            stats = dict(self.result_stats)
+        stats["saved"] = 1 - stats["compact_tokens"] / stats["raw_tokens"] if stats["raw_tokens"] else 0.0
+        return stats
+
+    def get_timeout(self, tool_name):
+        """
+        Get the timeout of a tool.
+        :param tool_name: Name of the tool
+        :return: Seconds a call may take
+        """
+        return self.timeouts.get(tool_name, Config.TOOL_TIMEOUT)
+
+    def get_reply_ttl(self, tool_name, arguments):
+        """
+        Seconds a reply built on a call may be reused across sessions.
+        :param tool_name: Name of the tool
+        :param arguments: Arguments dictionary
+        :return: Seconds, or None if the reply must not be shared, e.g. for account or side-effecting tools
+        """
+        ttl = self.reply_ttls.get(tool_name)
+        if ttl is None or tool_name not in self.read_only:
+            return None
+        return ttl(arguments) if callable(ttl) else ttl
+
+    def failure_result(self, tool_name, error):
+        """
+        Describe a failed tool call to the model.
+        :param tool_name: Name of the tool
+        :param error: Exception raised by the call
+        :return: Result text
+        """
+        if isinstance(error, (FutureTimeout, TimeoutError)):
+            return f"{tool_name} did not answer within {self.get_timeout(tool_name):g} seconds"
+        return f"{tool_name} failed: {error}"
 
     def get_tool_descriptions(self):
         """
@@ -47,15 +272,145 @@ class ToolManager:
         """
         return self.tool_descriptions
 
+    def get_system_prompt(self, native=False):
+        """
+        Get the system prompt describing the tools.
+        It is rendered once and stays byte-identical until a tool is registered, so providers
+        can cache the prompt prefix.
+        :param native: The tools are passed through native tool calling, so the prompt leaves out
+                       the catalog and the JSON format
+        :return: System prompt text
+        """
+        system_prompt = self.system_prompts.get(native)
+        if system_prompt is None:
+            if native:
+                system_prompt = SYSTEM_PROMPT_NATIVE
+            else:
+                catalog = "\n".join(
+                    f"- {tool['name']}: {tool['description']} - parameters: arguments: "
+                    f"{json.dumps(tool['parameters'], sort_keys=True)}"
+                    for tool in self.tool_descriptions)
+                system_prompt = SYSTEM_PROMPT_HEAD + catalog + SYSTEM_PROMPT_TAIL
+            self.system_prompts[native] = system_prompt
+        return system_prompt
+
+
+class Speculation:
+    def __init__(self, tool_manager, calls):
+        """
+        Read-only tool calls started while the model is still deciding what to call.
+        :param tool_manager: Tool manager running the calls
+        :param calls: List of (tool name, arguments dictionary)
+        """
+        self.tool_manager = tool_manager
+        self.flights = {}  # call key -> (future, start time, [finish time], started from the reply)
+        for tool_name, arguments in calls:
+            self._start(tool_name, arguments, early=False)
+
+    def add(self, tool_name, arguments):
+        """
+        Start a call the model has already written out while the rest of its reply still streams in.
+        Only read-only tools are started; the others wait until the reply is complete and parsed.
+        :param tool_name: Name of the tool
+        :param arguments: Arguments dictionary
+        """
+        if tool_name in self.tool_manager.read_only and self._start(tool_name, arguments, early=True):
+            with self.tool_manager.lock:
+                self.tool_manager.prefetch_stats["early"] += 1
+
+    def _start(self, tool_name, arguments, early):
+        key = _call_key(tool_name, arguments)
+        if key in self.flights:
+            return False
+        finished = []
+        future = self.tool_manager.executor.submit(contextvars.copy_context().run, self._run, finished, tool_name,
+                                                   arguments)
+        self.flights[key] = (future, time.perf_counter(), finished, early)
+        return True
+
+    def _run(self, finished, tool_name, arguments):
+        try:
+            return self.tool_manager.use_tool(tool_name, **arguments)
+        finally:
+            finished.append(time.perf_counter())
+
+    def take(self, tool_name, arguments):
+        """
+        Claim the speculative run of a call the model asked for.
+        :param tool_name: Name of the tool
+        :param arguments: Arguments dictionary
+        :return: Future of the call, or None if it was not started speculatively
+        """
+        flight = self.flights.pop(_call_key(tool_name, arguments), None)
+        if flight is None:
+            return None
+        future, started, finished, early = flight
+        decided = time.perf_counter()
+
+        def count(_):
+            # The call ran for this long before the model asked for it
+            saved = min(decided, finished[0] if finished else decided) - started
+            with self.tool_manager.lock:
+                # Early starts are not guesses, so they stay out of the prefetch hit rate
+                self.tool_manager.prefetch_stats["used"] += not early
+                self.tool_manager.prefetch_stats["time_saved_s"] += max(saved, 0.0)
+
+        future.add_done_callback(count)
+        return future
+
+    def close(self):
+        """Discard the calls the model did not ask for."""
+        for future, _, _, _ in self.flights.values():
+            future.cancel()
+        with self.tool_manager.lock:
+            self.tool_manager.prefetch_stats["wasted"] += sum(not early for _, _, _, early in self.flights.values())
+        self.flights = {}
+
+
+def _call_key(tool_name, arguments):
+    return tool_name, json.dumps(arguments, sort_keys=True)
+
+
+def _strip_zeros(match):
+    return match.group(1).rstrip(".")
+
+
+def _fit(rows, header, max_tokens):
+    """
+    Keep the header and as many rows as fit in max_tokens, then say how many were left out.
+    :return: Tuple of (lines, whether rows were left out or cut)
+    """
+    lines = [header] if header else []
+    used = count_tokens(header) + 1 if header else 0
+    for index, row in enumerate(rows):
+        left = len(rows) - index
+        # Room for the "...and N more" line unless this is the last row
+        cost = count_tokens(row) + 1 + (8 if left > 1 else 0)
+        if used + cost <= max_tokens:
+            lines.append(row)
+            used += cost - (8 if left > 1 else 0)
+            continue
+        if index == 0 and left == 1:
+            # A single long text, cut to roughly the tokens left
+            lines.append(row[:max(max_tokens - used, 1) * 4] + "…")
+        else:
+            lines.append(f"…and {left} more")
+        return lines, True
+    return lines, False
+
 
 # Tool registration decorator
-def register_tool(description, parameters):
+def register_tool(description, parameters, timeout=None, read_only=False, formatter=None, reply_ttl=None):
     def decorator(func):
         tool_manager.register_tool(
             tool_name=func.__name__,
             tool_function=func,
             description=description,
-            parameters=parameters
+            parameters=parameters,
+            timeout=timeout,
+            read_only=read_only,
+            formatter=formatter,
+            reply_ttl=reply_ttl
         )
         return func
 
@@ -66,6 +421,123 @@ def register_tool(description, parameters):
 tool_manager = ToolManager()
 
 
+class _Flight:
+    """A fetch in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class MarketDataCache:
+    def __init__(self, ttl=Config.PRICE_CACHE_TTL, bulk_refresh=Config.PRICE_CACHE_BULK_REFRESH):
+        """
+        Cache ticker prices with a per-symbol TTL.
+        Concurrent lookups of the same symbol share a single outbound request.
+        :param ttl: Seconds a quote is considered fresh
+        :param bulk_refresh: Refresh all symbols through the all-tickers endpoint on a miss
+        """
+        self.ttl = ttl
+        self.bulk_refresh = bulk_refresh
+        self.prices = {}  # symbol -> (price, fetched_at)
+        self.inflight = {}  # symbol, or "*" for a bulk refresh -> _Flight
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0, "fetches": 0, "bulk_fetches": 0,
+                      "errors": 0}
+
+    def get_price(self, symbol):
+        """
+        Get the price of a symbol, fetching it from Binance if the cached quote is missing or stale.
+        :param symbol: Cryptocurrency pair, e.g., BTCUSDT
+        :return: Price string as returned by Binance
+        """
+        with self.lock:
+            entry = self.prices.get(symbol)
+            if entry and time.monotonic() - entry[1] < self.ttl:
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["stale" if entry else "misses"] += 1
+
+            key = "*" if self.bulk_refresh else symbol
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            try:
+                if self.bulk_refresh:
+                    self._refresh_all()
+                else:
+                    self._refresh_symbol(symbol)
+            except Exception as e:
+                flight.error = e
+                with self.lock:
+                    self.stats["errors"] += 1
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error:
+            raise flight.error
+        with self.lock:
+            entry = self.prices.get(symbol)
+        if entry is None:
+            raise ValueError(f"Unknown symbol {symbol}")
+        return entry[0]
+
+    def invalidate(self, symbol=None):
+        """
+        Drop cached quotes.
+        :param symbol: Symbol to drop, or None to drop everything
+        """
+        with self.lock:
+            if symbol is None:
+                self.prices.clear()
+            else:
+                self.prices.pop(symbol, None)
+
+    def get_stats(self):
+        """
+        Get cache counters.
+        :return: Dictionary of counters and the number of cached symbols
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["symbols"] = len(self.prices)
+        lookups = stats["hits"] + stats["misses"] + stats["stale"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _refresh_symbol(self, symbol):
+        response = binance_client.request("GET", "/api/v3/ticker/price", {"symbol": symbol})
+        if response.status_code != 200:
+            raise ValueError(response.text)
+        price = response.json()["price"]
+        with self.lock:
+            self.stats["fetches"] += 1
+            self.prices[symbol] = (price, time.monotonic())
+
+    def _refresh_all(self):
+        response = binance_client.request("GET", "/api/v3/ticker/price")
+        if response.status_code != 200:
+            raise ValueError(response.text)
+        fetched_at = time.monotonic()
+        with self.lock:
+            self.stats["bulk_fetches"] += 1
+            for ticker in response.json():
+                self.prices[ticker["symbol"]] = (ticker["price"], fetched_at)
+
+
+# Initialize MarketDataCache
+market_data_cache = MarketDataCache()
+
+
 # Tool 1: Get cryptocurrency pair price
 @register_tool(
     description="Get the current price of a cryptocurrency pair.",
@@ -75,18 +547,16 @@ tool_manager = ToolManager()
             "symbol": {"type": "string", "description": "The cryptocurrency pair, e.g., BTCUSDT."}
         },
         "required": ["symbol"]
-    }
+    },
+    read_only=True,
+    reply_ttl=Config.PRICE_CACHE_TTL
 )
-@lru_cache(maxsize=100)
 def get_symbol_price(symbol):
-    url = "https://api.binance.com/api/v3/ticker/price"
-    params = {"symbol": symbol}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        return f"{symbol} current price is: {data['price']} USDT"
-    else:
-        return f"Failed to get {symbol} price: {response.text}"
+    try:
+        price = market_data_cache.get_price(symbol)
+    except ValueError as e:
+        return f"Failed to get {symbol} price: {e}"
+    return f"{symbol} current price is: {price} USDT"
 
 
 # Tool 2: Get account balance
@@ -98,25 +568,17 @@ def get_symbol_price(symbol):
             "asset": {"type": "string", "description": "The cryptocurrency symbol, e.g., BTC."}
         },
         "required": ["asset"]
-    }
+    },
+    read_only=True
 )
 def get_account_balance(asset):
-    url = "https://api.binance.com/api/v3/account"
-    timestamp = int(time.time() * 1000)
-    params = {"timestamp": timestamp}
-    query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-    signature = hmac.new(Config.BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-    params["signature"] = signature
-    headers = {"X-MBX-APIKEY": Config.BINANCE_API_KEY}
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code == 200:
-        balances = response.json().get("balances", [])
-        for balance in balances:
-            if balance["asset"] == asset:
-                return f"{asset} balance is: {balance['free']}"
+    try:
+        balance = account_state.get_balance(asset)
+    except ValueError as e:
+        return f"Failed to get account balance: {e}"
+    if balance is None:
         return f"No balance found for {asset}"
-    else:
-        return f"Failed to get account balance: {response.text}"
+    return f"{asset} balance is: {balance['free']}"
 
 
 # Tool 3: Place a market order
@@ -133,26 +595,29 @@ def get_account_balance(asset):
     }
 )
 def place_market_order(symbol, side, quantity):
-    url = "https://api.binance.com/api/v3/order"
-    timestamp = int(time.time() * 1000)
     params = {
         "symbol": symbol,
         "side": side,
         "type": "MARKET",
-        "quantity": quantity,
-        "timestamp": timestamp
+        "quantity": quantity
     }
-    query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-    signature = hmac.new(Config.BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-    params["signature"] = signature
-    headers = {"X-MBX-APIKEY": Config.BINANCE_API_KEY}
-    response = requests.post(url, headers=headers, params=params)
+    response = binance_client.request("POST", "/api/v3/order", params, signed=True)
     if response.status_code == 200:
+        account_state.invalidate()
+        trade_history.invalidate(symbol)
         return f"{side} {quantity} {symbol} order has been placed"
     else:
         return f"Failed to place order: {response.text}"
 
 
+def _format_trade_history(result, arguments):
+    symbol = arguments.get("symbol", "")
+    if not result:
+        return f"No trades found for {symbol}"
+    rows = [row.replace(f" {symbol} @ ", " @ ") for row in reversed(result)]
+    return f"{symbol} trades (time ms, side, quantity @ price), newest first:", rows
+
+
 # Tool 4: Get trade history
 @register_tool(
     description="Get the recent trade history for a cryptocurrency pair.",
@@ -163,21 +628,16 @@ def place_market_order(symbol, side, quantity):
             "limit": {"type": "integer", "description": "The number of trades to return."}
         },
         "required": ["symbol"]
-    }
+    },
+    read_only=True,
+    formatter=_format_trade_history
 )
 def get_trade_history(symbol, limit=10):
-    url = "https://api.binance.com/api/v3/myTrades"
-    timestamp = int(time.time() * 1000)
     params = {
         "symbol": symbol,
-        "limit": limit,
-        "timestamp": timestamp
+        "limit": limit
     }
-    query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-    signature = hmac.new(Config.BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-    params["signature"] = signature
-    headers = {"X-MBX-APIKEY": Config.BINANCE_API_KEY}
-    response = requests.get(url, headers=headers, params=params)
+    response = binance_client.request("GET", "/api/v3/myTrades", params, signed=True)
     if response.status_code == 200:
         trades = response.json()
         return [f"{trade['time']}: {trade['side']} {trade['qty']} {symbol} @ {trade['price']}" for trade in trades]
@@ -185,6 +645,13 @@ def get_trade_history(symbol, limit=10):
         return f"Failed to get trade history: {response.text}"
 
 
+def _format_open_orders(result, arguments):
+    symbol = arguments.get("symbol", "")
+    if not result:
+        return f"No open orders for {symbol}"
+    return f"{symbol} open orders (side, quantity @ price):", [row.replace(f" {symbol} @ ", " @ ") for row in result]
+
+
 # Tool 5: Get open orders
 @register_tool(
     description="Get the current open orders for a cryptocurrency pair.",
@@ -194,25 +661,16 @@ def get_trade_history(symbol, limit=10):
             "symbol": {"type": "string", "description": "The cryptocurrency pair, e.g., BTCUSDT."}
         },
         "required": ["symbol"]
-    }
+    },
+    read_only=True,
+    formatter=_format_open_orders
 )
 def get_open_orders(symbol):
-    url = "https://api.binance.com/api/v3/openOrders"
-    timestamp = int(time.time() * 1000)
-    params = {
-        "symbol": symbol,
-        "timestamp": timestamp
-    }
-    query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-    signature = hmac.new(Config.BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-    params["signature"] = signature
-    headers = {"X-MBX-APIKEY": Config.BINANCE_API_KEY}
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code == 200:
-        orders = response.json()
-        return [f"{order['side']} {order['origQty']} {symbol} @ {order['price']}" for order in orders]
-    else:
-        return f"Failed to get open orders: {response.text}"
+    try:
+        orders = account_state.get_open_orders(symbol)
+    except ValueError as e:
+        return f"Failed to get open orders: {e}"
+    return [f"{order['side']} {order['origQty']} {symbol} @ {order['price']}" for order in orders]
 
 
 # Tool 6: Cancel an order
@@ -228,19 +686,153 @@ def get_open_orders(symbol):
     }
 )
 def cancel_order(symbol, order_id):
-    url = "https://api.binance.com/api/v3/order"
-    timestamp = int(time.time() * 1000)
     params = {
         "symbol": symbol,
-        "orderId": order_id,
-        "timestamp": timestamp
+        "orderId": order_id
     }
-    query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-    signature = hmac.new(Config.BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-    params["signature"] = signature
-    headers = {"X-MBX-APIKEY": Config.BINANCE_API_KEY}
-    response = requests.delete(url, headers=headers, params=params)
+    response = binance_client.request("DELETE", "/api/v3/order", params, signed=True)
     if response.status_code == 200:
+        account_state.invalidate()
         return f"Order {order_id} has been canceled"
     else:
         return f"Failed to cancel order: {response.text}"
+
+
+# Tool 7: Summarize trade history
+@register_tool(
+    description="Summarize all trades of a cryptocurrency pair: volume, VWAP, realized PnL and fees.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "symbol": {"type": "string", "description": "The cryptocurrency pair, e.g., BTCUSDT."},
+            "days": {"type": "integer", "description": "Only count trades of the last N days, all trades if omitted."}
+        },
+        "required": ["symbol"]
+    },
+    read_only=True
+)
+def get_trade_summary(symbol, days=None):
+    try:
+        summary = trade_history.summary(symbol, days)
+    except ValueError as e:
+        return f"Failed to get trade summary: {e}"
+    if not summary["trades"]:
+        return f"No trades found for {symbol}"
+    fees = ", ".join(f"{fee:.8g} {asset}" for asset, fee in summary["fees"].items())
+    return (f"{symbol}: {summary['trades']} trades, "
+            f"bought {summary['buy_qty']:.8g} @ {summary['buy_vwap']:.8g}, "
+            f"sold {summary['sell_qty']:.8g} @ {summary['sell_vwap']:.8g}, "
+            f"VWAP {summary['vwap']:.8g}, quote volume {summary['quote_volume']:.8g}, "
+            f"realized PnL {summary['realized_pnl']:.8g}, net position {summary['net_qty']:.8g}, fees {fees}")
+
+
+def _format_daily_volume(result, arguments):
+    symbol = arguments.get("symbol", "")
+    if not result:
+        return f"No trades found for {symbol}"
+    rows = [row.replace(f" {symbol} (", " (") for row in reversed(result)]
+    return f"{symbol} daily volume (UTC day: base (quote) in trades), newest first:", rows
+
+
+# Tool 8: Get daily trading volume
+@register_tool(
+    description="Get the traded volume of a cryptocurrency pair per day.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "symbol": {"type": "string", "description": "The cryptocurrency pair, e.g., BTCUSDT."},
+            "days": {"type": "integer", "description": "The number of most recent days."}
+        },
+        "required": ["symbol"]
+    },
+    read_only=True,
+    formatter=_format_daily_volume
+)
+def get_daily_volume(symbol, days=7):
+    try:
+        volumes = trade_history.daily_volume(symbol, days)
+    except ValueError as e:
+        return f"Failed to get daily volume: {e}"
+    return [f"{date}: {base:.8g} {symbol} ({quote:.8g} quote) in {count} trades"
+            for date, base, quote, count in volumes]
+
+
+def _until_candle_close(arguments):
+    """Seconds until the current candle of the interval closes; results on closed candles hold until then."""
+    interval_ms = INTERVAL_MS.get(arguments.get("interval", "1d"))
+    if interval_ms is None:
+        return 0
+    # Weekly candles open on Mondays, four days after the epoch; the others are aligned to it
+    offset_ms = 4 * INTERVAL_MS["1d"] if arguments.get("interval") == "1w" else 0
+    return (interval_ms - (time.time() * 1000 - offset_ms) % interval_ms) / 1000
+
+
+def _format_klines(result, arguments):
+    # Newest first, so a cut drops the oldest candles
+    return result[0] + ", newest first:", result[:0:-1]
+
+
+# Tool 9: Get candles
+@register_tool(
+    description="Get the most recent closed candles (open, high, low, close, volume) of a cryptocurrency pair.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "symbol": {"type": "string", "description": "The cryptocurrency pair, e.g., BTCUSDT."},
+            "interval": {"type": "string", "enum": list(INTERVAL_MS),
+                         "description": "The candle interval, e.g., 1h or 1d. Defaults to 1d."},
+            "limit": {"type": "integer", "description": "The number of candles, at most 100. Defaults to 7."}
+        },
+        "required": ["symbol"]
+    },
+    read_only=True,
+    formatter=_format_klines,
+    reply_ttl=_until_candle_close
+)
+def get_klines(symbol, interval="1d", limit=7):
+    try:
+        candles = kline_store.get_candles(symbol, interval, max(1, min(int(limit), 100)))
+    except ValueError as e:
+        return f"Failed to get {symbol} candles: {e}"
+    if not len(candles):
+        return f"No {interval} candles found for {symbol}"
+    first, last = float(candles["open"][0]), float(candles["close"][-1])
+    header = (f"{symbol} {interval}, {len(candles)} candles: {first:.8g} -> {last:.8g} "
+              f"({(last / first - 1) * 100:+.2f}%), high {candles['high'].max():.8g}, low {candles['low'].min():.8g}")
+    return [header] + [f"{_candle_time(candle['open_time'], interval)}: O {candle['open']:.8g} H {candle['high']:.8g} "
+                       f"L {candle['low']:.8g} C {candle['close']:.8g} V {candle['volume']:.6g}" for candle in candles]
+
+
+# Tool 10: Get an indicator
+@register_tool(
+    description="Compute a technical indicator over the closed candles of a cryptocurrency pair: "
+                "sma or ema (moving averages), rsi, or volatility (annualized).",
+    parameters={
+        "type": "object",
+        "properties": {
+            "symbol": {"type": "string", "description": "The cryptocurrency pair, e.g., BTCUSDT."},
+            "indicator": {"type": "string", "enum": list(INDICATORS), "description": "The indicator to compute."},
+            "period": {"type": "integer", "description": "The indicator period in candles, e.g., 50. Defaults to 14."},
+            "interval": {"type": "string", "enum": list(INTERVAL_MS),
+                         "description": "The candle interval, e.g., 1h or 1d. Defaults to 1d."}
+        },
+        "required": ["symbol", "indicator"]
+    },
+    read_only=True,
+    reply_ttl=_until_candle_close
+)
+def get_indicator(symbol, indicator, period=14, interval="1d"):
+    try:
+        value, open_time = kline_store.indicator(symbol, indicator.lower(), int(period), interval)
+    except ValueError as e:
+        return f"Failed to compute {indicator} for {symbol}: {e}"
+    if indicator.lower() == "volatility":
+        return f"{symbol} {period}-period {interval} volatility is: {value * 100:.2f}% annualized"
+    return (f"{symbol} {indicator.upper()}({period}) on {interval} candles is: {value:.8g} "
+            f"as of the candle opened {_candle_time(open_time, interval)}")
+
+
+def _candle_time(open_time, interval):
+    """Open time of a candle in UTC, without the time of day for daily and longer intervals."""
+    pattern = "%Y-%m-%d" if INTERVAL_MS[interval] >= INTERVAL_MS["1d"] else "%Y-%m-%d %H:%M"
+    return time.strftime(pattern, time.gmtime(int(open_time) / 1000))
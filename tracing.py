@@ -0,0 +1,194 @@
+# tracing.py
+#
+# Per-stage latency spans of the chat pipeline. Every finished span is aggregated into a latency
+# histogram per stage, and into counters of the upstream status, cache hits and tokens it carries,
+# exported in the Prometheus text format on /metrics. A request that sends the trace header also
+# gets its own spans back in the details of the final SSE event.
+
+import threading
+import time
+from contextvars import ContextVar
+
+from config import Config
+from metrics import LatencyStats, prometheus_counter, prometheus_histogram
+
+TRACE_HEADER = "X-Trace-Id"
+
+# Innermost open span of the running thread or task; pools started through copy_context().run inherit it
+_current = ContextVar("current_span", default=None)
+
+
+class _Trace:
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.spans = []  # Finished spans, appended from any thread
+
+
+class Span:
+    __slots__ = ("tracer", "name", "attributes", "parent", "trace", "upstream", "upstream_calls", "start",
+                 "duration", "token")
+
+    recording = True
+
+    def __init__(self, tracer, name, attributes, parent, trace, upstream=False):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.trace = trace
+        self.upstream = upstream
+        self.upstream_calls = 0  # Upstream spans finished inside this one, e.g. Binance requests of a tool call
+        self.start = None
+        self.duration = None
+        self.token = None
+
+    def set(self, **attributes):
+        """Add attributes, e.g. status, cache_hit, prompt_tokens or completion_tokens."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self.start
+        try:
+            _current.reset(self.token)
+        except ValueError:
+            pass  # A generator holding the span was closed from another context
+        if exc_type is not None and "status" not in self.attributes:
+            self.attributes["status"] = getattr(exc, "status_code", None) or exc_type.__name__
+        self.tracer.finish(self)
+        return False
+
+    def details(self):
+        """
+        Spans of the request this span is the root of.
+        :return: Dictionary with the trace id and the spans in start order, times in milliseconds
+                 from the start of the root, or None if the request did not ask for a trace
+        """
+        if self.trace is None:
+            return None
+        spans = sorted(self.trace.spans, key=lambda span: span.start)
+        return {"id": self.trace.id, "spans": [dict(span.attributes, name=span.name,
+                                                    start_ms=round((span.start - self.start) * 1000, 3),
+                                                    duration_ms=round(span.duration * 1000, 3))
+                                               for span in spans]}
+
+
+class _NoSpan:
+    """Span handed out while tracing is disabled: entering, setting and leaving it do nothing."""
+
+    recording = False
+    upstream_calls = 0
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def details(self):
+        return None
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    def __init__(self, enabled=Config.TRACING_ENABLED):
+        """
+        Time the stages of chat turns.
+        :param enabled: Record spans at all; when False, span() returns NO_SPAN and costs a function call
+        """
+        self.enabled = enabled
+        self.latency = LatencyStats()  # Per stage
+        self.counters = {}  # (counter, stage, label value) -> count
+        self.lock = threading.Lock()
+
+    def span(self, name, trace_id=None, **attributes):
+        """
+        Open a span, nested in the current one.
+        :param name: Stage name, e.g. chat.llm or tool.get_symbol_price
+        :param trace_id: Start a trace collecting this span and all spans nested in it
+        :param attributes: Initial attributes
+        :return: Span to use with `with`
+        """
+        if not self.enabled:
+            return NO_SPAN
+        parent = _current.get()
+        trace = _Trace(trace_id) if trace_id is not None else parent.trace if parent is not None else None
+        return Span(self, name, attributes, parent, trace)
+
+    def upstream(self, name, **attributes):
+        """Open a span around a request to an upstream; the spans it is nested in count it in upstream_calls."""
+        if not self.enabled:
+            return NO_SPAN
+        parent = _current.get()
+        return Span(self, name, attributes, parent, parent.trace if parent is not None else None, upstream=True)
+
+    def record(self, name, seconds, **attributes):
+        """
+        Record a stage timed by the caller, e.g. time spread over several calls, as a span ending now.
+        :param name: Stage name
+        :param seconds: Duration in seconds
+        :param attributes: Attributes
+        """
+        if not self.enabled:
+            return
+        parent = _current.get()
+        span = Span(self, name, attributes, parent, parent.trace if parent is not None else None)
+        span.duration = seconds
+        span.start = time.perf_counter() - seconds
+        self.finish(span)
+
+    def finish(self, span):
+        """Aggregate a finished span and add it to its trace."""
+        self.latency.record(span.name, span.duration)
+        attributes = span.attributes
+        with self.lock:
+            if span.upstream:
+                parent = span.parent
+                while parent is not None:
+                    parent.upstream_calls += 1
+                    parent = parent.parent
+            if "status" in attributes:
+                self._count("status", span.name, attributes["status"], 1)
+            if "cache_hit" in attributes:
+                self._count("cache", span.name, "hit" if attributes["cache_hit"] else "miss", 1)
+            for kind in ("prompt", "completion"):
+                if f"{kind}_tokens" in attributes:
+                    self._count("tokens", span.name, kind, attributes[f"{kind}_tokens"])
+        if span.trace is not None:
+            span.trace.spans.append(span)
+
+    def render_prometheus(self):
+        """
+        Export the aggregated spans.
+        :return: Text in the Prometheus exposition format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: tuple(map(str, item[0])))
+        lines = prometheus_histogram("binance_agent_stage_seconds", "Latency of each stage of a chat turn.",
+                                     "stage", self.latency.snapshot())
+        for counter, name, description, label in (
+                ("status", "binance_agent_stage_status_total", "Finished spans per stage and status.", "status"),
+                ("cache", "binance_agent_cache_lookups_total",
+                 "Cache lookups per stage, e.g. read-only tool calls and the response cache.", "result"),
+                ("tokens", "binance_agent_tokens_total", "Tokens sent to and received from the LLM.", "kind")):
+            lines.extend(prometheus_counter(name, description, [({"stage": stage, label: value}, count)
+                                                                for (kind, stage, value), count in counters
+                                                                if kind == counter]))
+        return "\n".join(lines) + "\n"
+
+    def _count(self, counter, stage, value, amount):
+        key = (counter, stage, value)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+
+# Initialize Tracer
+tracer = Tracer()